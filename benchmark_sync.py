@@ -0,0 +1,443 @@
+"""Throughput benchmark for sync_client.py delivery modes.
+
+Every mode runs the real ``run_single_sync`` path in a child process against
+a local HTTP sink that emulates ``API_URL`` and ``API_BATCH_URL``. Rows come
+from an in-process stand-in for the HIS (``--db stub``, synthetic rows shaped
+like a HOSxP visit table, no network) or from a real MySQL server seeded with
+the same rows (``--db mysql``, connection taken from the ``HIS_DB_*`` env).
+
+    python benchmark_sync.py --rows 20000 --width 8 --latency-ms 5
+    python benchmark_sync.py --modes batch,batch-c4 --save-baseline
+    python benchmark_sync.py --db mysql --rows 100000
+
+Results are compared with the stored baseline; the exit code is 1 when a mode
+got slower (or bigger) than ``--tolerance`` allows.
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections.abc import Iterator
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+import pymysql
+from pymysql.constants import FIELD_TYPE
+
+import sync_client
+
+DEFAULT_BASELINE_PATH = os.path.join("state", "bench", "baseline.json")
+BENCH_SOURCE = "bench_visit.sql"
+
+# Delivery settings per mode, applied on top of load_config(). The rate
+# limiter is opened up in every mode so the numbers show what the pipeline
+# can do rather than what POST_SLEEP_MS allows.
+MODES: dict[str, dict[str, Any]] = {
+    "single": {"post_batch_size": 1, "post_concurrency": 1},
+    "single-c8": {"post_batch_size": 1, "post_concurrency": 8},
+    "batch": {"post_batch_size": 500, "post_concurrency": 1},
+    "batch-c4": {"post_batch_size": 500, "post_concurrency": 4},
+    "batch-gzip": {"post_batch_size": 500, "post_concurrency": 4, "post_wire_encoding": "gzip"},
+    "batch-columnar": {"post_batch_size": 500, "post_concurrency": 4, "post_batch_format": "columnar"},
+    "stream-batch": {
+        "post_batch_size": 500,
+        "post_concurrency": 4,
+        "db_stream": True,
+        "db_stream_chunk": 1000,
+    },
+}
+
+THAI_NAMES = ["สมชาย", "สมหญิง", "ประเสริฐ", "วิไลวรรณ", "กาญจนา", "อนุชา", "สุดารัตน์"]
+DIAGNOSES = ["J069", "I10", "E119", "K297", "M545", "Z000", "A099", "R51"]
+
+
+def synthetic_rows(count: int, width: int, seed: int = 11253) -> Iterator[dict[str, Any]]:
+    """Yield rows with the value types pymysql returns for a visit table."""
+    rng = random.Random(seed)
+    first_day = date(2024, 1, 1)
+    alphabet = string.ascii_letters + string.digits
+    for index in range(1, count + 1):
+        visit_day = first_day + timedelta(days=index % 365)
+        row: dict[str, Any] = {
+            "hoscode": "11253",
+            "hn": f"{index % 90000 + 1:09d}",
+            "vn": f"{visit_day:%y%m%d}{index:08d}",
+            "vstdate": visit_day,
+            "vsttime": timedelta(seconds=28800 + rng.randrange(36000)),
+            "regdatetime": datetime(visit_day.year, visit_day.month, visit_day.day, 8)
+            + timedelta(seconds=rng.randrange(36000)),
+            "fname": rng.choice(THAI_NAMES),
+            "pttype": f"{rng.randrange(1, 90):02d}",
+            "pdx": rng.choice(DIAGNOSES),
+            "age_y": rng.randrange(0, 100),
+            "income": Decimal(rng.randrange(0, 500000)) / 100,
+        }
+        for column in range(1, width + 1):
+            row[f"note_{column}"] = "".join(rng.choices(alphabet, k=24))
+        yield row
+
+
+def field_type(value: Any) -> int:
+    if isinstance(value, datetime):
+        return FIELD_TYPE.DATETIME
+    if isinstance(value, date):
+        return FIELD_TYPE.DATE
+    if isinstance(value, timedelta):
+        return FIELD_TYPE.TIME
+    if isinstance(value, Decimal):
+        return FIELD_TYPE.NEWDECIMAL
+    if isinstance(value, int):
+        return FIELD_TYPE.LONG
+    return FIELD_TYPE.VAR_STRING
+
+
+class StubCursor:
+    """Tuple cursor over synthetic rows; rows are generated while they are fetched."""
+
+    def __init__(self, count: int, width: int) -> None:
+        self.count = count
+        self.width = width
+        self.description: tuple[tuple[Any, ...], ...] | None = None
+        self._rows: Iterator[tuple[Any, ...]] = iter(())
+
+    def execute(self, query: str, args: Any = None) -> int:
+        if query.lstrip().upper().startswith(("SET ", "SHOW ")):
+            self.description = None
+            self._rows = iter(())
+            return 0
+        sample = next(synthetic_rows(1, self.width))
+        self.description = tuple(
+            (name, field_type(value), None, None, None, None, True) for name, value in sample.items()
+        )
+        self._rows = (tuple(row.values()) for row in synthetic_rows(self.count, self.width))
+        return self.count
+
+    def fetchall(self) -> list[tuple[Any, ...]]:
+        return list(self._rows)
+
+    def fetchmany(self, size: int) -> list[tuple[Any, ...]]:
+        return [row for _, row in zip(range(size), self._rows)]
+
+    def close(self) -> None:
+        self._rows = iter(())
+
+    def __enter__(self) -> "StubCursor":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+class StubConnection:
+    def __init__(self, count: int, width: int) -> None:
+        self.count = count
+        self.width = width
+        self.open = True
+
+    def cursor(self, cursorclass: type | None = None) -> StubCursor:
+        return StubCursor(self.count, self.width)
+
+    def ping(self, reconnect: bool = False) -> None:
+        pass
+
+    def close(self) -> None:
+        self.open = False
+
+
+def install_stub_db(count: int, width: int) -> None:
+    pymysql.connect = lambda **kwargs: StubConnection(count, width)
+
+
+def bench_table(count: int, width: int) -> str:
+    return f"bench_visit_{count}_{width}"
+
+
+def seed_mysql(config: dict[str, Any], count: int, width: int) -> str:
+    """Create and fill the benchmark table once; later runs reuse it."""
+    table = bench_table(count, width)
+    notes = "".join(f", note_{column} VARCHAR(32)" for column in range(1, width + 1))
+    connection = sync_client.connect_db(config, pymysql.cursors.Cursor)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                "hoscode VARCHAR(5), hn VARCHAR(9), vn VARCHAR(14) PRIMARY KEY, vstdate DATE, vsttime TIME, "
+                "regdatetime DATETIME, fname VARCHAR(64), pttype VARCHAR(2), pdx VARCHAR(8), "
+                f"age_y INT, income DECIMAL(10,2){notes}) DEFAULT CHARSET=utf8mb4"
+            )
+            cursor.execute(f"SELECT COUNT(*) FROM {table}")
+            if cursor.fetchone()[0] == count:
+                return table
+            cursor.execute(f"TRUNCATE TABLE {table}")
+            columns = None
+            chunk: list[tuple[Any, ...]] = []
+            for row in synthetic_rows(count, width):
+                if columns is None:
+                    columns = list(row)
+                chunk.append(tuple(row.values()))
+                if len(chunk) >= 1000:
+                    insert_rows(cursor, table, columns, chunk)
+                    chunk = []
+            if chunk:
+                insert_rows(cursor, table, columns, chunk)
+        connection.commit()
+    finally:
+        connection.close()
+    return table
+
+
+def insert_rows(cursor: Any, table: str, columns: list[str], rows: list[tuple[Any, ...]]) -> None:
+    placeholders = ", ".join(["%s"] * len(columns))
+    cursor.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})", rows)
+
+
+class HttpSink:
+    """Local stand-in for the raw and batch endpoints.
+
+    Every POST waits ``latency`` seconds and fails with 503 at ``error_rate``.
+    Request and byte counts are kept so the parent can report bytes on the wire.
+    """
+
+    def __init__(self, latency: float, error_rate: float, seed: int = 1) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.bytes_received = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_port}/raw"
+
+    def _handler(self) -> type[BaseHTTPRequestHandler]:
+        sink = self
+
+        class SinkHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Without TCP_NODELAY every keep-alive reply waits on delayed ACK.
+            disable_nagle_algorithm = True
+
+            def do_POST(self) -> None:
+                body = self.rfile.read(int(self.headers.get("Content-Length", "0")))
+                with sink._lock:
+                    sink.requests += 1
+                    sink.bytes_received += len(body)
+                    failed = sink._rng.random() < sink.error_rate
+                if sink.latency:
+                    time.sleep(sink.latency)
+                status = 503 if failed else 200
+                reply = b'{"status":"ok"}' if not failed else b'{"status":"unavailable"}'
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        return SinkHandler
+
+    def start(self) -> None:
+        threading.Thread(target=self._server.serve_forever, name="bench-sink", daemon=True).start()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.requests = 0
+            self.bytes_received = 0
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def run_worker(spec: dict[str, Any]) -> dict[str, Any]:
+    """Run one mode in this process and return its measurements."""
+    config = sync_client.load_config()
+    config.update(
+        {
+            "api_url": spec["api_url"],
+            "api_batch_url": f"{spec['api_url']}/batch",
+            "post_rate": 1_000_000.0,
+            "post_rate_max": 1_000_000.0,
+            "post_rate_adaptive": False,
+            "post_log_every": 0,
+            "row_fingerprint": False,
+            "db_stream": False,
+        }
+    )
+    config.update(MODES[spec["mode"]])
+    if spec["db"] == "stub":
+        install_stub_db(spec["rows"], spec["width"])
+
+    latencies: list[float] = []
+    latency_lock = threading.Lock()
+
+    def record_latency(response: Any, *args: Any, **kwargs: Any) -> None:
+        with latency_lock:
+            latencies.append(response.elapsed.total_seconds())
+
+    sync_client.get_session(config).hooks["response"].append(record_latency)
+    metrics = sync_client.RunMetrics(BENCH_SOURCE)
+    started = time.perf_counter()
+    with sync_client.use_metrics(metrics):
+        exit_code = sync_client.run_single_sync(config, BENCH_SOURCE, spec["sql"], False)
+    elapsed = time.perf_counter() - started
+    record = metrics.record(exit_code)
+    rows = record["counters"].get("rows_success", 0) + record["counters"].get("rows_failed", 0)
+    return {
+        "exit_code": exit_code,
+        "elapsed": round(elapsed, 3),
+        "rows": rows,
+        "failed": record["counters"].get("rows_failed", 0),
+        "rows_per_sec": round(rows / elapsed, 1) if elapsed > 0 else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        # ru_maxrss is in KiB on Linux.
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "phases": record["phases"],
+    }
+
+
+def run_mode(args: argparse.Namespace, sink: HttpSink, mode: str, sql_text: str) -> dict[str, Any]:
+    spec = {
+        "mode": mode,
+        "db": args.db,
+        "rows": args.rows,
+        "width": args.width,
+        "sql": sql_text,
+        "api_url": sink.url,
+    }
+    sink.reset()
+    with tempfile.TemporaryDirectory(prefix="plk-bench-") as work_dir:
+        result_path = os.path.join(work_dir, "result.json")
+        env = dict(os.environ, SYNC_STATE_DIR=os.path.join(work_dir, "state"))
+        # The child runs in a scratch directory so its error log and outbox
+        # do not mix with the real ones.
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--worker", json.dumps(spec), result_path],
+            cwd=work_dir,
+            env=env,
+            check=True,
+            stdout=None if args.verbose else subprocess.DEVNULL,
+        )
+        with open(result_path, "r", encoding="utf-8") as f:
+            result = json.load(f)
+    result["requests"] = sink.requests
+    result["bytes_sent"] = sink.bytes_received
+    return result
+
+
+def baseline_key(args: argparse.Namespace, mode: str) -> str:
+    return (
+        f"{mode}|db={args.db}|rows={args.rows}|width={args.width}"
+        f"|latency={args.latency_ms}|errors={args.error_rate}"
+    )
+
+
+def compare(result: dict[str, Any], baseline: dict[str, Any] | None, tolerance: float) -> list[str]:
+    """Return the metrics that regressed against the baseline."""
+    if not baseline:
+        return []
+    regressions = []
+    if result["rows_per_sec"] < baseline["rows_per_sec"] * (1 - tolerance):
+        regressions.append("rows/s")
+    for name in ("p99_ms", "peak_rss_mb", "bytes_sent"):
+        if baseline[name] and result[name] > baseline[name] * (1 + tolerance):
+            regressions.append(name)
+    return regressions
+
+
+def format_delta(value: float, base: float | None) -> str:
+    if not base:
+        return ""
+    return f" ({(value - base) / base * 100:+.0f}%)"
+
+
+def main() -> int:
+    if len(sys.argv) == 4 and sys.argv[1] == "--worker":
+        result = run_worker(json.loads(sys.argv[2]))
+        with open(sys.argv[3], "w", encoding="utf-8") as f:
+            json.dump(result, f)
+        return 0
+
+    parser = argparse.ArgumentParser(description="Benchmark sync_client.py delivery modes")
+    parser.add_argument("--rows", type=int, default=20000, help="rows per run")
+    parser.add_argument("--width", type=int, default=8, help="extra 24-char text columns per row")
+    parser.add_argument("--db", choices=["stub", "mysql"], default="stub", help="row source")
+    parser.add_argument("--latency-ms", type=float, default=2.0, help="sink latency per POST")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of POSTs answered 503")
+    parser.add_argument("--modes", default=",".join(MODES), help="comma separated: " + ",".join(MODES))
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH, help="baseline JSON file")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed regression ratio")
+    parser.add_argument("--verbose", action="store_true", help="show sync_client output")
+    args = parser.parse_args()
+
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    unknown = [mode for mode in modes if mode not in MODES]
+    if unknown:
+        parser.error(f"unknown modes: {', '.join(unknown)}")
+
+    if args.db == "mysql":
+        table = seed_mysql(sync_client.load_config(), args.rows, args.width)
+        sql_text = f"SELECT * FROM {table} ORDER BY vn"
+    else:
+        sql_text = f"SELECT * FROM {bench_table(args.rows, args.width)}"
+
+    sink = HttpSink(args.latency_ms / 1000, args.error_rate)
+    sink.start()
+    baselines = sync_client.read_json_file(args.baseline) or {}
+    regressed = False
+    print(
+        f"rows={args.rows} width={args.width} db={args.db} "
+        f"latency={args.latency_ms}ms error_rate={args.error_rate}"
+    )
+    print(f"{'mode':<16}{'rows/s':>18}{'p50 ms':>10}{'p99 ms':>16}{'rss MB':>14}{'bytes':>20}{'reqs':>8}{'failed':>8}")
+    try:
+        for mode in modes:
+            key = baseline_key(args, mode)
+            result = run_mode(args, sink, mode, sql_text)
+            base = baselines.get(key)
+            regressions = compare(result, base, args.tolerance)
+            regressed = regressed or bool(regressions)
+            base = base or {}
+            print(
+                f"{mode:<16}"
+                f"{result['rows_per_sec']:>10.0f}{format_delta(result['rows_per_sec'], base.get('rows_per_sec')):>8}"
+                f"{result['p50_ms']:>10.2f}"
+                f"{result['p99_ms']:>10.2f}{format_delta(result['p99_ms'], base.get('p99_ms')):>6}"
+                f"{result['peak_rss_mb']:>8.1f}{format_delta(result['peak_rss_mb'], base.get('peak_rss_mb')):>6}"
+                f"{result['bytes_sent']:>12}{format_delta(result['bytes_sent'], base.get('bytes_sent')):>8}"
+                f"{result['requests']:>8}{result['failed']:>8}"
+                + (f"  REGRESSION: {', '.join(regressions)}" if regressions else "")
+            )
+            if args.save_baseline:
+                baselines[key] = result
+    finally:
+        sink.stop()
+
+    if args.save_baseline:
+        sync_client.write_json_file(args.baseline, baselines)
+        print(f"baseline saved to {args.baseline}")
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,5 +9,12 @@ echo "[$(date '+%Y-%m-%d %H:%M:%S')] [entrypoint] running initial 000_sync_test.
 echo "[$(date '+%Y-%m-%d %H:%M:%S')] [entrypoint] starting MQTT listener" >> /app/logs/cron.log
 /usr/local/bin/python /app/mqtt_handler_sync_custom.py >> /app/logs/mqtt.log 2>&1 &
 
+if [ "${SYNC_DAEMON:-0}" = "1" ]; then
+  echo "[$(date '+%Y-%m-%d %H:%M:%S')] [entrypoint] starting sync daemon" >> /app/logs/cron.log
+  /usr/local/bin/python /app/sync_client.py --daemon >> /app/logs/cron.log 2>&1 &
+  # the daemon runs the sync jobs itself; cron keeps only logrotate
+  sed -i '/sync_client.py/d' /etc/cron.d/sync-client
+fi
+
 echo "[$(date '+%Y-%m-%d %H:%M:%S')] [entrypoint] starting cron" >> /app/logs/cron.log
 exec cron -f
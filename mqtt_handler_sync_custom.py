@@ -1,23 +1,27 @@
 from __future__ import annotations
 
+import gzip
 import json
 import os
+import re
 import sys
+import threading
 import time
-from datetime import date, datetime, timezone
-from decimal import Decimal
+from collections import OrderedDict, deque
+from collections.abc import Iterable, Sized
+from datetime import datetime, timezone
 from typing import Any
 
 import paho.mqtt.client as mqtt
-import pymysql
 import requests
 from dotenv import load_dotenv
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
+from sync_client import APP_DIR, append_error_log, fetch_rows, stream_rows
+
 
 MQTT_TOPIC = "sync/custom"
-ERROR_LOG_PATH = os.path.join("logs", "err_message.log")
 
 
 def log(msg: str) -> None:
@@ -28,7 +32,7 @@ def log(msg: str) -> None:
 def load_config() -> dict[str, Any]:
     # Hard-coded config for MQTT sync custom worker
     load_dotenv()
-    return {
+    config: dict[str, Any] = {
         "api_url": os.getenv("API_URL", "http://localhost:8000/raw"),
         "api_batch_url": os.getenv("API_BATCH_URL", ""),
         "sync_scripts_url": os.getenv("SYNC_SCRIPTS_URL", "").strip(),
@@ -51,76 +55,38 @@ def load_config() -> dict[str, Any]:
         "db_write_timeout": int(os.getenv("HIS_DB_WRITE_TIMEOUT", "60")),
         "db_retry_total": int(os.getenv("HIS_DB_RETRY_TOTAL", "2")),
         "db_retry_backoff": float(os.getenv("HIS_DB_RETRY_BACKOFF", "0.5")),
+        "db_pool_size": int(os.getenv("HIS_DB_POOL_SIZE", "4")),
+        "db_pool_idle_timeout": int(os.getenv("HIS_DB_POOL_IDLE_TIMEOUT", "300")),
+        "db_pool_wait_timeout": int(os.getenv("HIS_DB_POOL_WAIT_TIMEOUT", "60")),
+        "db_stream": os.getenv("HIS_DB_STREAM", "0").strip().lower() in {"1", "true", "yes"},
+        "db_stream_chunk": int(os.getenv("HIS_DB_STREAM_CHUNK", "1000")),
+        "db_stream_net_write_timeout": int(os.getenv("HIS_DB_STREAM_NET_WRITE_TIMEOUT", "600")),
+        # HIS load governor, shared with sync_client through SYNC_STATE_DIR
+        "state_dir": os.path.join(APP_DIR, os.getenv("SYNC_STATE_DIR", "state")),
+        "his_max_execution_ms": int(os.getenv("HIS_MAX_EXECUTION_MS", "0")),
+        "his_max_execution_overrides": os.getenv("HIS_MAX_EXECUTION_OVERRIDES", ""),
+        "his_max_queries": int(os.getenv("HIS_MAX_CONCURRENT_QUERIES", "4")),
+        "his_heavy_seconds": float(os.getenv("HIS_HEAVY_QUERY_SECONDS", "60")),
+        "his_heavy_wait_seconds": float(os.getenv("HIS_HEAVY_WAIT_SECONDS", "0")),
+        "his_track_examined": os.getenv("HIS_TRACK_EXAMINED", "1").strip().lower()
+        in {"1", "true", "yes"},
+        # work queue between paho's network thread and the DB/HTTP workers
+        "mqtt_workers": int(os.getenv("MQTT_WORKERS", "2")),
+        "mqtt_queue_size": int(os.getenv("MQTT_QUEUE_SIZE", "20")),
+        "mqtt_queue_policy": os.getenv("MQTT_QUEUE_POLICY", "drop_new").strip().lower(),
+        "mqtt_cache_ttl": float(os.getenv("MQTT_CACHE_TTL", "120")),
+        "mqtt_cache_max_bytes": int(os.getenv("MQTT_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+        # request/response mode: rows published back to the message's reply_to topic
+        "mqtt_reply_chunk_rows": int(os.getenv("MQTT_REPLY_CHUNK_ROWS", "500")),
+        "mqtt_reply_qos": int(os.getenv("MQTT_REPLY_QOS", "1")),
         # MQTT broker – fully hard-coded
         "mqtt_broker_host": "76.13.182.35",
         "mqtt_broker_port": 1883,
         "mqtt_broker_username": "hosplk",
         "mqtt_broker_password": "112233",
     }
-
-
-def append_error_log(err_message: str) -> None:
-    os.makedirs(os.path.dirname(ERROR_LOG_PATH), exist_ok=True)
-    date_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(ERROR_LOG_PATH, "a", encoding="utf-8") as f:
-        f.write(f"{date_time} , {err_message}\n")
-
-
-def normalize_value(value: Any) -> Any:
-    if isinstance(value, Decimal):
-        return float(value)
-    if isinstance(value, (datetime, date)):
-        return value.isoformat()
-    return value
-
-
-def normalize_row(row: dict[str, Any]) -> dict[str, Any]:
-    return {key: normalize_value(value) for key, value in row.items()}
-
-
-def is_retryable_mysql_error(error: Exception) -> bool:
-    if isinstance(error, (pymysql.err.OperationalError, pymysql.err.InterfaceError)):
-        code = error.args[0] if error.args else None
-        return code in {2006, 2013, 2014, 2055}
-    return "Lost connection to MySQL server" in str(error)
-
-
-def fetch_rows(config: dict[str, Any], sql_text: str) -> list[dict[str, Any]]:
-    retries = max(0, config["db_retry_total"])
-    backoff = config["db_retry_backoff"]
-    last_error: Exception | None = None
-    for attempt in range(retries + 1):
-        connection = None
-        try:
-            connection = pymysql.connect(
-                host=config["db_host"],
-                port=config["db_port"],
-                user=config["db_user"],
-                password=config["db_password"],
-                database=config["db_name"],
-                charset=config["db_charset"],
-                cursorclass=pymysql.cursors.DictCursor,
-                connect_timeout=config["db_connect_timeout"],
-                read_timeout=config["db_read_timeout"],
-                write_timeout=config["db_write_timeout"],
-            )
-            connection.ping(reconnect=True)
-            with connection.cursor() as cursor:
-                cursor.execute(sql_text)
-                rows = cursor.fetchall()
-                return [normalize_row(row) for row in rows]
-        except Exception as error:
-            last_error = error
-            append_error_log(f"sql err: attempt={attempt + 1}/{retries + 1} error={error}")
-            if not is_retryable_mysql_error(error) or attempt >= retries:
-                raise
-            time.sleep(backoff * (2**attempt))
-        finally:
-            if connection is not None:
-                connection.close()
-    if last_error:
-        raise last_error
-    return []
+    config["his_stats_path"] = os.path.join(config["state_dir"], "his_load.json")
+    return config
 
 
 def parse_retry_statuses(raw_value: str) -> list[int]:
@@ -169,7 +135,7 @@ def post_rows(
     api_url: str,
     timeout: int,
     sync_file: str,
-    rows: list[dict[str, Any]],
+    rows: Iterable[dict[str, Any]],
     config: dict[str, Any],
 ) -> tuple[int, int]:
     success = 0
@@ -178,6 +144,7 @@ def post_rows(
     log_every = max(0, config["post_log_every"])
     session = build_session(config)
     processed = 0
+    total = f"/{len(rows)}" if isinstance(rows, Sized) else ""
 
     def build_body(row_data: dict[str, Any]) -> dict[str, Any]:
         return {
@@ -191,8 +158,8 @@ def post_rows(
         hoscode = str(row.get("hoscode", "")).strip()
         if not hoscode:
             failed += 1
-            append_error_log(f"post err: idx={index} missing hoscode")
-            log(f"[SKIP] missing hoscode in row idx={index}")
+            if append_error_log("post", "missing hoscode", source=sync_file, idx=index):
+                log(f"[SKIP] missing hoscode in row idx={index}")
             continue
 
         body = build_body(row)
@@ -202,55 +169,414 @@ def post_rows(
                 success += 1
             else:
                 failed += 1
-                append_error_log(
-                    f"post err: idx={index} hoscode={hoscode} "
-                    f"status={response.status_code} body={response.text}"
-                )
-                log(f"[FAIL] idx={index} hoscode={hoscode} status={response.status_code}")
+                if append_error_log(
+                    "post",
+                    f"HTTP {response.status_code}",
+                    source=sync_file,
+                    idx=index,
+                    hoscode=hoscode,
+                    status=response.status_code,
+                    body=response.text,
+                ):
+                    log(f"[FAIL] idx={index} hoscode={hoscode} status={response.status_code}")
         except requests.RequestException as error:
             failed += 1
-            append_error_log(f"post err: idx={index} hoscode={hoscode} error={error}")
-            log(f"[ERROR] idx={index} hoscode={hoscode} error={error}")
+            if append_error_log("post", error, source=sync_file, idx=index, hoscode=hoscode):
+                log(f"[ERROR] idx={index} hoscode={hoscode} error={error}")
         finally:
             processed += 1
             if log_every and processed % log_every == 0:
-                log(f"progress: {processed}/{len(rows)} posted")
+                log(f"progress: {processed}{total} posted")
             time.sleep(sleep_seconds)
 
     return success, failed
 
 
-def post_sync_custom(config: dict[str, Any], source: str, sql_text: str) -> None:
+# Quoted literals and comments are kept verbatim; only the whitespace
+# between them is collapsed, so queries differing inside a string never
+# share a cache entry.
+SQL_TOKEN = re.compile(
+    r"""'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*"|`[^`]*`|(?:--|#)[^\n]*\n?|/\*.*?\*/|\s+""",
+    re.DOTALL,
+)
+
+
+def normalize_sql(sql_text: str) -> str:
+    normalized = SQL_TOKEN.sub(lambda token: " " if token.group().isspace() else token.group(), sql_text)
+    return normalized.strip().rstrip(";").strip()
+
+
+class ResultCache:
+    """TTL + LRU cache of custom query results keyed by normalized SQL.
+
+    Entries expire ``ttl`` seconds after they were stored. The total size,
+    estimated from the rows' JSON length, is kept under ``max_bytes`` by
+    evicting the least recently used entries.
+    """
+
+    def __init__(self, ttl: float, max_bytes: int) -> None:
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = 0
+        self._entries: OrderedDict[str, tuple[float, int, list[dict[str, Any]]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sql_text: str) -> list[dict[str, Any]] | None:
+        key = normalize_sql(sql_text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, sql_text: str, rows: list[dict[str, Any]]) -> None:
+        size = len(json.dumps(rows, ensure_ascii=False, default=str))
+        if size > self.max_bytes:
+            return
+        key = normalize_sql(sql_text)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, size, rows)
+            self._size += size
+            while self._size > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key: str) -> None:
+        _, size, _ = self._entries.pop(key)
+        self._size -= size
+
+
+def post_sync_custom(
+    config: dict[str, Any],
+    source: str,
+    sql_text: str,
+    cache: ResultCache | None = None,
+    refresh: bool = False,
+) -> None:
     sql_label = source or "mqtt_custom"
 
     if not sql_text.strip():
         log(f"[MQTT] [{sql_label}] empty SQL text, skip")
         return
 
+    # Streamed results are never materialized, so they bypass the cache.
+    if config["db_stream"]:
+        # DB errors surface from inside post_rows once the stream is consumed.
+        log(f"[MQTT] [{sql_label}] streaming rows chunk={config['db_stream_chunk']}")
+        try:
+            success, failed = post_rows(
+                config["api_url"],
+                config["request_timeout"],
+                sql_label,
+                stream_rows(config, sql_text, sql_label),
+                config,
+            )
+        except Exception as error:
+            log(f"[MQTT] [{sql_label}] db error: {error}")
+            return
+        if success + failed == 0:
+            log(f"[MQTT] [{sql_label}] no data to sync")
+            return
+    else:
+        rows = cache.get(sql_text) if cache and not refresh else None
+        if rows is not None:
+            log(f"[MQTT] [{sql_label}] cache hit (hits={cache.hits} misses={cache.misses})")
+        else:
+            try:
+                rows = fetch_rows(config, sql_text, sql_label)
+            except Exception as error:
+                log(f"[MQTT] [{sql_label}] db error: {error}")
+                return
+            if cache:
+                cache.put(sql_text, rows)
+
+        if not rows:
+            log(f"[MQTT] [{sql_label}] no data to sync")
+            return
+
+        log(f"[MQTT] [{sql_label}] rows prepared: {len(rows)}")
+        success, failed = post_rows(
+            config["api_url"],
+            config["request_timeout"],
+            sql_label,
+            rows,
+            config,
+        )
+    status = "success" if failed == 0 else "fail"
+    log(f"[MQTT] [{sql_label}] {status} success={success} failed={failed}")
+
+
+class ReplyPublisher:
+    """Publishes a query result to the requester's reply topic.
+
+    Every message is one JSON object, gzip-compressed unless the request
+    asked for ``"encoding": "none"``: ``{"type": "rows", "seq": n, "rows": [...]}``
+    chunks, then one ``{"type": "end", ...}`` record with the row count and
+    timings, or ``{"type": "error", ...}``. Chunks start at
+    ``FIRST_CHUNK_ROWS`` rows and double up to ``chunk_rows``, so the first
+    rows leave as soon as the HIS sends them. At most ``MAX_IN_FLIGHT``
+    QoS 1 messages are left unacknowledged.
+    """
+
+    FIRST_CHUNK_ROWS = 16
+    MAX_IN_FLIGHT = 8
+
+    def __init__(
+        self,
+        client: mqtt.Client,
+        topic: str,
+        correlation_id: str,
+        encoding: str,
+        qos: int,
+        chunk_rows: int,
+    ) -> None:
+        self.client = client
+        self.topic = topic
+        self.correlation_id = correlation_id
+        self.encoding = encoding
+        self.qos = qos
+        self.chunk_rows = max(1, chunk_rows)
+        self.rows = 0
+        self.chunks = 0
+        self.bytes = 0
+        self._in_flight: deque[mqtt.MQTTMessageInfo] = deque()
+
+    def send_rows(self, rows: Iterable[dict[str, Any]]) -> float | None:
+        """Publish ``rows`` in chunks; returns when the first row was ready."""
+        first_row_at = None
+        limit = min(self.FIRST_CHUNK_ROWS, self.chunk_rows)
+        chunk: list[dict[str, Any]] = []
+        for row in rows:
+            if first_row_at is None:
+                first_row_at = time.monotonic()
+            chunk.append(row)
+            if len(chunk) >= limit:
+                self._publish({"type": "rows", "seq": self.chunks, "rows": chunk})
+                chunk = []
+                limit = min(limit * 2, self.chunk_rows)
+        if chunk:
+            self._publish({"type": "rows", "seq": self.chunks, "rows": chunk})
+        return first_row_at
+
+    def end(self, timings: dict[str, float]) -> None:
+        self._publish(
+            {"type": "end", "rows": self.rows, "chunks": self.chunks, "bytes": self.bytes, "timings": timings}
+        )
+        self._drain()
+
+    def error(self, message: str, drain: bool = True) -> None:
+        """Publish the error record; ``drain=False`` does not wait for PUBACKs.
+
+        Callers on paho's network thread must not drain: only that thread
+        can process the acknowledgement they would wait for.
+        """
+        self._publish({"type": "error", "rows": self.rows, "error": message})
+        if drain:
+            self._drain()
+
+    def _publish(self, message: dict[str, Any]) -> None:
+        message["correlation_id"] = self.correlation_id
+        if message["type"] == "rows":
+            self.rows += len(message["rows"])
+            self.chunks += 1
+        payload = json.dumps(message, ensure_ascii=False, default=str).encode("utf-8")
+        if self.encoding == "gzip":
+            payload = gzip.compress(payload, compresslevel=6)
+        self.bytes += len(payload)
+        info = self.client.publish(self.topic, payload, qos=self.qos)
+        if self.qos > 0:
+            self._in_flight.append(info)
+            if len(self._in_flight) > self.MAX_IN_FLIGHT:
+                self._in_flight.popleft().wait_for_publish(timeout=30)
+
+    def _drain(self) -> None:
+        while self._in_flight:
+            self._in_flight.popleft().wait_for_publish(timeout=30)
+
+
+def reply_sync_custom(
+    config: dict[str, Any],
+    publisher: ReplyPublisher,
+    source: str,
+    sql_text: str,
+    queued_at: float,
+    cache: ResultCache | None = None,
+    refresh: bool = False,
+) -> None:
+    """Run a custom query and publish its rows to the reply topic, not the API."""
+    sql_label = source or "mqtt_custom"
+    started = time.monotonic()
+    timings = {"queue_ms": round((started - queued_at) * 1000, 1)}
+
+    if not sql_text.strip():
+        publisher.error("empty SQL text")
+        return
+
+    rows: Iterable[dict[str, Any]] | None = cache.get(sql_text) if cache and not refresh else None
+    if rows is not None:
+        log(f"[MQTT] [{sql_label}] reply from cache (hits={cache.hits} misses={cache.misses})")
+    else:
+        # Streamed, so the first chunk is published while MySQL is still sending.
+        rows = stream_rows(config, sql_text, sql_label)
     try:
-        rows = fetch_rows(config, sql_text)
+        first_row_at = publisher.send_rows(rows)
     except Exception as error:
         log(f"[MQTT] [{sql_label}] db error: {error}")
+        publisher.error(str(error))
         return
+    finished = time.monotonic()
+    if first_row_at is not None:
+        timings["first_row_ms"] = round((first_row_at - started) * 1000, 1)
+    timings["total_ms"] = round((finished - started) * 1000, 1)
+    publisher.end(timings)
+    log(
+        f"[MQTT] [{sql_label}] replied rows={publisher.rows} chunks={publisher.chunks} "
+        f"bytes={publisher.bytes} to {publisher.topic} in {timings['total_ms']}ms"
+    )
 
-    if not rows:
-        log(f"[MQTT] [{sql_label}] no data to sync")
-        return
 
-    log(f"[MQTT] [{sql_label}] rows prepared: {len(rows)}")
-    success, failed = post_rows(
-        config["api_url"],
-        config["request_timeout"],
-        sql_label,
-        rows,
-        config,
-    )
-    status = "success" if failed == 0 else "fail"
-    log(f"[MQTT] [{sql_label}] {status} success={success} failed={failed}")
+class WorkQueue:
+    """Bounded queue of custom queries drained by a fixed pool of workers.
+
+    paho's ``on_message`` only calls ``submit``, so a slow query never blocks
+    keepalives. A message whose ``source`` + SQL + ``no_cache`` flag is already
+    queued or running is coalesced into that execution, so a ``no_cache``
+    request never receives rows read through the cache. When ``max_pending``
+    jobs are waiting, ``policy`` decides what to drop: ``drop_new`` rejects
+    the incoming message, ``drop_oldest`` evicts the oldest waiting one.
+    """
+
+    def __init__(
+        self,
+        config: dict[str, Any],
+        workers: int,
+        max_pending: int,
+        policy: str,
+        cache: ResultCache | None = None,
+        client: mqtt.Client | None = None,
+    ) -> None:
+        if policy not in {"drop_new", "drop_oldest"}:
+            raise ValueError(f"unsupported MQTT_QUEUE_POLICY: {policy}")
+        self.config = config
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        self.policy = policy
+        self.cache = cache
+        self.client = client
+        self._pending: deque[tuple[tuple[str, ...], str, str, bool, dict[str, Any] | None]] = deque()
+        self._active: set[tuple[str, ...]] = set()
+        self._cond = threading.Condition()
+
+    def start(self) -> None:
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"mqtt-worker-{number}", daemon=True)
+            thread.start()
+
+    def submit(
+        self,
+        source: str,
+        sql_text: str,
+        refresh: bool = False,
+        reply: dict[str, Any] | None = None,
+    ) -> bool:
+        key: tuple[str, ...] = (source, normalize_sql(sql_text), "refresh" if refresh else "")
+        if reply:
+            # Every requester waits for its own answer, so replies never coalesce.
+            key += (reply["topic"], reply["correlation_id"])
+            reply["queued_at"] = time.monotonic()
+        label = source or "mqtt_custom"
+        evicted = None
+        with self._cond:
+            if key in self._active:
+                log(f"[MQTT] [{label}] same query already queued or running, coalesced")
+                return False
+            full = len(self._pending) >= self.max_pending
+            accepted = not (full and self.policy == "drop_new")
+            if accepted:
+                if full:
+                    evicted = self._pending.popleft()
+                    self._active.discard(evicted[0])
+                self._active.add(key)
+                self._pending.append((key, source, sql_text, refresh, reply))
+                self._cond.notify()
+        # Rejections are published after the lock is released so workers
+        # are not held up by the broker.
+        if not accepted:
+            append_error_log("mqtt", "queue full, dropped", source=label)
+            log(f"[MQTT] [{label}] queue full ({self.max_pending}), dropped")
+            self._reject(reply, "queue full")
+        if evicted is not None:
+            _, old_source, _, _, old_reply = evicted
+            append_error_log("mqtt", "queue full, evicted", source=old_source or "mqtt_custom")
+            log(f"[MQTT] [{old_source or 'mqtt_custom'}] evicted from full queue")
+            self._reject(old_reply, "evicted from full queue")
+        return accepted
+
+    def _publisher(self, reply: dict[str, Any]) -> ReplyPublisher:
+        return ReplyPublisher(
+            self.client,
+            reply["topic"],
+            reply["correlation_id"],
+            reply["encoding"],
+            self.config["mqtt_reply_qos"],
+            self.config["mqtt_reply_chunk_rows"],
+        )
+
+    def _reject(self, reply: dict[str, Any] | None, reason: str) -> None:
+        # Called from on_message on paho's network thread, so no drain.
+        if reply and self.client is not None:
+            self._publisher(reply).error(reason, drain=False)
+
+    def _worker(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                key, source, sql_text, refresh, reply = self._pending.popleft()
+            try:
+                if reply and self.client is not None:
+                    reply_sync_custom(
+                        self.config,
+                        self._publisher(reply),
+                        source,
+                        sql_text,
+                        reply["queued_at"],
+                        self.cache,
+                        refresh,
+                    )
+                else:
+                    post_sync_custom(self.config, source, sql_text, self.cache, refresh)
+            except Exception as error:
+                append_error_log("mqtt", error, source=source)
+                log(f"[MQTT] [{source or 'mqtt_custom'}] error: {error}")
+            finally:
+                with self._cond:
+                    self._active.discard(key)
 
 
 def mqtt_listener(config: dict[str, Any]) -> None:
     topic = MQTT_TOPIC
+    client = mqtt.Client()
+    work_queue = WorkQueue(
+        config,
+        config["mqtt_workers"],
+        config["mqtt_queue_size"],
+        config["mqtt_queue_policy"],
+        ResultCache(config["mqtt_cache_ttl"], config["mqtt_cache_max_bytes"])
+        if config["mqtt_cache_ttl"] > 0
+        else None,
+        client,
+    )
+    work_queue.start()
 
     def on_connect(client: mqtt.Client, userdata: Any, flags: Any, rc: int) -> None:
         if rc == 0:
@@ -264,22 +590,33 @@ def mqtt_listener(config: dict[str, Any]) -> None:
         payload = msg.payload.decode(errors="replace")
         log(f"[MQTT] message received topic={msg.topic} payload={payload}")
 
-        # Expect MQTT payload as JSON: {"source": "...", "sql": "..."}
+        # Expect MQTT payload as JSON: {"source": "...", "sql": "...", "no_cache": false}
+        # plus "reply_to" and "correlation_id" to get the rows back over MQTT.
+        refresh = False
+        reply = None
         try:
             data = json.loads(payload)
             source = str(data.get("source", "")).strip()
             sql_text = str(data.get("sql", ""))
+            refresh = bool(data.get("no_cache", False))
+            reply_to = str(data.get("reply_to") or "").strip()
+            if reply_to:
+                encoding = str(data.get("encoding") or "gzip").strip().lower()
+                reply = {
+                    "topic": reply_to,
+                    "correlation_id": str(data.get("correlation_id") or ""),
+                    "encoding": "none" if encoding == "none" else "gzip",
+                }
         except Exception:
             # If not JSON, treat raw payload as SQL and use topic as source
             source = str(msg.topic)
             sql_text = payload
 
-        post_sync_custom(config, source, sql_text)
+        work_queue.submit(source, sql_text, refresh, reply)
 
     def on_disconnect(client: mqtt.Client, userdata: Any, rc: int) -> None:
         log(f"[MQTT] disconnected rc={rc}")
 
-    client = mqtt.Client()
     username = config["mqtt_broker_username"].strip()
     password = config["mqtt_broker_password"].strip()
     if username:
@@ -1,40 +1,114 @@
 import argparse
+import atexit
+import base64
+import contextlib
+import fcntl
+import fnmatch
+import gzip
+import hashlib
 import json
 import os
 import re
+import sqlite3
 import sys
+import threading
 import time
-from datetime import date, datetime, timezone
+from collections.abc import Callable, Iterable, Iterator, Sized
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta, timezone
 from decimal import Decimal
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from typing import Any
 
 import pymysql
 import requests
+from pymysql.constants import FIELD_TYPE
 from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 from urllib3.util.retry import Retry
 
+try:
+    import orjson
+except ImportError:  # optional, stdlib json is used instead
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:  # optional, only needed for POST_WIRE_ENCODING=zstd
+    zstandard = None
+
 ERROR_LOG_PATH = os.path.join("logs", "err_message.log")
+SCRIPT_INDEX_CACHE_NAME = "_index"
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SCHEDULE_PATH = os.path.join(APP_DIR, "cron.d", "sync-client")
+
+
+# Per-thread log prefix, e.g. the HIS target a worker thread syncs.
+_LOG_CONTEXT = threading.local()
 
 
 def log(msg: str) -> None:
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{ts}] {msg}")
+    tag = getattr(_LOG_CONTEXT, "tag", "")
+    # One write per line keeps lines from concurrent jobs from interleaving.
+    sys.stdout.write(f"[{ts}] {tag}{msg}\n")
+    sys.stdout.flush()
 
 
 def load_config() -> dict[str, Any]:
     load_dotenv()
-    return {
+    config: dict[str, Any] = {
         "api_url": os.getenv("API_URL", "http://localhost:8000/raw"),
         "api_batch_url": os.getenv("API_BATCH_URL", ""),
         "sync_scripts_url": os.getenv("SYNC_SCRIPTS_URL", "").strip(),
         "request_timeout": int(os.getenv("REQUEST_TIMEOUT", "15")),
+        # Relative to the app, not the working directory: cron runs from
+        # /root while the daemon and MQTT run from /app, and all of them
+        # must share slots, watermarks and the outbox.
+        "state_dir": os.path.join(APP_DIR, os.getenv("SYNC_STATE_DIR", "state")),
+        "script_cache": os.getenv("SCRIPT_CACHE", "1").strip().lower() in {"1", "true", "yes"},
+        "script_cache_timeout": int(os.getenv("SCRIPT_CACHE_TIMEOUT", "5")),
+        "script_cache_max_age": int(os.getenv("SCRIPT_CACHE_MAX_AGE", "0")),
+        "row_fingerprint": os.getenv("ROW_FINGERPRINT", "0").strip().lower() in {"1", "true", "yes"},
+        "row_fingerprint_ttl_hours": float(os.getenv("ROW_FINGERPRINT_TTL_HOURS", "24")),
+        "metrics_textfile": os.getenv("METRICS_TEXTFILE", "").strip(),
+        "metrics_port": int(os.getenv("METRICS_PORT", "0")),
+        "outbox": os.getenv("OUTBOX", "1").strip().lower() in {"1", "true", "yes"},
+        "outbox_segment_bytes": int(os.getenv("OUTBOX_SEGMENT_BYTES", str(4 * 1024 * 1024))),
+        "outbox_max_bytes": int(os.getenv("OUTBOX_MAX_BYTES", str(256 * 1024 * 1024))),
+        "outbox_fsync_every": int(os.getenv("OUTBOX_FSYNC_EVERY", "50")),
+        "outbox_replay_concurrency": int(os.getenv("OUTBOX_REPLAY_CONCURRENCY", "2")),
+        "outbox_replay_interval": int(os.getenv("OUTBOX_REPLAY_INTERVAL", "60")),
+        "outbox_max_attempts": int(os.getenv("OUTBOX_MAX_ATTEMPTS", "20")),
         "post_sleep_ms": int(os.getenv("POST_SLEEP_MS", "300")),
         "post_log_every": int(os.getenv("POST_LOG_EVERY", "100")),
         "post_retry_total": int(os.getenv("POST_RETRY_TOTAL", "3")),
         "post_retry_backoff": float(os.getenv("POST_RETRY_BACKOFF", "0.5")),
         "post_retry_statuses": os.getenv("POST_RETRY_STATUSES", "429,500,502,503,504"),
         "post_batch_size": int(os.getenv("POST_BATCH_SIZE", "1")),
+        "post_concurrency": int(os.getenv("POST_CONCURRENCY", "1")),
+        "post_batch_bisect": os.getenv("POST_BATCH_BISECT", "0").strip().lower() in {"1", "true", "yes"},
+        "post_batch_bisect_depth": int(os.getenv("POST_BATCH_BISECT_DEPTH", "10")),
+        "post_batch_bisect_min_rows": int(os.getenv("POST_BATCH_BISECT_MIN_ROWS", "1")),
+        "post_batch_format": os.getenv("POST_BATCH_FORMAT", "rows").strip().lower(),
+        "post_batch_adaptive": os.getenv("POST_BATCH_ADAPTIVE", "0").strip().lower()
+        in {"1", "true", "yes"},
+        "post_batch_min_rows": int(os.getenv("POST_BATCH_MIN_ROWS", "10")),
+        "post_batch_max_rows": int(os.getenv("POST_BATCH_MAX_ROWS", "5000")),
+        "post_batch_max_bytes": int(os.getenv("POST_BATCH_MAX_BYTES", str(1024 * 1024))),
+        "post_batch_target_ms": int(os.getenv("POST_BATCH_TARGET_MS", "1000")),
+        "post_wire_encoding": os.getenv("POST_WIRE_ENCODING", "").strip().lower(),
+        "post_wire_level": int(os.getenv("POST_WIRE_LEVEL", "0")),
+        "post_wire_min_bytes": int(os.getenv("POST_WIRE_MIN_BYTES", "1024")),
+        "post_rate": float(os.getenv("POST_RATE", "0")),
+        "post_rate_min": float(os.getenv("POST_RATE_MIN", "0.2")),
+        "post_rate_max": float(os.getenv("POST_RATE_MAX", "50")),
+        "post_rate_step": float(os.getenv("POST_RATE_STEP", "0.2")),
+        "post_rate_backoff": float(os.getenv("POST_RATE_BACKOFF", "0.5")),
+        "post_rate_slow_ms": int(os.getenv("POST_RATE_SLOW_MS", "2000")),
+        "post_rate_adaptive": os.getenv("POST_RATE_ADAPTIVE", "1").strip().lower()
+        in {"1", "true", "yes"},
         "db_host": os.getenv("HIS_DB_HOST", "127.0.0.1"),
         "db_port": int(os.getenv("HIS_DB_PORT", "3306")),
         "db_user": os.getenv("HIS_DB_USER", "root"),
@@ -46,31 +120,546 @@ def load_config() -> dict[str, Any]:
         "db_write_timeout": int(os.getenv("HIS_DB_WRITE_TIMEOUT", "60")),
         "db_retry_total": int(os.getenv("HIS_DB_RETRY_TOTAL", "2")),
         "db_retry_backoff": float(os.getenv("HIS_DB_RETRY_BACKOFF", "0.5")),
+        "db_pool_size": int(os.getenv("HIS_DB_POOL_SIZE", "4")),
+        "db_pool_idle_timeout": int(os.getenv("HIS_DB_POOL_IDLE_TIMEOUT", "300")),
+        "db_pool_wait_timeout": int(os.getenv("HIS_DB_POOL_WAIT_TIMEOUT", "60")),
+        "hoscode": os.getenv("HIS_HOSCODE", "").strip(),
+        "his_targets_file": os.getenv("HIS_TARGETS_FILE", "").strip(),
+        "his_targets_concurrency": int(os.getenv("HIS_TARGETS_CONCURRENCY", "4")),
+        "his_target_workers": int(os.getenv("HIS_TARGET_WORKERS", "2")),
+        "his_max_execution_ms": int(os.getenv("HIS_MAX_EXECUTION_MS", "0")),
+        "his_max_execution_overrides": os.getenv("HIS_MAX_EXECUTION_OVERRIDES", ""),
+        "his_max_queries": int(os.getenv("HIS_MAX_CONCURRENT_QUERIES", "4")),
+        "his_heavy_seconds": float(os.getenv("HIS_HEAVY_QUERY_SECONDS", "60")),
+        "his_heavy_wait_seconds": float(os.getenv("HIS_HEAVY_WAIT_SECONDS", "0")),
+        "his_track_examined": os.getenv("HIS_TRACK_EXAMINED", "1").strip().lower()
+        in {"1", "true", "yes"},
+        "shard_concurrency": int(os.getenv("HIS_SHARD_CONCURRENCY", "4")),
+        "shard_retries": int(os.getenv("HIS_SHARD_RETRIES", "2")),
+        "shard_page_rows": int(os.getenv("HIS_SHARD_PAGE_ROWS", "10000")),
+        "daemon_workers": int(os.getenv("SYNC_DAEMON_WORKERS", "4")),
+        "all_db_concurrency": int(os.getenv("SYNC_ALL_DB_CONCURRENCY", "2")),
+        "all_http_concurrency": int(os.getenv("SYNC_ALL_HTTP_CONCURRENCY", "4")),
+        "daemon_schedule": os.getenv("SYNC_DAEMON_SCHEDULE", DEFAULT_SCHEDULE_PATH),
+        "db_stream": os.getenv("HIS_DB_STREAM", "0").strip().lower() in {"1", "true", "yes"},
+        "db_stream_chunk": int(os.getenv("HIS_DB_STREAM_CHUNK", "1000")),
+        "db_stream_net_write_timeout": int(os.getenv("HIS_DB_STREAM_NET_WRITE_TIMEOUT", "600")),
     }
+    config["script_cache_dir"] = os.path.join(config["state_dir"], "scripts")
+    config["watermark_path"] = os.path.join(config["state_dir"], "watermarks.json")
+    config["fingerprint_path"] = os.path.join(config["state_dir"], "fingerprints.sqlite3")
+    config["outbox_dir"] = os.path.join(config["state_dir"], "outbox")
+    config["metrics_state_path"] = os.path.join(config["state_dir"], "metrics_last_run.json")
+    config["his_stats_path"] = os.path.join(config["state_dir"], "his_load.json")
+    config["batch_sizes_path"] = os.path.join(config["state_dir"], "batch_sizes.json")
+    return config
 
 
-def normalize_value(value: Any) -> Any:
-    if isinstance(value, Decimal):
-        return float(value)
-    if isinstance(value, (datetime, date)):
-        return value.isoformat()
-    return value
+def decimal_to_float(value: Decimal | None) -> float | None:
+    return None if value is None else float(value)
+
+
+def temporal_to_text(value: date | datetime | str | None) -> str | None:
+    # pymysql hands out invalid dates such as '0000-00-00' as plain strings.
+    if value is None or isinstance(value, str):
+        return value
+    return value.isoformat()
+
+
+def time_to_text(value: timedelta | str | None) -> str | None:
+    # MySQL TIME arrives as timedelta and may be negative or exceed 24 hours.
+    if value is None or isinstance(value, str):
+        return value
+    sign = "-" if value < timedelta(0) else ""
+    value = abs(value)
+    hours, rest = divmod(value.days * 86400 + value.seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    text = f"{sign}{hours:02d}:{minutes:02d}:{seconds:02d}"
+    return f"{text}.{value.microseconds:06d}" if value.microseconds else text
+
+
+def bits_to_int(value: bytes | None) -> int | None:
+    return None if value is None else int.from_bytes(value, "big")
+
+
+def bytes_to_text(value: bytes | str | None) -> str | None:
+    # Binary columns that hold text are sent as text; real binary as base64.
+    if not isinstance(value, bytes):
+        return value
+    try:
+        return value.decode("utf-8")
+    except UnicodeDecodeError:
+        return base64.b64encode(value).decode("ascii")
+
 
+def set_to_text(value: set[str] | str | None) -> str | None:
+    if not isinstance(value, (set, frozenset)):
+        return value
+    return ",".join(sorted(value))
 
-def normalize_row(row: dict[str, Any]) -> dict[str, Any]:
-    return {key: normalize_value(value) for key, value in row.items()}
+
+# Column converters chosen from the MySQL field type in cursor.description.
+FIELD_CONVERTERS: dict[int, Callable[[Any], Any]] = {
+    FIELD_TYPE.DECIMAL: decimal_to_float,
+    FIELD_TYPE.NEWDECIMAL: decimal_to_float,
+    FIELD_TYPE.DATE: temporal_to_text,
+    FIELD_TYPE.NEWDATE: temporal_to_text,
+    FIELD_TYPE.DATETIME: temporal_to_text,
+    FIELD_TYPE.TIMESTAMP: temporal_to_text,
+    FIELD_TYPE.TIME: time_to_text,
+    FIELD_TYPE.BIT: bits_to_int,
+}
+# Text and binary share these field types; str, bytes or set is only known
+# from the values, so the first non-NULL value of the column decides.
+PROBED_FIELD_TYPES = {
+    FIELD_TYPE.VARCHAR,
+    FIELD_TYPE.VAR_STRING,
+    FIELD_TYPE.STRING,
+    FIELD_TYPE.TINY_BLOB,
+    FIELD_TYPE.MEDIUM_BLOB,
+    FIELD_TYPE.LONG_BLOB,
+    FIELD_TYPE.BLOB,
+    FIELD_TYPE.ENUM,
+    FIELD_TYPE.SET,
+    FIELD_TYPE.GEOMETRY,
+    FIELD_TYPE.JSON,
+}
+
+
+class RowConverter:
+    """Turns tuple rows into JSON-ready dicts with a per-column plan.
+
+    The plan is built once per query from ``cursor.description``: numeric and
+    plain text columns pass through untouched, the others get one converter
+    that runs over the whole column of a batch. Duplicate column names get
+    the table prefix, like pymysql's ``DictCursor``.
+    """
+
+    def __init__(self, names: list[str], type_codes: list[int]) -> None:
+        self.names = names
+        self.converters: list[Callable[[Any], Any] | None] = [
+            FIELD_CONVERTERS.get(type_code) for type_code in type_codes
+        ]
+        self._probe = {
+            index for index, type_code in enumerate(type_codes) if type_code in PROBED_FIELD_TYPES
+        }
+
+    @classmethod
+    def from_cursor(cls, cursor: pymysql.cursors.Cursor) -> "RowConverter":
+        fields = getattr(getattr(cursor, "_result", None), "fields", None)
+        names: list[str] = []
+        for index, column in enumerate(cursor.description or ()):
+            name = column[0]
+            if name in names and fields:
+                name = f"{fields[index].table_name}.{name}"
+            names.append(name)
+        return cls(names, [column[1] for column in cursor.description or ()])
+
+    def convert(self, rows: Iterable[tuple[Any, ...]]) -> list[dict[str, Any]]:
+        columns = list(zip(*rows))
+        if not columns:
+            return []
+        if self._probe:
+            self._resolve(columns)
+        for index, converter in enumerate(self.converters):
+            if converter is not None:
+                columns[index] = tuple(map(converter, columns[index]))
+        names = self.names
+        return [dict(zip(names, values)) for values in zip(*columns)]
+
+    def _resolve(self, columns: list[tuple[Any, ...]]) -> None:
+        for index in list(self._probe):
+            sample = next((value for value in columns[index] if value is not None), None)
+            if sample is None:
+                continue
+            self._probe.discard(index)
+            if isinstance(sample, bytes):
+                self.converters[index] = bytes_to_text
+            elif isinstance(sample, (set, frozenset)):
+                self.converters[index] = set_to_text
 
 
 def fetch_scripts_index(config: dict[str, Any], sync_scripts_url: str) -> dict[str, Any]:
     base = sync_scripts_url.rstrip("/")
+
+    def parse(response: requests.Response) -> dict[str, Any]:
+        payload = response.json()
+        if not isinstance(payload, dict):
+            raise ValueError("sync scripts index must be a JSON object")
+        return {"scripts": payload}
+
+    entry = cached_get(config, base, SCRIPT_INDEX_CACHE_NAME, parse)
+    return entry["scripts"] if entry else {}
+
+
+def script_cache_path(config: dict[str, Any], cache_name: str) -> str:
+    safe_name = re.sub(r"[^\w.-]", "_", cache_name)
+    return os.path.join(config["script_cache_dir"], f"{safe_name}.json")
+
+
+def read_json_file(path: str) -> dict[str, Any] | None:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return entry if isinstance(entry, dict) else None
+
+
+def write_json_file(path: str, entry: dict[str, Any]) -> None:
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError as error:
+        log(f"[cache] cannot write {path}: {error}")
+
+
+def cached_get(
+    config: dict[str, Any],
+    url: str,
+    cache_name: str,
+    parse: Callable[[requests.Response], dict[str, Any]],
+    allow_missing: bool = False,
+) -> dict[str, Any] | None:
+    """GET ``url`` through the on-disk script catalog.
+
+    The cached entry is revalidated with If-None-Match/If-Modified-Since, so
+    an unchanged script or index costs one 304. When the server is slow
+    (``script_cache_timeout``), unreachable or answering 5xx, the cached copy
+    is used instead. Entries younger than ``script_cache_max_age`` seconds are
+    returned without asking the server at all. A 404 returns None when ``allow_missing`` is set and
+    drops the cached copy.
+    """
+    path = script_cache_path(config, cache_name)
+    cached = read_json_file(path) if config["script_cache"] else None
+    if cached and time.time() - cached.get("fetched_ts", 0) < config["script_cache_max_age"]:
+        return cached
+    headers: dict[str, str] = {}
     timeout = int(config["request_timeout"])
-    session = build_session(config)
-    response = session.get(base, timeout=timeout)
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+        timeout = min(timeout, config["script_cache_timeout"])
+
+    try:
+        response = get_session(config).get(url, headers=headers, timeout=timeout)
+    except requests.RequestException as error:
+        if cached is None:
+            raise
+        log(f"[cache] [{cache_name}] server unreachable, using cached copy: {error}")
+        return cached
+
+    if response.status_code == 304 and cached:
+        cached["fetched_ts"] = time.time()
+        write_json_file(path, cached)
+        return cached
+    if response.status_code == 404 and allow_missing:
+        if cached is not None:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+        return None
+    if response.status_code >= 500 and cached:
+        log(f"[cache] [{cache_name}] server status={response.status_code}, using cached copy")
+        return cached
+
     response.raise_for_status()
-    payload = response.json()
-    if not isinstance(payload, dict):
-        raise ValueError("sync scripts index must be a JSON object")
-    return payload
+    entry = parse(response)
+    if config["script_cache"]:
+        entry["etag"] = response.headers.get("ETag", "")
+        entry["last_modified"] = response.headers.get("Last-Modified", "")
+        entry["fetched_ts"] = time.time()
+        write_json_file(path, entry)
+    return entry
+
+
+WATERMARK_DIRECTIVE = re.compile(
+    r"^[ \t]*--[ \t]*@watermark[ \t]*:?[ \t]*(?P<column>\w+)(?:[ \t]+(?P<initial>[^\r\n]+?))?[ \t\r]*$",
+    re.MULTILINE,
+)
+WATERMARK_PLACEHOLDER = "{{watermark}}"
+DEFAULT_WATERMARK_INITIAL = "1970-01-01 00:00:00"
+_WATERMARK_LOCK = threading.Lock()
+
+
+class Watermark:
+    """Highest value of the script's watermark column seen in this run.
+
+    A script opts in with a ``-- @watermark <column> [initial]`` comment. The
+    highest value is only written to the state store by ``commit`` after a
+    run with zero failed rows.
+    """
+
+    def __init__(self, script: str, column: str, last: Any) -> None:
+        self.script = script
+        self.column = column
+        self.last = last
+        self.highest: Any = None
+
+    def observe(self, row: dict[str, Any]) -> None:
+        value = row.get(self.column)
+        if value is None:
+            return
+        try:
+            if self.highest is None or value > self.highest:
+                self.highest = value
+        except TypeError:
+            # Mixed types in one column; keep the first comparable value.
+            pass
+
+    def track(self, rows: Iterable[dict[str, Any]]) -> Iterator[dict[str, Any]]:
+        for row in rows:
+            self.observe(row)
+            yield row
+
+    def commit(self, config: dict[str, Any]) -> None:
+        if self.highest is None or self.highest == self.last:
+            return
+        path = config["watermark_path"]
+        with _WATERMARK_LOCK:
+            state = read_json_file(path) or {}
+            state[self.script] = self.highest
+            write_json_file(path, state)
+        log(f"[{self.script}] watermark {self.column} -> {self.highest}")
+
+
+def bind_watermark(
+    config: dict[str, Any],
+    script: str,
+    sql_text: str,
+    full: bool = False,
+) -> tuple[str, Watermark | None]:
+    """Restrict ``sql_text`` to rows newer than the stored watermark.
+
+    Scripts that use the ``{{watermark}}`` placeholder get the last value
+    substituted in place, so the filter reaches the HIS index. Other scripts
+    are wrapped as ``SELECT * FROM (...) WHERE <column> > <last>``. Without a
+    stored value (or with ``full``) the placeholder gets the directive's
+    initial value and an unplaceheld script runs unchanged.
+    """
+    match = WATERMARK_DIRECTIVE.search(sql_text)
+    if not match:
+        return sql_text, None
+
+    column = match.group("column")
+    state = {} if full else read_json_file(config["watermark_path"]) or {}
+    last = state.get(script)
+    watermark = Watermark(script, column, last)
+
+    if WATERMARK_PLACEHOLDER in sql_text:
+        initial = (match.group("initial") or DEFAULT_WATERMARK_INITIAL).strip("'\"")
+        value = last if last is not None else initial
+        bound = sql_text.replace(WATERMARK_PLACEHOLDER, pymysql.converters.escape_item(value, "utf8mb4"))
+    elif last is not None:
+        body = sql_text.strip().rstrip(";")
+        literal = pymysql.converters.escape_item(last, "utf8mb4")
+        bound = f"SELECT * FROM (\n{body}\n) AS wm WHERE wm.`{column}` > {literal}"
+    else:
+        bound = sql_text
+
+    log(f"[{script}] incremental {column} > {last if last is not None else '(full)'}")
+    return bound, watermark
+
+
+SHARD_DIRECTIVE = re.compile(
+    r"^[ \t]*--[ \t]*@shard[ \t]*:?[ \t]*(?P<column>[\w.]+)[ \t]+(?P<low>\S+)[ \t]+(?P<high>\S+)"
+    r"[ \t]+(?P<count>\d+)[ \t\r]*$",
+    re.MULTILINE,
+)
+SHARD_PLACEHOLDER = "{{shard}}"
+
+
+class ShardPlan:
+    """Ranges of one column that split a heavy script into sub-queries.
+
+    A script opts in with ``-- @shard <column> <low> <high> <shards>``, where
+    the bounds are integers (e.g. a primary key) or dates (``today`` is
+    allowed as high bound). Both bounds are inclusive and the last range is
+    left open upwards so rows added after the script was written are not
+    lost. The script must put a ``{{shard}}`` placeholder where the range
+    condition belongs (e.g. in the WHERE of the scanned table): filtering
+    outside a GROUP BY would make every shard scan the whole table, so a
+    directive without the placeholder is ignored and the script runs as is.
+    """
+
+    def __init__(self, column: str, ranges: list[tuple[Any, Any]], keyset: bool) -> None:
+        self.column = column
+        self.name = column.rsplit(".", 1)[-1]
+        self.ranges = ranges
+        self.keyset = keyset
+
+    @classmethod
+    def from_sql(cls, sql_text: str, source: str = "") -> "ShardPlan | None":
+        match = SHARD_DIRECTIVE.search(sql_text)
+        if not match:
+            return None
+        if SHARD_PLACEHOLDER not in sql_text:
+            log(f"[{source}] @shard {match.group('column')} ignored: script has no {SHARD_PLACEHOLDER} placeholder")
+            return None
+        low, high = match.group("low"), match.group("high")
+        count = max(1, int(match.group("count")))
+        if re.fullmatch(r"-?\d+", low) and re.fullmatch(r"-?\d+", high):
+            first, last = int(low), int(high)
+            step = max(1, -(-(last - first + 1) // count))
+            starts = list(range(first, last + 1, step))
+            return cls(match.group("column"), cls._ranges(starts), keyset=True)
+        first_day = date.fromisoformat(low)
+        last_day = date.today() if high == "today" else date.fromisoformat(high)
+        days = (last_day - first_day).days + 1
+        step = max(1, -(-days // count))
+        starts = [first_day + timedelta(days=offset) for offset in range(0, days, step)]
+        # Dates are not unique, so date shards cannot be paged by key.
+        return cls(match.group("column"), cls._ranges(starts), keyset=False)
+
+    @staticmethod
+    def _ranges(starts: list[Any]) -> list[tuple[Any, Any]]:
+        return [(start, starts[index + 1] if index + 1 < len(starts) else None) for index, start in enumerate(starts)]
+
+    def bind(self, sql_text: str, low: Any, high: Any, after: Any = None, limit: int = 0) -> str:
+        """SQL for one range, optionally one keyset page of it."""
+        def escape(value: Any) -> str:
+            return pymysql.converters.escape_item(value, "utf8mb4")
+
+        conditions = [f"{self.column} >= {escape(low)}"]
+        if high is not None:
+            conditions.append(f"{self.column} < {escape(high)}")
+        if after is not None:
+            conditions.append(f"{self.column} > {escape(after)}")
+        bound = sql_text.replace(SHARD_PLACEHOLDER, "(" + " AND ".join(conditions) + ")")
+        if not limit:
+            return bound
+        body = bound.strip().rstrip(";")
+        return f"SELECT * FROM (\n{body}\n) AS sh ORDER BY sh.`{self.name}` LIMIT {int(limit)}"
+
+
+def sharded_rows(
+    config: dict[str, Any],
+    plan: ShardPlan,
+    sql_text: str,
+    source: str,
+) -> Iterator[dict[str, Any]]:
+    """Yield the rows of every shard, fetched in parallel when the HIS has room.
+
+    Shards run on up to ``shard_concurrency`` pooled connections, limited to
+    the governor's free query slots, and are yielded as they complete. With
+    fewer than two free slots the shards run one after another, integer
+    shards in keyset pages of ``shard_page_rows``. Each shard (or page) is
+    retried on its own. A heavy script takes the heavy slot once for all of
+    its shards, so they do not queue behind each other.
+    """
+    governor = get_his_governor(config)
+    with governor.heavy_slot(source):
+        yield from _sharded_rows(config, plan, sql_text, source, governor.free_slots())
+
+
+def _sharded_rows(
+    config: dict[str, Any],
+    plan: ShardPlan,
+    sql_text: str,
+    source: str,
+    free: int,
+) -> Iterator[dict[str, Any]]:
+    width = min(max(1, config["shard_concurrency"]), len(plan.ranges), free)
+    if width <= 1:
+        log(f"[{source}] HIS busy, running {len(plan.ranges)} shards of {plan.column} serially")
+        for low, high in plan.ranges:
+            yield from shard_pages(config, plan, sql_text, source, low, high)
+        return
+
+    log(f"[{source}] running {len(plan.ranges)} shards of {plan.column} on {width} connections")
+    metrics = current_metrics()
+
+    def run_shard(low: Any, high: Any) -> list[dict[str, Any]]:
+        with use_metrics(metrics):
+            return fetch_shard(config, plan.bind(sql_text, low, high), source, f"{low}..{high or ''}")
+
+    executor = ThreadPoolExecutor(max_workers=width, thread_name_prefix="shard")
+    try:
+        futures = [executor.submit(run_shard, low, high) for low, high in plan.ranges]
+        for future in as_completed(futures):
+            yield from future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def shard_pages(
+    config: dict[str, Any],
+    plan: ShardPlan,
+    sql_text: str,
+    source: str,
+    low: Any,
+    high: Any,
+) -> Iterator[dict[str, Any]]:
+    """Yield one shard, in keyset pages of ``shard_page_rows`` for integer columns.
+
+    Each page asks for one row more than it keeps. When that extra row has
+    the same key as the last kept row the column is not unique in the
+    result (e.g. after a join) and the next page (``> key``) would skip the
+    rest of that key, so the remainder of the shard is read in one query.
+    """
+    page_rows = max(0, config["shard_page_rows"])
+    label = f"{low}..{high or ''}"
+    if not plan.keyset or not page_rows:
+        yield from fetch_shard(config, plan.bind(sql_text, low, high), source, label)
+        return
+    after = None
+    while True:
+        rows = fetch_shard(config, plan.bind(sql_text, low, high, after, page_rows + 1), source, label)
+        if len(rows) <= page_rows:
+            yield from rows
+            return
+        if plan.name not in rows[-1]:
+            raise ValueError(f"shard column {plan.name} must be selected for keyset paging")
+        if rows[-1][plan.name] == rows[-2][plan.name]:
+            log(f"[{source}] shard {label}: {plan.name} is not unique, reading the rest unpaged")
+            yield from fetch_shard(config, plan.bind(sql_text, low, high, after), source, label)
+            return
+        rows.pop()
+        yield from rows
+        after = rows[-1][plan.name]
+
+
+def fetch_shard(config: dict[str, Any], sql_text: str, source: str, label: str) -> list[dict[str, Any]]:
+    retries = max(0, config["shard_retries"])
+    for attempt in range(retries + 1):
+        try:
+            # sharded_rows already holds the heavy slot for the whole run.
+            return fetch_rows(config, sql_text, source, heavy=False)
+        except Exception as error:
+            # Server-reported errors (bad SQL, execution limit) fail the same
+            # way again; anything else gets another try for this shard only.
+            if is_server_error(error) or attempt >= retries:
+                raise
+            log(f"[{source}] shard {label} failed ({error}), retry {attempt + 1}/{retries}")
+            time.sleep(config["db_retry_backoff"] * (2**attempt))
+    return []
+
+
+class RunGates:
+    """Separate caps on scripts querying the HIS and scripts posting rows.
+
+    ``--all`` runs many scripts at once; a script holds a DB slot while it
+    fetches and an HTTP slot while it posts, so one script can post while
+    the next is already querying. Streamed runs hold both slots throughout
+    and always take the DB slot first. A limit of 0 means no cap.
+    """
+
+    def __init__(self, db_limit: int, http_limit: int) -> None:
+        self._db = threading.BoundedSemaphore(db_limit) if db_limit > 0 else None
+        self._http = threading.BoundedSemaphore(http_limit) if http_limit > 0 else None
+
+    def db(self) -> contextlib.AbstractContextManager:
+        return self._db or contextlib.nullcontext()
+
+    def http(self) -> contextlib.AbstractContextManager:
+        return self._http or contextlib.nullcontext()
+
+
+NO_GATES = RunGates(0, 0)
 
 
 def run_single_sync(
@@ -78,8 +667,20 @@ def run_single_sync(
     effective_file: str,
     sql_text: str,
     dry_run: bool,
+    watermark: Watermark | None = None,
+    full: bool = False,
+    gates: "RunGates | None" = None,
 ) -> int:
-    rows = fetch_rows(config, sql_text)
+    gates = gates or NO_GATES
+    plan = ShardPlan.from_sql(sql_text, effective_file)
+    if plan:
+        rows = sharded_rows(config, plan, sql_text, effective_file)
+        return run_stream_sync(config, effective_file, sql_text, dry_run, watermark, full, gates, rows)
+    if config["db_stream"]:
+        return run_stream_sync(config, effective_file, sql_text, dry_run, watermark, full, gates)
+
+    with gates.db():
+        rows = fetch_rows(config, sql_text, effective_file)
 
     if not rows:
         log(f"[{effective_file}] no data to sync")
@@ -91,15 +692,76 @@ def run_single_sync(
         print(json.dumps(rows[0], ensure_ascii=False, indent=2))
         return 0
 
-    success, failed = post_rows(
-        config["api_url"],
-        config["request_timeout"],
-        effective_file,
-        rows,
-        config,
-    )
+    if watermark:
+        for row in rows:
+            watermark.observe(row)
+
+    metrics = current_metrics()
+    metrics.add("rows_fetched", len(rows))
+    with gates.http(), metrics.phase("post"):
+        success, failed = post_rows(
+            config["api_url"],
+            config["request_timeout"],
+            effective_file,
+            rows,
+            config,
+            FingerprintStore.for_script(config, effective_file, sql_text, full),
+        )
+    metrics.add("rows_success", success)
+    metrics.add("rows_failed", failed)
+    status = "success" if failed == 0 else "fail"
+    log(f"[{effective_file}] {status} success={success} failed={failed}")
+    if watermark and failed == 0:
+        watermark.commit(config)
+    return 0 if failed == 0 else 1
+
+
+def run_stream_sync(
+    config: dict[str, Any],
+    effective_file: str,
+    sql_text: str,
+    dry_run: bool,
+    watermark: Watermark | None = None,
+    full: bool = False,
+    gates: "RunGates | None" = None,
+    rows: Iterator[dict[str, Any]] | None = None,
+) -> int:
+    gates = gates or NO_GATES
+    if rows is None:
+        rows = stream_rows(config, sql_text, effective_file)
+        log(f"[{effective_file}] streaming rows chunk={config['db_stream_chunk']}")
+
+    if dry_run:
+        with gates.db():
+            first = next(rows, None)
+            rows.close()
+        if first is None:
+            log(f"[{effective_file}] no data to sync")
+            return 0
+        print(json.dumps(first, ensure_ascii=False, indent=2))
+        return 0
+
+    metrics = current_metrics()
+    # Streaming interleaves DB reads with POSTs; "post" covers both here and
+    # the run holds a DB and an HTTP slot for its whole length.
+    with gates.db(), gates.http(), metrics.phase("post"):
+        success, failed = post_rows(
+            config["api_url"],
+            config["request_timeout"],
+            effective_file,
+            watermark.track(rows) if watermark else rows,
+            config,
+            FingerprintStore.for_script(config, effective_file, sql_text, full),
+        )
+    metrics.add("rows_success", success)
+    metrics.add("rows_failed", failed)
+    if success + failed == 0:
+        log(f"[{effective_file}] no data to sync")
+        return 0
     status = "success" if failed == 0 else "fail"
     log(f"[{effective_file}] {status} success={success} failed={failed}")
+    if watermark and failed == 0:
+        watermark.commit(config)
     return 0 if failed == 0 else 1
 
 
@@ -123,10 +785,14 @@ def fetch_sql_from_endpoint(
 
     base = sync_scripts_url.rstrip("/")
     url = f"{base}/{name}"
-    timeout = int(config["request_timeout"])
-    session = build_session(config)
-    response = session.get(url, timeout=timeout)
-    if response.status_code == 404:
+    entry = cached_get(
+        config,
+        url,
+        name,
+        lambda response: parse_script_response(response, url),
+        allow_missing=True,
+    )
+    if entry is None:
         payload = fetch_scripts_index(config, sync_scripts_url)
         if name not in payload:
             return name, "", False
@@ -135,7 +801,10 @@ def fetch_sql_from_endpoint(
         is_active = bool(entry.get("activate", False))
         return name, sql_text, is_active
 
-    response.raise_for_status()
+    return name, str(entry.get("sql", "")), bool(entry.get("activate", False))
+
+
+def parse_script_response(response: requests.Response, url: str) -> dict[str, Any]:
     content_type = response.headers.get("content-type", "").lower()
     is_active = False
     if "application/json" in content_type:
@@ -156,246 +825,2160 @@ def fetch_sql_from_endpoint(
         # But let's assume if it returns 200 plain text, we allow it (or you can force False).
         is_active = True
 
-    return name, sql_text, is_active
+    return {"sql": sql_text, "activate": is_active}
 
 
-def append_error_log(err_message: str) -> None:
-    os.makedirs(os.path.dirname(ERROR_LOG_PATH), exist_ok=True)
-    date_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(ERROR_LOG_PATH, "a", encoding="utf-8") as log_file:
-        log_file.write(f"{date_time} , {err_message}\n")
+def clip_text(text: str, limit: int) -> str:
+    if limit <= 0 or len(text) <= limit:
+        return text
+    return f"{text[:limit]}...(+{len(text) - limit} chars)"
 
 
-def is_retryable_mysql_error(error: Exception) -> bool:
-    if isinstance(error, (pymysql.err.OperationalError, pymysql.err.InterfaceError)):
-        code = error.args[0] if error.args else None
-        return code in {2006, 2013, 2014, 2055}
-    return "Lost connection to MySQL server" in str(error)
+class ErrorLog:
+    """Buffered JSON-lines writer behind ``append_error_log``.
 
+    Callers only add to an in-memory window under a lock. A daemon thread
+    writes the window every ``flush_seconds`` through one open handle, which
+    is reopened when logrotate moved the file, and once more at exit. An
+    error repeating within the window with the same event, message and
+    fields (``VARYING_FIELDS`` aside) is written once, then summarized with
+    ``"repeated": n`` and the ``idx`` of every repeat (up to ``MAX_MERGED_IDX``,
+    then only counted). Past ``max_keys`` distinct errors per window new ones
+    are only counted, so a failure storm costs a dict lookup per error.
+    String values are clipped to ``text_limit`` characters.
+    """
 
-def fetch_rows(config: dict[str, Any], sql_text: str) -> list[dict[str, Any]]:
-    retries = max(0, config["db_retry_total"])
-    backoff = config["db_retry_backoff"]
-    last_error: Exception | None = None
-    for attempt in range(retries + 1):
-        connection = None
+    VARYING_FIELDS = ("idx", "attempt", "rows")
+    MAX_MERGED_IDX = 1000
+    # urllib3 errors embed object addresses, which differ on every failure.
+    OBJECT_ADDRESS = re.compile(r" at 0x[0-9a-fA-F]+")
+
+    def __init__(self, path: str, flush_seconds: float, text_limit: int, max_keys: int) -> None:
+        self.path = path
+        self.flush_seconds = max(0.1, flush_seconds)
+        self.text_limit = text_limit
+        self.max_keys = max(1, max_keys)
+        self._window: dict[tuple[Any, ...], dict[str, Any]] = {}
+        self._lines: list[str] = []
+        self._dropped = 0
+        self._handle: Any = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        atexit.register(self.flush)
+
+    @classmethod
+    def from_env(cls) -> "ErrorLog":
+        return cls(
+            ERROR_LOG_PATH,
+            float(os.getenv("ERROR_LOG_FLUSH_SECONDS", "2")),
+            int(os.getenv("ERROR_LOG_TEXT_LIMIT", "500")),
+            int(os.getenv("ERROR_LOG_MAX_KEYS", "200")),
+        )
+
+    def append(self, event: str, error: Any, fields: dict[str, Any]) -> bool:
+        record: dict[str, Any] = {"ts": datetime.now().isoformat(timespec="seconds"), "event": event}
+        if error is not None:
+            record["error"] = clip_text(self.OBJECT_ADDRESS.sub("", str(error)), self.text_limit)
+        for name, value in fields.items():
+            record[name] = clip_text(value, self.text_limit) if isinstance(value, str) else value
+        key = tuple(
+            (name, repr(value)) for name, value in record.items()
+            if name != "ts" and name not in self.VARYING_FIELDS
+        )
+        with self._lock:
+            entry = self._window.get(key)
+            if entry is not None:
+                entry["repeated"] += 1
+                entry["last"] = record
+                if "idx" in record and len(entry["idx"]) < self.MAX_MERGED_IDX:
+                    entry["idx"].append(record["idx"])
+                return False
+            if len(self._window) >= self.max_keys:
+                self._dropped += 1
+                return False
+            self._window[key] = {"record": record, "repeated": 0, "last": record, "idx": []}
+            self._lines.append(json.dumps(record, ensure_ascii=False, default=str))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="error-log", daemon=True)
+                self._thread.start()
+        return True
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.flush_seconds)
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            lines, window, dropped = self._lines, self._window, self._dropped
+            self._lines, self._window, self._dropped = [], {}, 0
+        for entry in window.values():
+            if not entry["repeated"]:
+                continue
+            last = entry["last"]
+            summary = {name: value for name, value in entry["record"].items() if name not in self.VARYING_FIELDS}
+            summary["ts"] = last["ts"]
+            summary["repeated"] = entry["repeated"]
+            summary.update({f"last_{name}": last[name] for name in self.VARYING_FIELDS if name in last})
+            if entry["idx"]:
+                summary["repeated_idx"] = entry["idx"]
+            lines.append(json.dumps(summary, ensure_ascii=False, default=str))
+        if dropped:
+            lines.append(json.dumps({
+                "ts": datetime.now().isoformat(timespec="seconds"),
+                "event": "error_log",
+                "error": f"more than {self.max_keys} distinct errors, not logged",
+                "repeated": dropped,
+            }))
+        if not lines:
+            return
+        with self._write_lock:
+            try:
+                handle = self._open()
+                handle.write("\n".join(lines) + "\n")
+                handle.flush()
+            except OSError as error:
+                log(f"[error-log] cannot write {self.path}: {error}")
+
+    def _open(self) -> Any:
+        if self._handle is not None:
+            try:
+                if os.stat(self.path).st_ino == os.fstat(self._handle.fileno()).st_ino:
+                    return self._handle
+            except OSError:
+                pass
+            self._handle.close()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._handle = open(self.path, "a", encoding="utf-8")
+        return self._handle
+
+
+_ERROR_LOG: ErrorLog | None = None
+_ERROR_LOG_LOCK = threading.Lock()
+
+
+def append_error_log(event: str, error: Any = None, **fields: Any) -> bool:
+    """Queue one error for ``logs/err_message.log``.
+
+    Returns False when it was folded into the count of an identical error,
+    so callers can skip echoing repeats to stdout as well.
+    """
+    global _ERROR_LOG
+    if _ERROR_LOG is None:
+        with _ERROR_LOG_LOCK:
+            if _ERROR_LOG is None:
+                _ERROR_LOG = ErrorLog.from_env()
+    return _ERROR_LOG.append(event, error, fields)
+
+
+METRICS_LOG_PATH = os.path.join("logs", "sync_metrics.log")
+_METRICS_LOCK = threading.Lock()
+_CURRENT_RUN = threading.local()
+
+
+class RunMetrics:
+    """Timers and counters for one sync run.
+
+    The run is bound to the thread that executes it (``use_metrics``); delivery
+    workers adopt the caller's run, so every phase and counter of a run ends
+    up in one record.
+    """
+
+    def __init__(self, source: str) -> None:
+        self.source = source
+        self.started = time.time()
+        self.phases: dict[str, float] = {}
+        self.counters: dict[str, int] = {}
+        self.http_status: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
         try:
-            connection = pymysql.connect(
-                host=config["db_host"],
-                port=config["db_port"],
-                user=config["db_user"],
-                password=config["db_password"],
-                database=config["db_name"],
-                charset=config["db_charset"],
-                cursorclass=pymysql.cursors.DictCursor,
-                connect_timeout=config["db_connect_timeout"],
-                read_timeout=config["db_read_timeout"],
-                write_timeout=config["db_write_timeout"],
-            )
-            connection.ping(reconnect=True)
-            with connection.cursor() as cursor:
-                cursor.execute(sql_text)
-                rows = cursor.fetchall()
-                return [normalize_row(row) for row in rows]
-        except Exception as error:
-            last_error = error
-            append_error_log(f"sql err: attempt={attempt + 1}/{retries + 1} error={error}")
-            if not is_retryable_mysql_error(error) or attempt >= retries:
-                raise
-            time.sleep(backoff * (2**attempt))
+            yield
         finally:
-            if connection is not None:
-                connection.close()
-    if last_error:
-        raise last_error
-    return []
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
 
+    def add(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
 
-def parse_retry_statuses(raw_value: str) -> list[int]:
-    return [int(value.strip()) for value in raw_value.split(",") if value.strip().isdigit()]
+    def count_status(self, status: int | str) -> None:
+        with self._lock:
+            key = str(status)
+            self.http_status[key] = self.http_status.get(key, 0) + 1
 
+    def record(self, exit_code: int) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "ts": datetime.now(timezone.utc).isoformat(),
+                "source": self.source,
+                "exit_code": exit_code,
+                "elapsed": round(time.time() - self.started, 3),
+                "phases": {name: round(value, 3) for name, value in self.phases.items()},
+                "counters": dict(self.counters),
+                "http_status": dict(self.http_status),
+            }
 
-def build_session(config: dict[str, Any]) -> requests.Session:
-    statuses = parse_retry_statuses(config["post_retry_statuses"])
-    retry = Retry(
-        total=config["post_retry_total"],
-        backoff_factor=config["post_retry_backoff"],
-        status_forcelist=statuses,
-        allowed_methods={"POST", "GET"},
-        raise_on_status=False,
-    )
-    adapter = HTTPAdapter(max_retries=retry)
-    session = requests.Session()
-    session.mount("http://", adapter)
-    session.mount("https://", adapter)
-    return session
 
+class _NoMetrics(RunMetrics):
+    # Used outside a tracked run (MQTT handler, outbox replay, ad-hoc calls).
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        yield
 
-def post_rows(
-    api_url: str,
-    timeout: int,
-    sync_file: str,
-    rows: list[dict[str, Any]],
-    config: dict[str, Any],
-) -> tuple[int, int]:
-    success = 0
-    failed = 0
-    sleep_seconds = config["post_sleep_ms"] / 1000
-    log_every = max(0, config["post_log_every"])
-    batch_size = max(1, config["post_batch_size"])
-    batch_url = config["api_batch_url"].strip()
-    session = build_session(config)
-    processed = 0
-
-    def build_body(row_data: dict[str, Any]) -> dict[str, Any]:
-        return {
-            "hoscode": str(row_data.get("hoscode", "")).strip(),
-            "source": sync_file,
-            "payload": dict(row_data),
-            "sync_datetime": datetime.now(timezone.utc).isoformat(),
-        }
+    def add(self, name: str, value: int = 1) -> None:
+        pass
 
-    if batch_size > 1 and batch_url:
-        batch: list[tuple[int, dict[str, Any]]] = []
-        for index, row in enumerate(rows, start=1):
-            body = build_body(row)
-            if not body["hoscode"]:
-                failed += 1
-                append_error_log(f"post err: idx={index} missing hoscode")
-                log("[SKIP] missing hoscode in row")
-                continue
-            batch.append((index, body))
-            if len(batch) < batch_size:
-                continue
+    def count_status(self, status: int | str) -> None:
+        pass
 
-            success, failed, processed = post_batch(
-                batch_url,
-                session,
-                batch,
-                timeout,
-                success,
-                failed,
-                processed,
-                log_every,
-            )
-            batch = []
-            time.sleep(sleep_seconds)
 
-        if batch:
-            success, failed, processed = post_batch(
-                batch_url,
-                session,
-                batch,
-                timeout,
-                success,
-                failed,
-                processed,
-                log_every,
-            )
-            time.sleep(sleep_seconds)
-    else:
-        for index, row in enumerate(rows, start=1):
-            hoscode = str(row.get("hoscode", "")).strip()
-            if not hoscode:
-                failed += 1
-                append_error_log(f"post err: idx={index} missing hoscode")
-                log(f"[SKIP] missing hoscode in row idx={index}")
-                continue
+_NO_METRICS = _NoMetrics("")
 
-            body = build_body(row)
 
-            try:
-                response = session.post(api_url, json=body, timeout=timeout)
-                if response.status_code < 300:
-                    success += 1
-                else:
-                    failed += 1
-                    append_error_log(
-                        "post err: idx={idx} hoscode={hoscode} "
-                        "status={status} body={body}".format(
-                            idx=index,
-                            hoscode=hoscode,
-                            status=response.status_code,
-                            body=response.text,
-                        )
-                    )
-                    log(
-                        f"[FAIL] idx={index} hoscode={hoscode} "
-                        f"status={response.status_code} body={response.text}"
-                    )
-            except requests.RequestException as error:
-                failed += 1
-                append_error_log(f"post err: idx={index} hoscode={hoscode} error={error}")
-                log(f"[ERROR] idx={index} hoscode={hoscode} error={error}")
-            finally:
-                processed += 1
-                if log_every and processed % log_every == 0:
-                    log(f"progress: {processed}/{len(rows)} posted")
-                time.sleep(sleep_seconds)
+def current_metrics() -> RunMetrics:
+    return getattr(_CURRENT_RUN, "metrics", None) or _NO_METRICS
 
-    return success, failed
+
+@contextlib.contextmanager
+def use_metrics(metrics: RunMetrics) -> Iterator[RunMetrics]:
+    previous = getattr(_CURRENT_RUN, "metrics", None)
+    _CURRENT_RUN.metrics = metrics
+    try:
+        yield metrics
+    finally:
+        _CURRENT_RUN.metrics = previous
 
 
-def post_batch(
-    batch_url: str,
-    session: requests.Session,
-    batch: list[tuple[int, dict[str, Any]]],
-    timeout: int,
-    success: int,
-    failed: int,
-    processed: int,
-    log_every: int,
-) -> tuple[int, int, int]:
-    bodies = [body for _, body in batch]
+def write_run_metrics(config: dict[str, Any], record: dict[str, Any]) -> None:
+    """Append the run record as a JSON line and refresh the Prometheus textfile."""
     try:
-        response = session.post(batch_url, json=bodies, timeout=timeout)
-        if response.status_code < 300:
-            success += len(bodies)
-        else:
-            failed += len(bodies)
-            append_error_log(
-                "post err: batch idx={start}-{end} status={status} body={body}".format(
-                    start=batch[0][0],
-                    end=batch[-1][0],
-                    status=response.status_code,
-                    body=response.text,
-                )
+        os.makedirs(os.path.dirname(METRICS_LOG_PATH), exist_ok=True)
+        with _METRICS_LOCK, open(METRICS_LOG_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        if not config["metrics_textfile"] and config["metrics_port"] <= 0:
+            return
+        # cron starts one process per script, so the shared last-run state
+        # is updated under a file lock.
+        os.makedirs(os.path.dirname(config["metrics_state_path"]) or ".", exist_ok=True)
+        with _METRICS_LOCK, open(f"{config['metrics_state_path']}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            state = read_json_file(config["metrics_state_path"]) or {}
+            state[record["source"]] = record
+            write_json_file(config["metrics_state_path"], state)
+            if config["metrics_textfile"]:
+                write_text_atomic(config["metrics_textfile"], render_prometheus(state))
+    except OSError as error:
+        log(f"[metrics] cannot write metrics: {error}")
+
+
+def write_text_atomic(path: str, text: str) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def render_prometheus(state: dict[str, Any]) -> str:
+    def label(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    samples: dict[str, list[str]] = {
+        "plk_sync_last_run_timestamp_seconds": [],
+        "plk_sync_last_run_exit_code": [],
+        "plk_sync_last_run_duration_seconds": [],
+        "plk_sync_last_run_phase_seconds": [],
+        "plk_sync_last_run_count": [],
+        "plk_sync_last_run_http_responses": [],
+    }
+    for source, record in sorted(state.items()):
+        src = label(source)
+        started = datetime.fromisoformat(record["ts"]).timestamp() - record["elapsed"]
+        samples["plk_sync_last_run_timestamp_seconds"].append(f'{{source="{src}"}} {started:.3f}')
+        samples["plk_sync_last_run_exit_code"].append(f'{{source="{src}"}} {record["exit_code"]}')
+        samples["plk_sync_last_run_duration_seconds"].append(f'{{source="{src}"}} {record["elapsed"]}')
+        for name, value in sorted(record["phases"].items()):
+            samples["plk_sync_last_run_phase_seconds"].append(
+                f'{{source="{src}",phase="{label(name)}"}} {value}'
             )
-            log(
-                f"[FAIL] batch idx={batch[0][0]}-{batch[-1][0]} "
-                f"status={response.status_code} body={response.text}"
+        for name, value in sorted(record["counters"].items()):
+            samples["plk_sync_last_run_count"].append(
+                f'{{source="{src}",counter="{label(name)}"}} {value}'
             )
-    except requests.RequestException as error:
-        failed += len(bodies)
-        append_error_log(
-            f"post err: batch idx={batch[0][0]}-{batch[-1][0]} error={error}"
-        )
-        log(f"[ERROR] batch idx={batch[0][0]}-{batch[-1][0]} error={error}")
+        for status, value in sorted(record["http_status"].items()):
+            samples["plk_sync_last_run_http_responses"].append(
+                f'{{source="{src}",status="{label(status)}"}} {value}'
+            )
+    lines = []
+    for name, values in samples.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(f"{name}{value}" for value in values)
+    return "\n".join(lines) + "\n"
 
-    processed += len(bodies)
-    if log_every and processed % log_every == 0:
-        log(f"progress: {processed} rows posted")
-    return success, failed, processed
 
+def start_metrics_server(config: dict[str, Any]) -> None:
+    """Serve the last-run metrics on ``metrics_port`` (daemon mode only)."""
+    port = config["metrics_port"]
+    if port <= 0:
+        return
 
-def main() -> int:
-    parser = argparse.ArgumentParser(description="Generic sync client for <number>_sync_*.sql")
-    parser.add_argument("sync_file", help="sync SQL file name, e.g. 0_sync_test.sql")
-    parser.add_argument("--dry-run", action="store_true", help="Print first payload without posting")
-    args = parser.parse_args()
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.rstrip("/") not in {"", "/metrics"}:
+                self.send_error(404)
+                return
+            state = read_json_file(config["metrics_state_path"]) or {}
+            body = render_prometheus(state).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
 
-    config = load_config()
-    sync_scripts_url = config["sync_scripts_url"].strip()
-    if not sync_scripts_url:
-        raise ValueError("SYNC_SCRIPTS_URL is required")
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
 
-    effective_file, sql_text, is_active = fetch_sql_from_endpoint(
-        config,
-        sync_scripts_url,
-        args.sync_file,
-    )
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    log(f"[metrics] serving on :{port}/metrics")
 
-    if not sql_text.strip():
+
+def is_retryable_mysql_error(error: Exception) -> bool:
+    if isinstance(error, (pymysql.err.OperationalError, pymysql.err.InterfaceError)):
+        code = error.args[0] if error.args else None
+        return code in {2006, 2013, 2014, 2055}
+    return "Lost connection to MySQL server" in str(error)
+
+
+def is_server_error(error: Exception) -> bool:
+    # Errors reported by the server (codes below 2000, e.g. a bad column, or
+    # 3000+ on MySQL 5.7+, e.g. a statement killed by max_execution_time) leave
+    # the connection usable; client-side codes 2000-2999 mean the socket is gone.
+    if isinstance(error, pymysql.err.MySQLError) and error.args:
+        code = error.args[0]
+        return isinstance(code, int) and (0 < code < 2000 or code >= 3000)
+    return False
+
+
+def connect_db(
+    config: dict[str, Any],
+    cursorclass: type = pymysql.cursors.DictCursor,
+) -> pymysql.connections.Connection:
+    connection = pymysql.connect(
+        host=config["db_host"],
+        port=config["db_port"],
+        user=config["db_user"],
+        password=config["db_password"],
+        database=config["db_name"],
+        charset=config["db_charset"],
+        cursorclass=cursorclass,
+        connect_timeout=config["db_connect_timeout"],
+        read_timeout=config["db_read_timeout"],
+        write_timeout=config["db_write_timeout"],
+        # Pooled connections are reused for many reads; without autocommit
+        # the first SELECT pins an InnoDB snapshot that later queries see.
+        autocommit=True,
+    )
+    connection.ping(reconnect=True)
+    return connection
+
+
+class ConnectionPool:
+    """Bounded pool of HIS connections shared by every query in the process.
+
+    At most ``size`` connections exist at once; callers wait up to
+    ``wait_timeout`` seconds for a free one. Checkout pings the connection
+    and replaces it if the ping fails. Idle connections older than
+    ``idle_timeout`` are closed before MySQL's own ``wait_timeout`` drops
+    them. Connections that saw a retryable error are discarded on release,
+    so the retry gets a fresh handshake instead of the broken socket.
+    """
+
+    def __init__(
+        self,
+        config: dict[str, Any],
+        size: int,
+        idle_timeout: float,
+        wait_timeout: float,
+    ) -> None:
+        self.config = config
+        self.size = max(1, size)
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self._idle: list[tuple[float, pymysql.connections.Connection]] = []
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._lock = threading.Lock()
+
+    def acquire(self) -> pymysql.connections.Connection:
+        if not self._slots.acquire(timeout=self.wait_timeout):
+            raise TimeoutError(f"no free HIS connection after {self.wait_timeout}s")
+        try:
+            while True:
+                connection = self._take_idle()
+                if connection is None:
+                    current_metrics().add("db_connects")
+                    return connect_db(self.config)
+                try:
+                    connection.ping(reconnect=False)
+                    return connection
+                except Exception:
+                    close_quietly(connection)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, connection: pymysql.connections.Connection, reusable: bool) -> None:
+        try:
+            if reusable and connection.open:
+                with self._lock:
+                    self._idle.append((time.monotonic(), connection))
+            else:
+                close_quietly(connection)
+        finally:
+            self._slots.release()
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for _, connection in idle:
+            close_quietly(connection)
+
+    def _take_idle(self) -> pymysql.connections.Connection | None:
+        expired: list[pymysql.connections.Connection] = []
+        connection = None
+        with self._lock:
+            cutoff = time.monotonic() - self.idle_timeout
+            while self._idle and self._idle[0][0] < cutoff:
+                expired.append(self._idle.pop(0)[1])
+            if self._idle:
+                connection = self._idle.pop()[1]
+        for stale in expired:
+            close_quietly(stale)
+        return connection
+
+
+_DB_POOLS: dict[int, ConnectionPool] = {}
+_DB_POOLS_LOCK = threading.Lock()
+
+
+def get_db_pool(config: dict[str, Any]) -> ConnectionPool:
+    key = id(config)
+    with _DB_POOLS_LOCK:
+        pool = _DB_POOLS.get(key)
+        if pool is None:
+            pool = ConnectionPool(
+                config,
+                config["db_pool_size"],
+                config["db_pool_idle_timeout"],
+                config["db_pool_wait_timeout"],
+            )
+            _DB_POOLS[key] = pool
+        return pool
+
+
+def acquire_connection(config: dict[str, Any]) -> pymysql.connections.Connection:
+    return get_db_pool(config).acquire()
+
+
+def release_connection(
+    config: dict[str, Any],
+    connection: pymysql.connections.Connection,
+    reusable: bool,
+) -> None:
+    get_db_pool(config).release(connection, reusable)
+
+
+def close_quietly(connection: pymysql.connections.Connection) -> None:
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+# Server errors for a statement killed by the execution limit (MySQL, MariaDB).
+QUERY_TIMEOUT_ERRORS = {3024, 1969}
+
+
+class HisQuery:
+    """Measurements of one governed HIS query, filled in by the caller."""
+
+    def __init__(self, governor: "HisGovernor", source: str) -> None:
+        self.governor = governor
+        self.source = source
+        self.rows = 0
+        self.examined: int | None = None
+        self._connection: pymysql.connections.Connection | None = None
+        self._reads_before: int | None = None
+        self._started = time.monotonic()
+
+    def begin(self, connection: pymysql.connections.Connection) -> None:
+        """Apply the script's execution limit and snapshot the read counters."""
+        self._connection = connection
+        self.governor.apply_limit(connection, self.source)
+        if self.governor.track_examined:
+            self._reads_before = handler_reads(connection)
+        self._started = time.monotonic()
+
+    def end(self, rows: int) -> None:
+        """Record the row count; must run after the result was fully read."""
+        self.rows = rows
+        if self._reads_before is not None and self._connection is not None:
+            self.examined = max(0, handler_reads(self._connection) - self._reads_before)
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self._started
+
+
+def handler_reads(connection: pymysql.connections.Connection) -> int:
+    # The storage engine read counters of this session; their delta over a
+    # statement approximates its rows examined without performance_schema.
+    with connection.cursor(pymysql.cursors.Cursor) as cursor:
+        cursor.execute("SHOW SESSION STATUS LIKE 'Handler_read%'")
+        return sum(int(value) for _, value in cursor.fetchall())
+
+
+class HisGovernor:
+    """Keeps scheduled scripts and MQTT queries from overloading the HIS.
+
+    * Every query runs with a server-side execution limit
+      (``max_execution_time`` on MySQL, ``max_statement_time`` on MariaDB),
+      ``max_execution_ms`` by default or a per-script override.
+    * At most ``max_queries`` queries run at once across all processes that
+      share the state directory; slots are ``flock``-ed files, so a crashed
+      process gives its slot back.
+    * Execution time and rows examined are kept per script in
+      ``his_load.json``. Scripts averaging ``heavy_seconds`` or more also need
+      the single heavy slot, so heavy queries run one after another. A heavy
+      script waits ``heavy_wait_timeout`` for it (0 = as long as it takes)
+      and then runs anyway; ``heavy_slot`` holds it across all queries of a
+      run, e.g. the shards of one script.
+    """
+
+    STATS_ALPHA = 0.3
+
+    def __init__(self, config: dict[str, Any]) -> None:
+        self.max_execution_ms = max(0, config["his_max_execution_ms"])
+        self.overrides = parse_execution_overrides(config["his_max_execution_overrides"])
+        self.max_queries = max(0, config["his_max_queries"])
+        self.heavy_seconds = config["his_heavy_seconds"]
+        self.track_examined = config["his_track_examined"]
+        self.wait_timeout = config["db_pool_wait_timeout"]
+        self.heavy_wait_timeout = max(0.0, config["his_heavy_wait_seconds"])
+        self.slot_dir = os.path.join(config["state_dir"], "his_slots")
+        self.stats_path = config["his_stats_path"]
+        self._limits = bool(self.max_execution_ms or any(self.overrides.values()))
+        self._warned: set[str] = set()
+
+    def limit_for(self, source: str) -> int:
+        return self.overrides.get(source, self.max_execution_ms)
+
+    def apply_limit(self, connection: pymysql.connections.Connection, source: str) -> None:
+        if not self._limits:
+            return
+        limit_ms = self.limit_for(source)
+        # Pooled connections keep session variables, so 0 is set explicitly
+        # to clear the previous script's limit.
+        if "mariadb" in connection.get_server_info().lower():
+            statement, value = "SET SESSION max_statement_time = %s", limit_ms / 1000
+        else:
+            statement, value = "SET SESSION max_execution_time = %s", limit_ms
+        try:
+            with connection.cursor(pymysql.cursors.Cursor) as cursor:
+                cursor.execute(statement, (value,))
+        except pymysql.err.MySQLError as error:
+            if not is_server_error(error):
+                raise
+            if statement not in self._warned:
+                self._warned.add(statement)
+                log(f"[his] server does not support execution limits: {error}")
+
+    @contextlib.contextmanager
+    def query(self, source: str, heavy: bool = True) -> Iterator[HisQuery]:
+        metrics = current_metrics()
+        with contextlib.ExitStack() as stack:
+            with metrics.phase("his_wait"):
+                # Always heavy slot first, then a query slot, so waiters
+                # cannot hold each other's slots.
+                # ``heavy=False``: the caller already holds the heavy slot.
+                if heavy:
+                    stack.enter_context(self.heavy_slot(source))
+                stack.enter_context(self._slot("query", self.max_queries))
+            probe = HisQuery(self, source)
+            try:
+                yield probe
+            except BaseException as error:
+                self._finish(probe, error)
+                raise
+            self._finish(probe, None)
+
+    @contextlib.contextmanager
+    def heavy_slot(self, source: str) -> Iterator[None]:
+        """Hold the heavy slot, if ``source`` is heavy, for the whole block."""
+        if not self.is_heavy(source):
+            yield
+            return
+        log(f"[his] [{source}] heavy script, waiting for the heavy slot")
+        slot_file = self._acquire("heavy", 1, self.heavy_wait_timeout or None)
+        if slot_file is None:
+            log(f"[his] [{source}] heavy slot still busy after {self.heavy_wait_timeout:g}s, running anyway")
+        try:
+            yield
+        finally:
+            if slot_file is not None:
+                slot_file.close()
+
+    def free_slots(self) -> int:
+        """Query slots nobody holds right now (a snapshot, for sizing only)."""
+        if self.max_queries <= 0:
+            return sys.maxsize
+        os.makedirs(self.slot_dir, exist_ok=True)
+        free = 0
+        for index in range(self.max_queries):
+            with open(os.path.join(self.slot_dir, f"query-{index}.lock"), "a") as slot_file:
+                try:
+                    fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                free += 1
+        return free
+
+    def is_heavy(self, source: str) -> bool:
+        if not source or self.heavy_seconds <= 0:
+            return False
+        entry = (read_json_file(self.stats_path) or {}).get(source) or {}
+        return entry.get("avg_seconds", 0.0) >= self.heavy_seconds
+
+    def _finish(self, probe: HisQuery, error: BaseException | None) -> None:
+        timed_out = (
+            isinstance(error, pymysql.err.MySQLError)
+            and bool(error.args)
+            and error.args[0] in QUERY_TIMEOUT_ERRORS
+        )
+        elapsed = probe.elapsed
+        if probe.examined is not None:
+            current_metrics().add("db_rows_examined", probe.examined)
+        if timed_out:
+            log(f"[his] [{probe.source}] killed by execution limit after {elapsed:.1f}s")
+        elif error is None:
+            log(
+                f"[his] [{probe.source}] exec={elapsed:.2f}s rows={probe.rows} "
+                f"examined={'-' if probe.examined is None else probe.examined}"
+            )
+        if probe.source and (error is None or timed_out):
+            self._record(probe, elapsed, timed_out)
+
+    def _record(self, probe: HisQuery, elapsed: float, timed_out: bool) -> None:
+        try:
+            os.makedirs(os.path.dirname(self.stats_path) or ".", exist_ok=True)
+            with open(f"{self.stats_path}.lock", "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                stats = read_json_file(self.stats_path) or {}
+                entry = stats.get(probe.source) or {"runs": 0, "timeouts": 0}
+                alpha = self.STATS_ALPHA if entry["runs"] else 1.0
+                entry["runs"] += 1
+                entry["last_run"] = datetime.now(timezone.utc).isoformat()
+                entry["last_seconds"] = round(elapsed, 3)
+                entry["avg_seconds"] = round(
+                    alpha * elapsed + (1 - alpha) * entry.get("avg_seconds", elapsed), 3
+                )
+                entry["max_seconds"] = round(max(elapsed, entry.get("max_seconds", 0.0)), 3)
+                if timed_out:
+                    entry["timeouts"] += 1
+                else:
+                    entry["last_rows"] = probe.rows
+                if probe.examined is not None:
+                    entry["last_examined"] = probe.examined
+                    entry["max_examined"] = max(probe.examined, entry.get("max_examined", 0))
+                stats[probe.source] = entry
+                write_json_file(self.stats_path, stats)
+        except OSError as error:
+            log(f"[his] cannot write load stats: {error}")
+
+    @contextlib.contextmanager
+    def _slot(self, name: str, count: int) -> Iterator[None]:
+        if count <= 0:
+            yield
+            return
+        slot_file = self._acquire(name, count, self.wait_timeout)
+        if slot_file is None:
+            raise TimeoutError(f"no free HIS {name} slot after {self.wait_timeout}s")
+        try:
+            yield
+        finally:
+            slot_file.close()
+
+    def _acquire(self, name: str, count: int, timeout: float | None) -> Any:
+        """Lock one of ``count`` slot files; None after ``timeout`` seconds."""
+        os.makedirs(self.slot_dir, exist_ok=True)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.05
+        while True:
+            for index in range(count):
+                slot_file = open(os.path.join(self.slot_dir, f"{name}-{index}.lock"), "a")
+                try:
+                    fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    slot_file.close()
+                    continue
+                return slot_file
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(delay)
+            delay = min(0.5, delay * 2)
+
+
+def print_his_stats(config: dict[str, Any]) -> None:
+    stats = read_json_file(config["his_stats_path"]) or {}
+    if not stats:
+        log("[his] no load stats recorded yet")
+        return
+    print(f"{'source':<48}{'runs':>6}{'avg s':>9}{'max s':>9}{'last rows':>11}{'examined':>12}{'timeouts':>10}")
+    for source, entry in sorted(stats.items(), key=lambda item: -item[1].get("avg_seconds", 0.0)):
+        print(
+            f"{source:<48}{entry['runs']:>6}{entry['avg_seconds']:>9.2f}{entry['max_seconds']:>9.2f}"
+            f"{entry.get('last_rows', '-'):>11}{entry.get('last_examined', '-'):>12}{entry['timeouts']:>10}"
+        )
+
+
+def parse_execution_overrides(raw_value: str) -> dict[str, int]:
+    overrides = {}
+    for item in raw_value.split(","):
+        name, _, value = item.partition("=")
+        if name.strip() and value.strip().isdigit():
+            overrides[name.strip()] = int(value)
+    return overrides
+
+
+_GOVERNORS: dict[int, HisGovernor] = {}
+_GOVERNORS_LOCK = threading.Lock()
+
+
+def get_his_governor(config: dict[str, Any]) -> HisGovernor:
+    key = id(config)
+    with _GOVERNORS_LOCK:
+        governor = _GOVERNORS.get(key)
+        if governor is None:
+            governor = HisGovernor(config)
+            _GOVERNORS[key] = governor
+        return governor
+
+
+def fetch_rows(
+    config: dict[str, Any],
+    sql_text: str,
+    source: str = "",
+    heavy: bool = True,
+) -> list[dict[str, Any]]:
+    metrics = current_metrics()
+    governor = get_his_governor(config)
+    retries = max(0, config["db_retry_total"])
+    backoff = config["db_retry_backoff"]
+    last_error: Exception | None = None
+    for attempt in range(retries + 1):
+        connection = None
+        reusable = False
+        try:
+            with governor.query(source, heavy) as probe:
+                connection = acquire_connection(config)
+                probe.begin(connection)
+                with connection.cursor(pymysql.cursors.Cursor) as cursor:
+                    with metrics.phase("db_execute"):
+                        cursor.execute(sql_text)
+                    with metrics.phase("db_fetch"):
+                        rows = cursor.fetchall()
+                    converter = RowConverter.from_cursor(cursor)
+                probe.end(len(rows))
+            reusable = True
+            with metrics.phase("normalize"):
+                return converter.convert(rows)
+        except Exception as error:
+            last_error = error
+            reusable = is_server_error(error)
+            append_error_log("sql", error, source=source, attempt=f"{attempt + 1}/{retries + 1}")
+            if not is_retryable_mysql_error(error) or attempt >= retries:
+                raise
+            metrics.add("db_retries")
+            time.sleep(backoff * (2**attempt))
+        finally:
+            if connection is not None:
+                release_connection(config, connection, reusable)
+    if last_error:
+        raise last_error
+    return []
+
+
+def stream_rows(config: dict[str, Any], sql_text: str, source: str = "") -> Iterator[dict[str, Any]]:
+    """Yield normalized rows from an unbuffered server-side cursor.
+
+    Rows are pulled with ``fetchmany`` in chunks of ``db_stream_chunk`` so only one
+    chunk is held in memory and posting starts while MySQL is still sending. A
+    retry is only possible before the first row was yielded; after that the
+    error is raised to the caller, because the consumer has already seen rows.
+    """
+    metrics = current_metrics()
+    governor = get_his_governor(config)
+    retries = max(0, config["db_retry_total"])
+    backoff = config["db_retry_backoff"]
+    chunk_size = max(1, config["db_stream_chunk"])
+    for attempt in range(retries + 1):
+        connection = None
+        yielded = False
+        drained = False
+        try:
+            # The slot is held until the last row was read, as the query
+            # keeps running on the server while rows are posted.
+            with governor.query(source) as probe:
+                connection = acquire_connection(config)
+                probe.begin(connection)
+                cursor = connection.cursor(pymysql.cursors.SSCursor)
+                # The server aborts an unread result after net_write_timeout, and
+                # slow POSTs leave the socket unread between chunks.
+                cursor.execute(
+                    "SET SESSION net_write_timeout = %s",
+                    (max(1, config["db_stream_net_write_timeout"]),),
+                )
+                with metrics.phase("db_execute"):
+                    cursor.execute(sql_text)
+                converter = RowConverter.from_cursor(cursor)
+                count = 0
+                while True:
+                    with metrics.phase("db_fetch"):
+                        chunk = cursor.fetchmany(chunk_size)
+                    if not chunk:
+                        drained = True
+                        probe.end(count)
+                        return
+                    count += len(chunk)
+                    with metrics.phase("normalize"):
+                        normalized = converter.convert(chunk)
+                    yielded = True
+                    yield from normalized
+        except Exception as error:
+            append_error_log("sql", error, source=source, attempt=f"{attempt + 1}/{retries + 1}")
+            if yielded or not is_retryable_mysql_error(error) or attempt >= retries:
+                raise
+            metrics.add("db_retries")
+            time.sleep(backoff * (2**attempt))
+        finally:
+            # A half-read unbuffered result cannot be reused, only closed.
+            if connection is not None:
+                release_connection(config, connection, drained)
+
+
+def parse_retry_statuses(raw_value: str) -> list[int]:
+    return [int(value.strip()) for value in raw_value.split(",") if value.strip().isdigit()]
+
+
+def build_session(config: dict[str, Any]) -> requests.Session:
+    statuses = parse_retry_statuses(config["post_retry_statuses"])
+    retry = Retry(
+        total=config["post_retry_total"],
+        backoff_factor=config["post_retry_backoff"],
+        status_forcelist=statuses,
+        allowed_methods={"POST", "GET"},
+        raise_on_status=False,
+    )
+    pool_size = max(10, config["post_concurrency"])
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+_SESSIONS: dict[int, requests.Session] = {}
+_SESSIONS_LOCK = threading.Lock()
+
+
+def get_session(config: dict[str, Any]) -> requests.Session:
+    """Return the process-wide session for this config, building it once.
+
+    Reusing it keeps HTTP keep-alive and TLS sessions warm across runs in
+    daemon mode. urllib3's connection pool is thread-safe, so delivery
+    workers share it as well.
+    """
+    key = id(config)
+    with _SESSIONS_LOCK:
+        session = _SESSIONS.get(key)
+        if session is None:
+            session = build_session(config)
+            _SESSIONS[key] = session
+        return session
+
+
+class RateLimiter:
+    """Token bucket shared by all POST workers, tuned from server feedback.
+
+    The rate grows by ``step`` req/s after every fast 2xx response and is cut
+    by ``backoff`` on 429/503 or a connection error (AIMD). A ``Retry-After``
+    header pauses the whole bucket for that long. Slow responses hold the
+    rate where it is. With ``adaptive=False`` the rate stays fixed, which is
+    the old ``POST_SLEEP_MS`` behaviour.
+    """
+
+    BACKOFF_STATUSES = {429, 503}
+
+    def __init__(
+        self,
+        rate: float,
+        min_rate: float,
+        max_rate: float,
+        step: float,
+        backoff: float,
+        slow_seconds: float,
+        adaptive: bool = True,
+    ) -> None:
+        self.min_rate = max(0.01, min_rate)
+        self.max_rate = max(self.min_rate, max_rate)
+        self.rate = min(self.max_rate, max(self.min_rate, rate))
+        self.step = step
+        self.backoff = min(1.0, max(0.01, backoff))
+        self.slow_seconds = slow_seconds
+        self.adaptive = adaptive
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: dict[str, Any]) -> "RateLimiter":
+        rate = config["post_rate"]
+        if rate <= 0:
+            sleep_ms = config["post_sleep_ms"]
+            rate = 1000 / sleep_ms if sleep_ms > 0 else config["post_rate_max"]
+        return cls(
+            rate,
+            config["post_rate_min"],
+            config["post_rate_max"],
+            config["post_rate_step"],
+            config["post_rate_backoff"],
+            config["post_rate_slow_ms"] / 1000,
+            config["post_rate_adaptive"],
+        )
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(1.0, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def feedback(self, response: requests.Response | None, elapsed: float) -> None:
+        if not self.adaptive:
+            return
+        statuses = response_statuses(response)
+        with self._lock:
+            if not statuses or self.BACKOFF_STATUSES.intersection(statuses):
+                self.rate = max(self.min_rate, self.rate * self.backoff)
+                retry_after = parse_retry_after(response)
+                if retry_after:
+                    self._paused_until = max(
+                        self._paused_until,
+                        time.monotonic() + retry_after,
+                    )
+            elif statuses[-1] < 300 and elapsed < self.slow_seconds:
+                self.rate = min(self.max_rate, self.rate + self.step)
+
+
+def response_statuses(response: requests.Response | None) -> list[int]:
+    """Statuses seen for one request, including ones urllib3 retried away."""
+    if response is None:
+        return []
+    statuses: list[int] = []
+    retries = getattr(response.raw, "retries", None)
+    for attempt in getattr(retries, "history", None) or ():
+        if attempt.status is not None:
+            statuses.append(attempt.status)
+    statuses.append(response.status_code)
+    return statuses
+
+
+def parse_retry_after(response: requests.Response | None) -> float:
+    if response is None:
+        return 0.0
+    value = response.headers.get("Retry-After", "").strip()
+    if not value:
+        return 0.0
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return 0.0
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def send_limited(
+    session: requests.Session,
+    limiter: RateLimiter,
+    url: str,
+    **kwargs: Any,
+) -> requests.Response:
+    metrics = current_metrics()
+    limiter.acquire()
+    started = time.monotonic()
+    response = None
+    try:
+        response = session.post(url, **kwargs)
+        return response
+    finally:
+        limiter.feedback(response, time.monotonic() - started)
+        if response is None:
+            metrics.count_status("error")
+        else:
+            statuses = response_statuses(response)
+            metrics.count_status(response.status_code)
+            metrics.add("http_requests")
+            metrics.add("http_retries", len(statuses) - 1)
+            body = response.request.body if response.request is not None else None
+            metrics.add("bytes_sent", len(body) if body else 0)
+
+
+class DeliveryPool:
+    """Run POST tasks on up to ``concurrency`` worker threads.
+
+    Workers share the process-wide session from ``get_session``. Tasks return
+    ``(success, failed)`` for the rows they carried and the pool folds them
+    into the run totals, so accounting is the same as the serial path. At most
+    ``2 * concurrency`` tasks are queued, which keeps a streamed result from
+    piling up in memory behind a slow API. With ``concurrency=1`` tasks run
+    inline on the caller's thread. A task that raises instead of returning
+    counts all ``rows`` it was submitted with as failed.
+    """
+
+    def __init__(
+        self,
+        config: dict[str, Any],
+        concurrency: int,
+        total_label: str,
+        limiter: RateLimiter,
+    ) -> None:
+        self.config = config
+        self.concurrency = max(1, concurrency)
+        self.total_label = total_label
+        self.limiter = limiter
+        self.log_every = max(0, config["post_log_every"])
+        self.success = 0
+        self.failed = 0
+        self.processed = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.concurrency * 2)
+        self._metrics = current_metrics()
+        self._executor: ThreadPoolExecutor | None = None
+        if self.concurrency > 1:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.concurrency,
+                thread_name_prefix="post",
+            )
+
+    def session(self) -> requests.Session:
+        return get_session(self.config)
+
+    def add_failed(self, count: int) -> None:
+        with self._lock:
+            self.failed += count
+
+    def submit(self, rows: int, fn: Callable[..., tuple[int, int]], *args: Any) -> None:
+        if self._executor is None:
+            try:
+                result = fn(self.session(), *args)
+            except Exception as error:
+                result = self._task_error(error, rows)
+            self._record(result)
+            return
+        self._slots.acquire()
+        future = self._executor.submit(self._run, fn, *args)
+        future.add_done_callback(lambda done: self._done(done, rows))
+
+    def close(self) -> tuple[int, int]:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        return self.success, self.failed
+
+    def _run(self, fn: Callable[..., tuple[int, int]], *args: Any) -> tuple[int, int]:
+        with use_metrics(self._metrics):
+            return fn(self.session(), *args)
+
+    def _done(self, future: Future, rows: int) -> None:
+        self._slots.release()
+        try:
+            result = future.result()
+        except Exception as error:
+            result = self._task_error(error, rows)
+        self._record(result)
+
+    def _task_error(self, error: Exception, rows: int) -> tuple[int, int]:
+        # post_single/post_batch handle request errors themselves; anything
+        # else (e.g. the outbox disk is full) must not stop the remaining
+        # deliveries, but its rows were not confirmed and count as failed.
+        if append_error_log("post", error, stage="worker", rows=rows):
+            log(f"[ERROR] worker error={error} rows={rows}")
+        return 0, rows
+
+    def _record(self, result: tuple[int, int]) -> None:
+        ok, bad = result
+        with self._lock:
+            before = self.processed
+            self.success += ok
+            self.failed += bad
+            self.processed += ok + bad
+            processed = self.processed
+        if self.log_every and processed // self.log_every > before // self.log_every:
+            log(
+                f"progress: {processed}{self.total_label} rows posted "
+                f"rate={self.limiter.rate:.2f}/s"
+            )
+
+
+class BodyEncoder:
+    """Serialize a batch body once and compress it for the wire.
+
+    Uses ``orjson`` when it is installed and compact stdlib ``json``
+    otherwise. Bodies of at least ``min_bytes`` are compressed with gzip or
+    zstd (``zstandard`` package) and sent with ``Content-Encoding``.
+    """
+
+    DEFAULT_LEVELS = {"gzip": 6, "zstd": 3}
+
+    def __init__(self, encoding: str, level: int, min_bytes: int) -> None:
+        if encoding not in {"", "none", "gzip", "zstd"}:
+            raise ValueError(f"unsupported POST_WIRE_ENCODING: {encoding}")
+        if encoding == "zstd" and zstandard is None:
+            raise ValueError("POST_WIRE_ENCODING=zstd requires the zstandard package")
+        self.encoding = "" if encoding == "none" else encoding
+        self.level = level or self.DEFAULT_LEVELS.get(self.encoding, 0)
+        self.min_bytes = min_bytes
+        self._local = threading.local()
+
+    @classmethod
+    def from_config(cls, config: dict[str, Any]) -> "BodyEncoder | None":
+        if not config["post_wire_encoding"]:
+            return None
+        return cls(
+            config["post_wire_encoding"],
+            config["post_wire_level"],
+            config["post_wire_min_bytes"],
+        )
+
+    def encode(self, body: Any) -> tuple[bytes, dict[str, str]]:
+        if orjson is not None:
+            data = orjson.dumps(body)
+        else:
+            data = json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        if not self.encoding or len(data) < self.min_bytes:
+            return data, headers
+        if self.encoding == "gzip":
+            data = gzip.compress(data, compresslevel=self.level)
+        else:
+            # ZstdCompressor is not thread-safe; keep one per delivery worker.
+            compressor = getattr(self._local, "zstd", None)
+            if compressor is None:
+                compressor = zstandard.ZstdCompressor(level=self.level)
+                self._local.zstd = compressor
+            data = compressor.compress(data)
+        headers["Content-Encoding"] = self.encoding
+        return data, headers
+
+
+_BATCH_SIZES_LOCK = threading.Lock()
+
+
+class BatchSizer:
+    """Decides when a batch is full and tunes the row target per script.
+
+    A batch closes at ``target`` rows or when its estimated JSON size reaches
+    ``max_bytes``, whichever comes first; the size per row is sampled rather
+    than measured for every row. In adaptive mode the target grows by a
+    quarter after a full batch that was answered 2xx within ``slow_seconds``
+    while the recent error rate is low, shrinks by a fifth on slow answers,
+    halves on 5xx or a request error, and drops to half the rejected batch on
+    413, which also caps the target below that batch. The learned target is
+    stored per script for the next run.
+    """
+
+    SAMPLE_EVERY = 16
+
+    def __init__(
+        self,
+        target: int,
+        min_rows: int = 1,
+        max_rows: int = 0,
+        max_bytes: int = 0,
+        slow_seconds: float = 0.0,
+        adaptive: bool = False,
+    ) -> None:
+        self.min_rows = max(1, min_rows)
+        self.max_rows = max(self.min_rows, max_rows or target)
+        self.target = min(self.max_rows, max(self.min_rows, target))
+        self.max_bytes = max_bytes
+        self.slow_seconds = slow_seconds
+        self.adaptive = adaptive
+        self.initial = self.target
+        self.error_rate = 0.0
+        self.bytes_per_row = 0.0
+        self._seen = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: dict[str, Any], script: str) -> "BatchSizer":
+        if not config["post_batch_adaptive"]:
+            return cls(max(1, config["post_batch_size"]), max_bytes=config["post_batch_max_bytes"])
+        learned = (read_json_file(config["batch_sizes_path"]) or {}).get(script)
+        return cls(
+            int(learned or config["post_batch_size"]),
+            config["post_batch_min_rows"],
+            config["post_batch_max_rows"],
+            config["post_batch_max_bytes"],
+            config["post_batch_target_ms"] / 1000,
+            adaptive=True,
+        )
+
+    def measure(self, body: dict[str, Any]) -> None:
+        if not self.max_bytes:
+            return
+        self._seen += 1
+        if self._seen > 4 and self._seen % self.SAMPLE_EVERY:
+            return
+        size = len(json.dumps(body, ensure_ascii=False, default=str).encode("utf-8"))
+        weight = 1.0 if self._seen == 1 else 0.2
+        self.bytes_per_row += weight * (size - self.bytes_per_row)
+
+    def is_full(self, rows: int) -> bool:
+        if rows >= self.target:
+            return True
+        return bool(self.max_bytes) and rows * self.bytes_per_row >= self.max_bytes
+
+    def observe(self, rows: int, status: int | None, elapsed: float) -> None:
+        if not self.adaptive:
+            return
+        failed = status is None or status == 413 or status >= 500
+        with self._lock:
+            self.error_rate += 0.2 * ((1.0 if failed else 0.0) - self.error_rate)
+            if status == 413:
+                # Never grow back to a size the endpoint refused.
+                self.max_rows = max(self.min_rows, min(self.max_rows, rows - 1))
+                target = min(self.target, rows) // 2
+            elif failed:
+                target = self.target // 2
+            elif status >= 300:
+                # Content errors (400/422) say nothing about the size.
+                return
+            elif elapsed > self.slow_seconds:
+                target = int(self.target * 0.8)
+            elif rows >= self.target and self.error_rate < 0.05:
+                target = int(self.target * 1.25) + 1
+            else:
+                return
+            self.target = min(self.max_rows, max(self.min_rows, target))
+
+    def save(self, config: dict[str, Any], script: str) -> None:
+        if not self.adaptive or self.target == self.initial:
+            return
+        log(f"[{script}] batch target {self.initial} -> {self.target} rows")
+        with _BATCH_SIZES_LOCK:
+            sizes = read_json_file(config["batch_sizes_path"]) or {}
+            sizes[script] = self.target
+            write_json_file(config["batch_sizes_path"], sizes)
+
+
+KEY_DIRECTIVE = re.compile(
+    r"^[ \t]*--[ \t]*@key[ \t]*:?[ \t]*(?P<columns>\w[\w \t,]*?)[ \t\r]*$",
+    re.MULTILINE,
+)
+
+
+class FingerprintStore:
+    """SQLite index of (source, row key) -> content hash of delivered rows.
+
+    ``changed`` compares a row with the hash stored for its key; the key is
+    the script's ``-- @key col1,col2`` columns, or the row position when the
+    script declares none. Hashes are only written for rows that the API
+    accepted. Entries older than ``ttl_hours`` are evicted when the store is
+    closed, so every row is re-sent at least once per TTL, and freed pages
+    are returned with an incremental vacuum.
+    """
+
+    FLUSH_EVERY = 500
+
+    def __init__(
+        self,
+        path: str,
+        source: str,
+        key_columns: list[str],
+        ttl_hours: float,
+        full: bool = False,
+    ) -> None:
+        self.source = source
+        self.key_columns = key_columns
+        self.ttl_seconds = ttl_hours * 3600
+        self._pending: dict[int, tuple[str, str]] = {}
+        self._delivered: list[tuple[str, str, str, float]] = []
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS fingerprints ("
+            "source TEXT NOT NULL, row_key TEXT NOT NULL, digest TEXT NOT NULL, "
+            "seen_at REAL NOT NULL, PRIMARY KEY (source, row_key)) WITHOUT ROWID"
+        )
+        self._known: dict[str, str] = {}
+        if not full:
+            self._known = dict(
+                self._db.execute(
+                    "SELECT row_key, digest FROM fingerprints WHERE source = ?",
+                    (source,),
+                )
+            )
+
+    @classmethod
+    def for_script(
+        cls,
+        config: dict[str, Any],
+        source: str,
+        sql_text: str,
+        full: bool = False,
+    ) -> "FingerprintStore | None":
+        if not config["row_fingerprint"]:
+            return None
+        match = KEY_DIRECTIVE.search(sql_text)
+        columns = [c.strip() for c in match.group("columns").split(",") if c.strip()] if match else []
+        return cls(
+            config["fingerprint_path"],
+            source,
+            columns,
+            config["row_fingerprint_ttl_hours"],
+            full,
+        )
+
+    def changed(self, index: int, row: dict[str, Any]) -> bool:
+        if self.key_columns:
+            key = "|".join(str(row.get(column)) for column in self.key_columns)
+        else:
+            key = str(index)
+        encoded = json.dumps(row, sort_keys=True, ensure_ascii=False, default=str)
+        digest = hashlib.blake2b(encoded.encode("utf-8"), digest_size=16).hexdigest()
+        if self._known.get(key) == digest:
+            return False
+        with self._lock:
+            self._pending[index] = (key, digest)
+        return True
+
+    def mark_delivered(self, indexes: list[int]) -> None:
+        now = time.time()
+        with self._lock:
+            for index in indexes:
+                entry = self._pending.pop(index, None)
+                if entry:
+                    self._delivered.append((self.source, entry[0], entry[1], now))
+            if len(self._delivered) >= self.FLUSH_EVERY:
+                self._flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush()
+            cutoff = time.time() - self.ttl_seconds
+            with self._db:
+                evicted = self._db.execute(
+                    "DELETE FROM fingerprints WHERE source = ? AND seen_at < ?",
+                    (self.source, cutoff),
+                ).rowcount
+            if evicted:
+                self._db.execute("PRAGMA incremental_vacuum")
+            self._db.close()
+
+    def _flush(self) -> None:
+        if not self._delivered:
+            return
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO fingerprints (source, row_key, digest, seen_at) "
+                "VALUES (?, ?, ?, ?)",
+                self._delivered,
+            )
+        self._delivered = []
+
+
+def post_rows(
+    api_url: str,
+    timeout: int,
+    sync_file: str,
+    rows: Iterable[dict[str, Any]],
+    config: dict[str, Any],
+    fingerprints: "FingerprintStore | None" = None,
+) -> tuple[int, int]:
+    batch_size = max(1, config["post_batch_size"])
+    batch_url = config["api_batch_url"].strip()
+    total = f"/{len(rows)}" if isinstance(rows, Sized) else ""
+    limiter = RateLimiter.from_config(config)
+    pool = DeliveryPool(config, config["post_concurrency"], total, limiter)
+    on_delivered = fingerprints.mark_delivered if fingerprints else None
+    outbox = get_outbox(config)
+    on_failed = outbox.recorder(sync_file) if outbox else None
+    sizer: BatchSizer | None = None
+    unchanged = 0
+
+    try:
+        if batch_url and (batch_size > 1 or config["post_batch_adaptive"]):
+            sizer = BatchSizer.from_config(config, sync_file)
+            encoder = BodyEncoder.from_config(config)
+            bisect_depth = config["post_batch_bisect_depth"] if config["post_batch_bisect"] else 0
+            batch: list[tuple[int, dict[str, Any]]] = []
+            batch_datetime = ""
+            for index, row in enumerate(rows, start=1):
+                if fingerprints and not fingerprints.changed(index, row):
+                    unchanged += 1
+                    continue
+                if not batch:
+                    batch_datetime = datetime.now(timezone.utc).isoformat()
+                body = build_body(config, sync_file, row, batch_datetime)
+                if not body["hoscode"]:
+                    pool.add_failed(1)
+                    if append_error_log("post", "missing hoscode", source=sync_file, idx=index):
+                        log(f"[SKIP] missing hoscode in row idx={index}")
+                    continue
+                batch.append((index, body))
+                sizer.measure(body)
+                if not sizer.is_full(len(batch)):
+                    continue
+
+                pool.submit(
+                    len(batch),
+                    post_batch,
+                    limiter,
+                    batch_url,
+                    batch,
+                    timeout,
+                    on_delivered,
+                    on_failed,
+                    encoder,
+                    bisect_depth,
+                    config["post_batch_bisect_min_rows"],
+                    config["post_batch_format"],
+                    sizer,
+                )
+                batch = []
+
+            if batch:
+                pool.submit(
+                    len(batch),
+                    post_batch,
+                    limiter,
+                    batch_url,
+                    batch,
+                    timeout,
+                    on_delivered,
+                    on_failed,
+                    encoder,
+                    bisect_depth,
+                    config["post_batch_bisect_min_rows"],
+                    config["post_batch_format"],
+                    sizer,
+                )
+        else:
+            for index, row in enumerate(rows, start=1):
+                if fingerprints and not fingerprints.changed(index, row):
+                    unchanged += 1
+                    continue
+                hoscode = str(row.get("hoscode") or config["hoscode"]).strip()
+                if not hoscode:
+                    pool.add_failed(1)
+                    if append_error_log("post", "missing hoscode", source=sync_file, idx=index):
+                        log(f"[SKIP] missing hoscode in row idx={index}")
+                    continue
+
+                body = build_body(config, sync_file, row, datetime.now(timezone.utc).isoformat())
+                pool.submit(
+                    1,
+                    post_single,
+                    limiter,
+                    api_url,
+                    index,
+                    body,
+                    timeout,
+                    on_delivered,
+                    on_failed,
+                )
+    finally:
+        success, failed = pool.close()
+        if sizer:
+            sizer.save(config, sync_file)
+        if fingerprints:
+            fingerprints.close()
+        if outbox:
+            outbox.close()
+
+    if unchanged:
+        log(f"[{sync_file}] skipped unchanged rows: {unchanged}")
+    return success, failed
+
+
+def is_rejected(status: int | None) -> bool:
+    """True when the API refused the body itself, so sending it again cannot help."""
+    return status is not None and 400 <= status < 500 and status not in {408, 429}
+
+
+def build_body(
+    config: dict[str, Any],
+    sync_file: str,
+    row_data: dict[str, Any],
+    sync_datetime: str,
+) -> dict[str, Any]:
+    # Rows are freshly normalized dicts owned by this run, so the payload
+    # does not need a defensive copy.
+    return {
+        "hoscode": str(row_data.get("hoscode") or config["hoscode"]).strip(),
+        "source": sync_file,
+        "payload": row_data,
+        "sync_datetime": sync_datetime,
+    }
+
+
+def post_single(
+    session: requests.Session,
+    limiter: RateLimiter,
+    api_url: str,
+    index: int,
+    body: dict[str, Any],
+    timeout: int,
+    on_delivered: Callable[[list[int]], None] | None = None,
+    on_failed: Callable[[str, list[int], Any, int | None, str], None] | None = None,
+) -> tuple[int, int]:
+    hoscode = body["hoscode"]
+    status: int | None = None
+    detail = ""
+    try:
+        response = send_limited(session, limiter, api_url, json=body, timeout=timeout)
+        status = response.status_code
+        if response.status_code < 300:
+            if on_delivered:
+                on_delivered([index])
+            return 1, 0
+        detail = response.text
+        if append_error_log(
+            "post",
+            f"HTTP {response.status_code}",
+            source=body["source"],
+            idx=index,
+            hoscode=hoscode,
+            status=response.status_code,
+            body=response.text,
+        ):
+            log(f"[FAIL] idx={index} hoscode={hoscode} status={response.status_code}")
+    except requests.RequestException as error:
+        if append_error_log("post", error, source=body["source"], idx=index, hoscode=hoscode):
+            log(f"[ERROR] idx={index} hoscode={hoscode} error={error}")
+        detail = str(error)
+    if on_failed:
+        on_failed(api_url, [index], body, status, detail)
+    return 0, 1
+
+
+# Statuses where the batch content was refused, so a smaller batch may pass.
+BISECT_STATUSES = {400, 413, 422}
+# Statuses that mean the batch endpoint does not understand the columnar body.
+# 400/422 are left out: they also mean "a bad row", which bisecting handles.
+FORMAT_REJECT_STATUSES = {415}
+# Batch format confirmed per batch URL ("columnar" once accepted, "rows" after a refusal).
+_BATCH_FORMATS: dict[str, str] = {}
+
+
+def columnar_batch(bodies: list[dict[str, Any]]) -> dict[str, Any]:
+    """Hoist the envelope and column names out of a list of row bodies.
+
+    Column order is the SQL result order (the cursor's description, which
+    the row dicts preserve). ``hoscode`` is only hoisted when every row
+    shares it; otherwise it is null and the receiver reads the column.
+    """
+    first = bodies[0]
+    columns = list(first["payload"])
+    hoscodes = {body["hoscode"] for body in bodies}
+    return {
+        "format": "columnar",
+        "hoscode": first["hoscode"] if len(hoscodes) == 1 else None,
+        "source": first["source"],
+        "sync_datetime": first["sync_datetime"],
+        "columns": columns,
+        "rows": [[body["payload"].get(column) for column in columns] for body in bodies],
+    }
+
+
+def post_batch(
+    session: requests.Session,
+    limiter: RateLimiter,
+    batch_url: str,
+    batch: list[tuple[int, dict[str, Any]]],
+    timeout: int,
+    on_delivered: Callable[[list[int]], None] | None = None,
+    on_failed: Callable[[str, list[int], Any, int | None, str], None] | None = None,
+    encoder: BodyEncoder | None = None,
+    bisect_depth: int = 0,
+    bisect_min_rows: int = 1,
+    batch_format: str = "rows",
+    sizer: BatchSizer | None = None,
+    bisect_stop: threading.Event | None = None,
+) -> tuple[int, int]:
+    """POST one batch; returns (success, failed) row counts.
+
+    When the endpoint rejects the batch itself (400/413/422) and
+    ``bisect_depth`` allows it, the batch is split in half and each half is
+    sent again, down to ``bisect_min_rows`` rows, so only the offending rows
+    end up failed and logged. Once both halves of a split deliver nothing,
+    the endpoint most likely rejects every row (e.g. after a schema change):
+    ``bisect_stop`` is set and the rest of the original batch is sent
+    without further splitting, so such a batch costs about two requests per
+    level instead of one per row. Every request outcome is reported to
+    ``sizer``.
+    """
+    bodies = [body for _, body in batch]
+    columnar = batch_format == "columnar" and _BATCH_FORMATS.get(batch_url) != "rows"
+    started = time.monotonic()
+    status: int | None = None
+    detail = ""
+    try:
+        payload = columnar_batch(bodies) if columnar else bodies
+        if encoder is None:
+            response = send_limited(session, limiter, batch_url, json=payload, timeout=timeout)
+        else:
+            data, headers = encoder.encode(payload)
+            response = send_limited(
+                session,
+                limiter,
+                batch_url,
+                data=data,
+                headers=headers,
+                timeout=timeout,
+            )
+        status = response.status_code
+        if sizer:
+            sizer.observe(len(batch), response.status_code, time.monotonic() - started)
+        if response.status_code < 300:
+            if columnar:
+                _BATCH_FORMATS[batch_url] = "columnar"
+            if on_delivered:
+                on_delivered([index for index, _ in batch])
+            return len(bodies), 0
+        if (
+            columnar
+            and batch_url not in _BATCH_FORMATS
+            and response.status_code in FORMAT_REJECT_STATUSES
+        ):
+            # 415 before any columnar batch was accepted: the endpoint does
+            # not support the format, so use the row format from now on.
+            log(f"[FORMAT] {batch_url} refused columnar batch status={response.status_code}, using rows")
+            _BATCH_FORMATS[batch_url] = "rows"
+            return post_batch(
+                session,
+                limiter,
+                batch_url,
+                batch,
+                timeout,
+                on_delivered,
+                on_failed,
+                encoder,
+                bisect_depth,
+                bisect_min_rows,
+                "rows",
+                sizer,
+                bisect_stop,
+            )
+        if (
+            response.status_code in BISECT_STATUSES
+            and bisect_depth > 0
+            and len(batch) > max(1, bisect_min_rows)
+            and not (bisect_stop and bisect_stop.is_set())
+        ):
+            log(
+                f"[SPLIT] batch idx={batch[0][0]}-{batch[-1][0]} "
+                f"status={response.status_code} rows={len(batch)}"
+            )
+            bisect_stop = bisect_stop or threading.Event()
+            middle = len(batch) // 2
+            counts = [
+                post_batch(
+                    session,
+                    limiter,
+                    batch_url,
+                    half,
+                    timeout,
+                    on_delivered,
+                    on_failed,
+                    encoder,
+                    bisect_depth - 1,
+                    bisect_min_rows,
+                    batch_format,
+                    sizer,
+                    bisect_stop,
+                )
+                for half in (batch[:middle], batch[middle:])
+            ]
+            if not counts[0][0] and not counts[1][0] and not bisect_stop.is_set():
+                log(f"[SPLIT] both halves of idx={batch[0][0]}-{batch[-1][0]} failed, no further splits")
+                bisect_stop.set()
+            return counts[0][0] + counts[1][0], counts[0][1] + counts[1][1]
+        detail = response.text
+        if append_error_log(
+            "post",
+            f"HTTP {response.status_code}",
+            source=bodies[0]["source"],
+            idx=f"{batch[0][0]}-{batch[-1][0]}",
+            rows=len(batch),
+            status=response.status_code,
+            body=response.text,
+        ):
+            log(f"[FAIL] batch idx={batch[0][0]}-{batch[-1][0]} status={response.status_code}")
+    except requests.RequestException as error:
+        if sizer:
+            sizer.observe(len(batch), None, time.monotonic() - started)
+        if append_error_log(
+            "post",
+            error,
+            source=bodies[0]["source"],
+            idx=f"{batch[0][0]}-{batch[-1][0]}",
+            rows=len(batch),
+        ):
+            log(f"[ERROR] batch idx={batch[0][0]}-{batch[-1][0]} error={error}")
+        detail = str(error)
+    if on_failed:
+        on_failed(batch_url, [index for index, _ in batch], bodies, status, detail)
+    return 0, len(bodies)
+
+
+class Outbox:
+    """Append-only, segmented store of request bodies that failed to POST.
+
+    Records are JSON lines holding the target URL, the ``source`` script, the
+    row indexes and the exact body that was sent. Writes are fsynced every
+    ``fsync_every`` records and on ``flush``. A segment is sealed once it
+    reaches ``segment_bytes``; when all segments exceed ``max_bytes`` the
+    oldest ones are dropped (and logged) so an outage cannot fill the disk.
+    ``replay`` drains sealed segments and compacts them: delivered records
+    are gone, and records that still fail are appended to a fresh segment
+    behind the other segments. Records the API rejects (4xx) are moved to
+    ``dead-letter.jsonl`` so they cannot block the queue; so are records the
+    API answered 408/429 ``max_attempts`` times. Connection errors and 5xx
+    are an outage, not a verdict on the record, so they are not counted and
+    stop the pass.
+    """
+
+    ABANDONED_AFTER = 3600
+    DEAD_LETTER_NAME = "dead-letter.jsonl"
+    RESPONSE_TEXT_LIMIT = 2000
+
+    def __init__(
+        self,
+        directory: str,
+        segment_bytes: int,
+        max_bytes: int,
+        fsync_every: int,
+        max_attempts: int = 0,
+    ) -> None:
+        self.directory = directory
+        self.max_attempts = max_attempts
+        self.segment_bytes = max(1024, segment_bytes)
+        self.max_bytes = max(self.segment_bytes, max_bytes)
+        self.fsync_every = max(1, fsync_every)
+        self._file: Any = None
+        self._path = ""
+        self._unsynced = 0
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._dead_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def recorder(self, source: str) -> Callable[[str, list[int], Any, int | None, str], None]:
+        """Callback for failed POSTs: rejected bodies are dead-lettered, others kept for replay."""
+        def record(url: str, indexes: list[int], body: Any, status: int | None, detail: str) -> None:
+            entry = {"url": url, "source": source, "indexes": indexes, "body": body}
+            if not is_rejected(status):
+                self.append(entry)
+                return
+            entry.update(ts=time.time(), attempts=0, last_error=f"HTTP {status}")
+            entry["response"] = clip_text(detail, self.RESPONSE_TEXT_LIMIT)
+            self._write_dead_letter([entry])
+
+        return record
+
+    def append(self, record: dict[str, Any]) -> None:
+        record.setdefault("ts", time.time())
+        with self._lock:
+            self._write(record)
+
+    def flush(self) -> None:
+        with self._lock:
+            self._sync()
+
+    def close(self) -> None:
+        """Seal the open segment so the next replay picks it up right away."""
+        with self._lock:
+            self._seal()
+
+    def pending_segments(self) -> list[str]:
+        names = sorted(
+            name for name in os.listdir(self.directory)
+            if name.startswith("segment-") and name.endswith(".jsonl")
+        )
+        return [os.path.join(self.directory, name) for name in names]
+
+    def replay(self, config: dict[str, Any]) -> tuple[int, int]:
+        """POST stored records again.
+
+        A pass stops at the first connection error or 5xx: the rest of that
+        segment is kept unsent and moves to the back of the queue.
+        """
+        if not self._replay_lock.acquire(blocking=False):
+            return 0, 0
+        # cron runs one process per script, so replays are also locked on disk.
+        lock_file = open(os.path.join(self.directory, ".replay.lock"), "w")
+        try:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return 0, 0
+            with self._lock:
+                self._seal()
+            self._seal_abandoned()
+            delivered = 0
+            remaining = 0
+            for path in self.pending_segments():
+                ok, still_failed, down = self._replay_segment(config, path)
+                delivered += ok
+                remaining += still_failed
+                if down:
+                    log("[outbox] API unavailable, replay paused")
+                    break
+            if delivered or remaining:
+                log(f"[outbox] replay delivered={delivered} still_failed={remaining}")
+            return delivered, remaining
+        finally:
+            lock_file.close()
+            self._replay_lock.release()
+
+    def _replay_segment(self, config: dict[str, Any], path: str) -> tuple[int, int, bool]:
+        """Replay one sealed segment; returns (delivered, still pending, API down)."""
+        records: list[dict[str, Any]] = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # torn last line after a crash
+                    continue
+        survivors: list[dict[str, Any]] = []
+        dead: list[dict[str, Any]] = []
+        survivors_lock = threading.Lock()
+        down = threading.Event()
+        timeout = config["request_timeout"]
+        limiter = RateLimiter.from_config(config)
+        pool = DeliveryPool(config, config["outbox_replay_concurrency"], "", limiter)
+
+        def replay_record(session: requests.Session, record: dict[str, Any]) -> tuple[int, int]:
+            status: int | None = None
+            if not down.is_set():
+                try:
+                    response = send_limited(session, limiter, record["url"], json=record["body"], timeout=timeout)
+                    status = response.status_code
+                    if status < 300:
+                        return 1, 0
+                    record["last_error"] = f"HTTP {status}"
+                    record["response"] = clip_text(response.text, self.RESPONSE_TEXT_LIMIT)
+                except requests.RequestException as error:
+                    record["last_error"] = str(error)
+                if status is None or status >= 500:
+                    down.set()
+                else:
+                    record["attempts"] = record.get("attempts", 0) + 1
+            given_up = is_rejected(status) or (
+                status is not None and 0 < self.max_attempts <= record.get("attempts", 0)
+            )
+            with survivors_lock:
+                (dead if given_up else survivors).append(record)
+            return 0, 1
+
+        for record in records:
+            pool.submit(1, replay_record, record)
+        delivered, _ = pool.close()
+
+        if dead:
+            self._dead_letter(dead)
+        with self._lock:
+            for record in survivors:
+                self._write(record)
+            self._sync()
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+        return delivered, len(survivors), down.is_set()
+
+    def _dead_letter(self, records: list[dict[str, Any]]) -> None:
+        self._write_dead_letter(records)
+        for record in records:
+            append_error_log(
+                "outbox",
+                f"gave up: {record.get('last_error', '')}",
+                source=record.get("source"),
+                attempts=record.get("attempts", 0),
+            )
+        log(f"[outbox] moved {len(records)} records to {self.DEAD_LETTER_NAME}")
+
+    def _write_dead_letter(self, records: list[dict[str, Any]]) -> None:
+        path = os.path.join(self.directory, self.DEAD_LETTER_NAME)
+        with self._dead_lock, open(path, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _write(self, record: dict[str, Any]) -> None:
+        if self._file is None:
+            self._open_segment()
+        self._file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every:
+            self._sync()
+        if self._file.tell() >= self.segment_bytes:
+            self._seal()
+            self._enforce_limit()
+
+    def _open_segment(self) -> None:
+        name = f"segment-{time.time_ns():020d}.jsonl.open"
+        self._path = os.path.join(self.directory, name)
+        self._file = open(self._path, "a", encoding="utf-8")
+
+    def _sync(self) -> None:
+        if self._file is None or not self._unsynced:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def _seal(self) -> None:
+        if self._file is None:
+            return
+        self._sync()
+        self._file.close()
+        self._file = None
+        # Only sealed segments (without the .open suffix) are replayed.
+        os.replace(self._path, self._path[: -len(".open")])
+
+    def _seal_abandoned(self) -> None:
+        # Open segments left behind by a process that died mid-run.
+        cutoff = time.time() - self.ABANDONED_AFTER
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".jsonl.open") and path != self._path:
+                with contextlib.suppress(OSError):
+                    if os.path.getmtime(path) < cutoff:
+                        os.replace(path, path[: -len(".open")])
+
+    def _enforce_limit(self) -> None:
+        segments = self.pending_segments()
+        total = sum(os.path.getsize(path) for path in segments)
+        while segments and total > self.max_bytes:
+            oldest = segments.pop(0)
+            size = os.path.getsize(oldest)
+            os.remove(oldest)
+            total -= size
+            append_error_log("outbox", "size limit reached", dropped=os.path.basename(oldest))
+            log(f"[outbox] size limit reached, dropped {os.path.basename(oldest)}")
+
+
+_OUTBOXES: dict[str, Outbox] = {}
+_OUTBOXES_LOCK = threading.Lock()
+
+
+def get_outbox(config: dict[str, Any]) -> Outbox | None:
+    if not config["outbox"]:
+        return None
+    directory = config["outbox_dir"]
+    with _OUTBOXES_LOCK:
+        outbox = _OUTBOXES.get(directory)
+        if outbox is None:
+            outbox = Outbox(
+                directory,
+                config["outbox_segment_bytes"],
+                config["outbox_max_bytes"],
+                config["outbox_fsync_every"],
+                config["outbox_max_attempts"],
+            )
+            _OUTBOXES[directory] = outbox
+        return outbox
+
+
+def start_outbox_replayer(config: dict[str, Any]) -> threading.Thread | None:
+    outbox = get_outbox(config)
+    if outbox is None:
+        return None
+    interval = max(1, config["outbox_replay_interval"])
+
+    def loop() -> None:
+        while True:
+            time.sleep(interval)
+            try:
+                outbox.replay(config)
+            except Exception as error:
+                append_error_log("outbox", error, stage="replay")
+                log(f"[outbox] replay error={error}")
+
+    thread = threading.Thread(target=loop, name="outbox-replay", daemon=True)
+    thread.start()
+    return thread
+
+
+CRON_FIELD_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+
+def parse_cron_field(field: str, low: int, high: int) -> set[int]:
+    values: set[int] = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step_text = part.split("/", 1)
+            step = int(step_text)
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start_text, end_text = part.split("-", 1)
+            start, end = int(start_text), int(end_text)
+        else:
+            start = end = int(part)
+            if step > 1:
+                end = high
+        if start < low or end > high or step < 1:
+            raise ValueError(f"cron field out of range: {field}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronJob:
+    def __init__(self, spec: list[str], sync_file: str) -> None:
+        self.sync_file = sync_file
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            parse_cron_field(field, low, high)
+            for field, (low, high) in zip(spec, CRON_FIELD_RANGES)
+        )
+        # cron accepts both 0 and 7 for Sunday
+        self.weekdays = {day % 7 for day in weekdays}
+        self.any_day = spec[2] == "*"
+        self.any_weekday = spec[4] == "*"
+
+    def matches(self, moment: datetime) -> bool:
+        if moment.minute not in self.minutes or moment.hour not in self.hours:
+            return False
+        if moment.month not in self.months:
+            return False
+        day_ok = moment.day in self.days
+        weekday_ok = (moment.isoweekday() % 7) in self.weekdays
+        # Standard cron: when both day fields are restricted either may match.
+        if self.any_day or self.any_weekday:
+            return day_ok and weekday_ok
+        return day_ok or weekday_ok
+
+
+def load_schedule(path: str) -> list[CronJob]:
+    """Read sync jobs from a cron.d file; other commands (logrotate, --replay-outbox) are ignored."""
+    jobs: list[CronJob] = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#") or re.match(r"^\w+=", line):
+                continue
+            fields = line.split()
+            if len(fields) < 7:
+                continue
+            # cron.d lines carry a user column: m h dom mon dow user command...
+            command = fields[6:]
+            script = next((i for i, arg in enumerate(command) if arg.endswith("sync_client.py")), None)
+            if script is None or script + 1 >= len(command) or command[script + 1].startswith("-"):
+                continue
+            jobs.append(CronJob(fields[:5], command[script + 1]))
+    return jobs
+
+
+def run_sync_file(
+    config: dict[str, Any],
+    sync_file: str,
+    dry_run: bool,
+    full: bool = False,
+) -> int:
+    targets = get_his_targets(config)
+    if targets:
+        return targets.run(
+            sync_file.strip(),
+            lambda target: run_tracked(
+                target,
+                sync_file.strip(),
+                dry_run,
+                lambda: _run_sync_file(target, sync_file, dry_run, full),
+            ),
+        )
+    record = run_tracked(
+        config,
+        sync_file.strip(),
+        dry_run,
+        lambda: _run_sync_file(config, sync_file, dry_run, full),
+    )
+    return record["exit_code"]
+
+
+def run_tracked(
+    config: dict[str, Any],
+    source: str,
+    dry_run: bool,
+    run: Callable[[], int],
+) -> dict[str, Any]:
+    """Call ``run`` under a fresh ``RunMetrics`` and return the run record.
+
+    Runs against one of several HIS targets are recorded as
+    ``<source>@<target>``.
+    """
+    if config.get("target"):
+        source = f"{source}@{config['target']}"
+    metrics = RunMetrics(source)
+    exit_code = 1
+    with use_metrics(metrics):
+        try:
+            exit_code = run()
+        finally:
+            record = metrics.record(exit_code)
+            if not dry_run:
+                write_run_metrics(config, record)
+    return record
+
+
+def _run_sync_file(
+    config: dict[str, Any],
+    sync_file: str,
+    dry_run: bool,
+    full: bool,
+) -> int:
+    sync_scripts_url = config["sync_scripts_url"].strip()
+    if not sync_scripts_url:
+        raise ValueError("SYNC_SCRIPTS_URL is required")
+
+    with current_metrics().phase("script"):
+        effective_file, sql_text, is_active = fetch_sql_from_endpoint(
+            config,
+            sync_scripts_url,
+            sync_file,
+        )
+
+    if not sql_text.strip():
         log(f"[{effective_file}] ไม่พบ script นี้บน server")
         return 0
 
@@ -403,7 +2986,514 @@ def main() -> int:
         log(f"[{effective_file}] skip activate=False")
         return 0
 
-    return run_single_sync(config, effective_file, sql_text, args.dry_run)
+    sql_text, watermark = bind_watermark(config, effective_file, sql_text, full)
+    return run_single_sync(config, effective_file, sql_text, dry_run, watermark, full)
+
+
+# Batch size assumed by --profile when batch posting is not configured.
+PROFILE_BATCH_ROWS = 500
+
+
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+def print_result_table(description: Any, rows: Iterable[tuple[Any, ...]]) -> None:
+    names = [column[0] for column in description or []]
+    cells = [["NULL" if value is None else str(value) for value in row] for row in rows]
+    widths = [max([len(name)] + [len(row[i]) for row in cells]) for i, name in enumerate(names)]
+    print("  " + "  ".join(name.ljust(width) for name, width in zip(names, widths)))
+    for row in cells:
+        print("  " + "  ".join(value.ljust(width) for value, width in zip(row, widths)))
+
+
+def profile_sync(
+    config: dict[str, Any],
+    sync_file: str,
+    full: bool = False,
+    analyze: bool = False,
+) -> int:
+    """Print the plan, phase timings and payload size of one script; posts nothing.
+
+    The script is bound like a real run (watermark, whole shard range) and
+    executed once under the HIS governor. ``analyze`` also runs EXPLAIN
+    ANALYZE (MariaDB: ANALYZE), which executes the query a second time.
+    Body sizes are measured on the real rows: single bodies as
+    ``requests`` serializes them, batches closed the way ``post_rows``
+    closes them, and their gzip/zstd size. The projected delivery time is
+    requests divided by the starting POST rate and excludes HTTP latency.
+    """
+    sync_scripts_url = config["sync_scripts_url"].strip()
+    if not sync_scripts_url:
+        raise ValueError("SYNC_SCRIPTS_URL is required")
+    effective_file, sql_text, is_active = fetch_sql_from_endpoint(config, sync_scripts_url, sync_file)
+    if not sql_text.strip():
+        log(f"[{effective_file}] ไม่พบ script นี้บน server")
+        return 1
+    sql_text, watermark = bind_watermark(config, effective_file, sql_text, full)
+    plan = ShardPlan.from_sql(sql_text, effective_file)
+    if plan:
+        sql_text = plan.bind(sql_text, plan.ranges[0][0], None)
+
+    target = f" on {config['target']}" if config.get("target") else ""
+    print(f"== {effective_file}{target} (activate={is_active})")
+    if watermark:
+        print(f"watermark: {watermark.column} > {watermark.last if watermark.last is not None else 'initial'}")
+    if plan:
+        print(f"shard: {plan.column} in {len(plan.ranges)} ranges, profiled as one query")
+
+    governor = get_his_governor(config)
+    with governor.query(effective_file) as probe:
+        connection = acquire_connection(config)
+        reusable = False
+        try:
+            probe.begin(connection)
+            with connection.cursor(pymysql.cursors.Cursor) as cursor:
+                cursor.execute(f"EXPLAIN {sql_text}")
+                print("\nEXPLAIN")
+                print_result_table(cursor.description, cursor.fetchall())
+                if analyze:
+                    mariadb = "mariadb" in connection.get_server_info().lower()
+                    keyword = "ANALYZE" if mariadb else "EXPLAIN ANALYZE"
+                    print(f"\n{keyword}")
+                    try:
+                        cursor.execute(f"{keyword} {sql_text}")
+                        print_result_table(cursor.description, cursor.fetchall())
+                    except pymysql.MySQLError as error:
+                        print(f"  not available: {error}")
+                started = time.perf_counter()
+                cursor.execute(sql_text)
+                execute_seconds = time.perf_counter() - started
+                started = time.perf_counter()
+                tuple_rows = cursor.fetchall()
+                fetch_seconds = time.perf_counter() - started
+                converter = RowConverter.from_cursor(cursor)
+            probe.end(len(tuple_rows))
+            reusable = True
+        finally:
+            release_connection(config, connection, reusable)
+    started = time.perf_counter()
+    rows = converter.convert(tuple_rows)
+    normalize_seconds = time.perf_counter() - started
+    del tuple_rows
+
+    print("\ntimings")
+    print(f"  execute    {execute_seconds:8.3f}s")
+    print(f"  fetch      {fetch_seconds:8.3f}s")
+    print(f"  normalize  {normalize_seconds:8.3f}s")
+    print(f"  rows       {len(rows):8d}")
+
+    sync_datetime = datetime.now(timezone.utc).isoformat()
+    bodies = [build_body(config, effective_file, row, sync_datetime) for row in rows]
+    missing = sum(1 for body in bodies if not body["hoscode"])
+    bodies = [body for body in bodies if body["hoscode"]]
+    if missing:
+        print(f"  skipped    {missing:8d} rows without hoscode")
+    if not bodies:
+        return 0
+
+    # requests serializes json= bodies with the stdlib defaults.
+    single_bytes = sum(len(json.dumps(body).encode("utf-8")) for body in bodies)
+
+    batch_mode = bool(config["api_batch_url"]) and (
+        config["post_batch_size"] > 1 or config["post_batch_adaptive"]
+    )
+    if batch_mode:
+        sizer = BatchSizer.from_config(config, effective_file)
+    else:
+        sizer = BatchSizer(PROFILE_BATCH_ROWS, max_bytes=config["post_batch_max_bytes"])
+    batches: list[list[dict[str, Any]]] = [[]]
+    for body in bodies:
+        if sizer.is_full(len(batches[-1])):
+            batches.append([])
+        batches[-1].append(body)
+        sizer.measure(body)
+    compact = BodyEncoder("", 0, 0)
+    gzip_level = config["post_wire_level"] if config["post_wire_encoding"] == "gzip" else 0
+    compressors: dict[str, Callable[[bytes], bytes]] = {
+        "gzip": lambda data: gzip.compress(data, compresslevel=gzip_level or BodyEncoder.DEFAULT_LEVELS["gzip"]),
+    }
+    if zstandard is not None:
+        zstd_level = config["post_wire_level"] if config["post_wire_encoding"] == "zstd" else 0
+        zstd = zstandard.ZstdCompressor(level=zstd_level or BodyEncoder.DEFAULT_LEVELS["zstd"])
+        compressors["zstd"] = zstd.compress
+    batch_bytes = 0
+    compressed_bytes = dict.fromkeys(compressors, 0)
+    for batch in batches:
+        payload = columnar_batch(batch) if config["post_batch_format"] == "columnar" else batch
+        data = compact.encode(payload)[0] if config["post_wire_encoding"] else json.dumps(payload).encode("utf-8")
+        batch_bytes += len(data)
+        for name, compress in compressors.items():
+            compressed_bytes[name] += len(compress(data))
+
+    count = len(bodies)
+    print("\npayload")
+    print(f"  single           {format_bytes(single_bytes / count):>10}/row {format_bytes(single_bytes):>10} total")
+    label = "batch" if batch_mode else f"batch (off, {PROFILE_BATCH_ROWS} rows)"
+    print(
+        f"  {label:<16} {format_bytes(batch_bytes / count):>10}/row {format_bytes(batch_bytes):>10} total"
+        f"  {len(batches)} requests of up to {max(len(batch) for batch in batches)} rows"
+        f" ({config['post_batch_format']})"
+    )
+    for name, size in compressed_bytes.items():
+        print(f"  batch + {name:<8} {format_bytes(size / count):>10}/row {format_bytes(size):>10} total")
+
+    limiter = RateLimiter.from_config(config)
+    requests_needed = len(batches) if batch_mode else count
+    print("\nprojected delivery (rate limit only, excludes HTTP latency)")
+    print(
+        f"  {requests_needed} {'batch' if batch_mode else 'single'} requests at {limiter.rate:.2f} req/s"
+        f" = {requests_needed / limiter.rate:.1f}s"
+    )
+    if limiter.adaptive and limiter.max_rate > limiter.rate:
+        print(f"  down to {requests_needed / limiter.max_rate:.1f}s if the rate grows to {limiter.max_rate:.2f} req/s")
+    if not batch_mode:
+        print(f"  with batches: {len(batches)} requests = {len(batches) / limiter.rate:.1f}s")
+    return 0
+
+
+def select_index_scripts(scripts: dict[str, Any], pattern: str | None) -> list[tuple[str, str]]:
+    """Active ``<number>_sync_*.sql`` entries of the index, optionally filtered by a glob."""
+    selected = []
+    for name, entry in sorted(scripts.items()):
+        if not isinstance(entry, dict) or not re.match(r"^\d+_sync_", name):
+            continue
+        if pattern and not fnmatch.fnmatch(name, pattern):
+            continue
+        sql_text = str(entry.get("sql", ""))
+        if bool(entry.get("activate", False)) and sql_text.strip():
+            selected.append((name, sql_text))
+    return selected
+
+
+def run_all(
+    config: dict[str, Any],
+    pattern: str | None,
+    dry_run: bool,
+    full: bool = False,
+) -> int:
+    """Run every active script of the index concurrently and print one summary.
+
+    The index is fetched once and its SQL is used as is. Up to
+    ``all_db_concurrency`` scripts query the HIS and up to
+    ``all_http_concurrency`` scripts post at the same time. With several HIS
+    targets every target runs its own ``--all``.
+    """
+    targets = get_his_targets(config)
+    if targets:
+        return targets.run(
+            "all",
+            lambda target: {"exit_code": run_all(target, pattern, dry_run, full), "counters": {}},
+        )
+    sync_scripts_url = config["sync_scripts_url"].strip()
+    if not sync_scripts_url:
+        raise ValueError("SYNC_SCRIPTS_URL is required")
+    scripts = select_index_scripts(fetch_scripts_index(config, sync_scripts_url), pattern)
+    if not scripts:
+        log(f"[all] no active scripts match {pattern or '*'}")
+        return 0
+
+    db_limit = max(1, config["all_db_concurrency"])
+    http_limit = max(1, config["all_http_concurrency"])
+    gates = RunGates(db_limit, http_limit)
+    log(f"[all] running {len(scripts)} scripts db_concurrency={db_limit} http_concurrency={http_limit}")
+
+    def run_script(name: str, sql_text: str) -> dict[str, Any]:
+        def run() -> int:
+            bound_sql, watermark = bind_watermark(config, name, sql_text, full)
+            return run_single_sync(config, name, bound_sql, dry_run, watermark, full, gates)
+
+        try:
+            return run_tracked(config, name, dry_run, run)
+        except Exception as error:
+            append_error_log("all", error, source=name)
+            log(f"[all] [{name}] error={error}")
+            return {"source": name, "exit_code": 1, "elapsed": 0.0, "counters": {}, "error": str(error)}
+
+    started = time.monotonic()
+    # One worker per slot lets a script wait for an HTTP slot while another
+    # one already uses the freed DB slot.
+    with ThreadPoolExecutor(max_workers=db_limit + http_limit, thread_name_prefix="all") as executor:
+        records = list(executor.map(lambda item: run_script(*item), scripts))
+
+    failed_scripts = [record for record in records if record["exit_code"] != 0]
+    log(
+        f"[all] summary scripts={len(records)} ok={len(records) - len(failed_scripts)} "
+        f"failed={len(failed_scripts)} elapsed={time.monotonic() - started:.1f}s"
+    )
+    for record in records:
+        counters = record["counters"]
+        detail = record.get("error") or (
+            f"success={counters.get('rows_success', 0)} failed={counters.get('rows_failed', 0)}"
+        )
+        log(f"[all]   {record['source']} exit={record['exit_code']} {detail} elapsed={record['elapsed']:.1f}s")
+    return 1 if failed_scripts else 0
+
+
+# HIS_TARGETS_FILE entry keys and the config keys they override.
+TARGET_KEYS = {
+    "host": "db_host",
+    "port": "db_port",
+    "user": "db_user",
+    "password": "db_password",
+    "database": "db_name",
+    "charset": "db_charset",
+    "pool_size": "db_pool_size",
+    "hoscode": "hoscode",
+}
+
+
+class HisTargets:
+    """Several HIS databases served by one process.
+
+    Each entry of ``HIS_TARGETS_FILE`` gets its own config copy with its DB
+    credentials and hoscode, its own connection pool, HIS governor slots and
+    watermark/fingerprint/load state under ``state/targets/<name>``; the HTTP
+    session, script cache, outbox and metrics stay shared. A job runs on
+    every target through that target's ``workers`` threads, and at most
+    ``his_targets_concurrency`` target jobs run at once overall.
+    """
+
+    def __init__(self, config: dict[str, Any], entries: list[dict[str, Any]]) -> None:
+        self.configs: list[dict[str, Any]] = []
+        self._executors: dict[str, ThreadPoolExecutor] = {}
+        self._slots = threading.BoundedSemaphore(max(1, config["his_targets_concurrency"]))
+        session = get_session(config)
+        for entry in entries:
+            name = str(entry.get("name", "")).strip()
+            if not re.fullmatch(r"[A-Za-z0-9_.-]+", name) or name in self._executors:
+                raise ValueError(f"HIS target needs a unique name of letters, digits, '_', '.' or '-': {entry}")
+            target = dict(config)
+            for key, config_key in TARGET_KEYS.items():
+                if key in entry:
+                    target[config_key] = type(config[config_key])(entry[key])
+            state_dir = os.path.join(config["state_dir"], "targets", name)
+            target["target"] = name
+            target["state_dir"] = state_dir
+            target["watermark_path"] = os.path.join(state_dir, "watermarks.json")
+            target["fingerprint_path"] = os.path.join(state_dir, "fingerprints.sqlite3")
+            target["his_stats_path"] = os.path.join(state_dir, "his_load.json")
+            target["batch_sizes_path"] = os.path.join(state_dir, "batch_sizes.json")
+            with _SESSIONS_LOCK:
+                _SESSIONS[id(target)] = session
+            self.configs.append(target)
+            self._executors[name] = ThreadPoolExecutor(
+                max_workers=max(1, int(entry.get("workers", config["his_target_workers"]))),
+                thread_name_prefix=f"target-{name}",
+            )
+
+    @classmethod
+    def load(cls, config: dict[str, Any]) -> "HisTargets":
+        path = config["his_targets_file"]
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, json.JSONDecodeError) as error:
+            raise ValueError(f"cannot read HIS_TARGETS_FILE {path}: {error}") from error
+        if not isinstance(entries, list) or not entries:
+            raise ValueError(f"HIS_TARGETS_FILE {path} must hold a non-empty JSON list")
+        return cls(config, entries)
+
+    def run(self, label: str, job: Callable[[dict[str, Any]], dict[str, Any]]) -> int:
+        """Run ``job`` on every target, log one line per target and return 0 or 1.
+
+        ``job`` returns a run record; only ``exit_code`` and ``counters`` are
+        read from it.
+        """
+
+        def run_target(target: dict[str, Any]) -> dict[str, Any]:
+            with self._slots:
+                started = time.monotonic()
+                _LOG_CONTEXT.tag = f"[{target['target']}] "
+                try:
+                    record = job(target)
+                except Exception as error:
+                    append_error_log("target", error, target=target["target"], source=label)
+                    record = {"exit_code": 1, "counters": {}, "error": str(error)}
+                finally:
+                    _LOG_CONTEXT.tag = ""
+                return {**record, "elapsed": time.monotonic() - started}
+
+        started = time.monotonic()
+        futures = [
+            (target, self._executors[target["target"]].submit(run_target, target))
+            for target in self.configs
+        ]
+        results = [(target, future.result()) for target, future in futures]
+        failed = [target["target"] for target, record in results if record["exit_code"] != 0]
+        log(
+            f"[targets] [{label}] targets={len(results)} ok={len(results) - len(failed)} "
+            f"failed={len(failed)} elapsed={time.monotonic() - started:.1f}s"
+        )
+        for target, record in results:
+            counters = record["counters"]
+            detail = f" {record['error']}" if record.get("error") else (
+                f" success={counters.get('rows_success', 0)} failed={counters.get('rows_failed', 0)}"
+                if counters
+                else ""
+            )
+            log(
+                f"[targets]   {target['target']} hoscode={target['hoscode'] or '-'} "
+                f"exit={record['exit_code']}{detail} elapsed={record['elapsed']:.1f}s"
+            )
+        return 1 if failed else 0
+
+
+_TARGETS: dict[int, HisTargets | None] = {}
+_TARGETS_LOCK = threading.Lock()
+
+
+def get_his_targets(config: dict[str, Any]) -> HisTargets | None:
+    """Targets of ``HIS_TARGETS_FILE``, or None for the single ``HIS_DB_*`` target."""
+    if not config["his_targets_file"] or config.get("target"):
+        return None
+    key = id(config)
+    with _TARGETS_LOCK:
+        if key not in _TARGETS:
+            _TARGETS[key] = HisTargets.load(config)
+        return _TARGETS[key]
+
+
+def run_daemon(config: dict[str, Any], schedule_path: str) -> int:
+    """Run the cron.d schedule in-process with warm HTTP and DB connections.
+
+    Jobs are started on a thread pool of ``daemon_workers``. A job that is
+    still running when its next slot comes up is skipped for that slot.
+    """
+    jobs = load_schedule(schedule_path)
+    if not jobs:
+        raise ValueError(f"no sync jobs found in schedule: {schedule_path}")
+    log(f"[daemon] loaded {len(jobs)} jobs from {schedule_path}")
+    start_outbox_replayer(config)
+    start_metrics_server(config)
+
+    running: set[str] = set()
+    running_lock = threading.Lock()
+    executor = ThreadPoolExecutor(
+        max_workers=max(1, config["daemon_workers"]),
+        thread_name_prefix="job",
+    )
+
+    def run_job(sync_file: str) -> None:
+        started = time.monotonic()
+        try:
+            code = run_sync_file(config, sync_file, False)
+            log(f"[daemon] [{sync_file}] done exit={code} elapsed={time.monotonic() - started:.1f}s")
+        except Exception as error:
+            append_error_log("daemon", error, source=sync_file)
+            log(f"[daemon] [{sync_file}] error={error}")
+        finally:
+            with running_lock:
+                running.discard(sync_file)
+
+    try:
+        next_tick = datetime.now().replace(second=0, microsecond=0)
+        while True:
+            next_tick += timedelta(minutes=1)
+            now = datetime.now()
+            if next_tick < now - timedelta(minutes=1):
+                # Clock jumped or the host was suspended: resume from now
+                # instead of replaying every missed minute.
+                next_tick = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+            time.sleep(max(0.0, (next_tick - datetime.now()).total_seconds()))
+            for job in jobs:
+                if not job.matches(next_tick):
+                    continue
+                with running_lock:
+                    if job.sync_file in running:
+                        log(f"[daemon] [{job.sync_file}] still running, skip this slot")
+                        continue
+                    running.add(job.sync_file)
+                executor.submit(run_job, job.sync_file)
+    except KeyboardInterrupt:
+        log("[daemon] stopping")
+    finally:
+        executor.shutdown(wait=True)
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Generic sync client for <number>_sync_*.sql")
+    parser.add_argument("sync_file", nargs="?", help="sync SQL file name, e.g. 0_sync_test.sql")
+    parser.add_argument("--dry-run", action="store_true", help="Print first payload without posting")
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Run the cron.d schedule in-process instead of a single file",
+    )
+    parser.add_argument("--schedule", help="cron.d file used by --daemon")
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Ignore stored watermarks and row fingerprints and resync every row",
+    )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="Run every active script from the sync scripts index concurrently",
+    )
+    parser.add_argument(
+        "--match",
+        metavar="GLOB",
+        help="Run only the active index scripts whose name matches (implies --all)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print EXPLAIN, execute/fetch/normalize timings and payload size of sync_file without posting",
+    )
+    parser.add_argument(
+        "--explain-analyze",
+        action="store_true",
+        help="With --profile, also run EXPLAIN ANALYZE (executes the query a second time)",
+    )
+    parser.add_argument(
+        "--his-stats",
+        action="store_true",
+        help="Print recorded HIS execution time and rows examined per script and exit",
+    )
+    parser.add_argument(
+        "--replay-outbox",
+        action="store_true",
+        help="POST the failed deliveries stored in the outbox again and exit",
+    )
+    args = parser.parse_args()
+
+    config = load_config()
+    if args.his_stats:
+        targets = get_his_targets(config)
+        for target in targets.configs if targets else [config]:
+            if targets:
+                print(f"== {target['target']} ({target['db_host']}/{target['db_name']})")
+            print_his_stats(target)
+        return 0
+    if args.replay_outbox:
+        outbox = get_outbox(config)
+        if outbox is None:
+            parser.error("OUTBOX is disabled")
+        _, remaining = outbox.replay(config)
+        return 0 if remaining == 0 else 1
+    if args.daemon:
+        return run_daemon(config, args.schedule or config["daemon_schedule"])
+    if args.all or args.match:
+        if args.sync_file:
+            parser.error("sync_file cannot be combined with --all/--match")
+        return run_all(config, args.match, args.dry_run, args.full)
+    if not args.sync_file:
+        parser.error("sync_file is required unless --daemon, --all or --replay-outbox is given")
+    if args.profile:
+        targets = get_his_targets(config)
+        codes = [
+            profile_sync(target, args.sync_file, args.full, args.explain_analyze)
+            for target in (targets.configs if targets else [config])
+        ]
+        return max(codes)
+
+    return run_sync_file(config, args.sync_file, args.dry_run, args.full)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sync_client  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def error_log(tmp_path, monkeypatch):
+    """Send ``append_error_log`` to a per-test file instead of logs/."""
+    path = str(tmp_path / "logs" / "err_message.log")
+    monkeypatch.setattr(sync_client, "ERROR_LOG_PATH", path)
+    monkeypatch.setattr(sync_client, "_ERROR_LOG", sync_client.ErrorLog(path, 60, 500, 200))
+    return path
@@ -0,0 +1,78 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sync_client  # noqa: E402
+
+
+def make_sizer(target=100):
+    return sync_client.BatchSizer(target, 10, 1000, 0, 1.0, adaptive=True)
+
+
+def test_fast_full_batches_grow_the_target():
+    sizer = make_sizer()
+
+    sizer.observe(100, 200, 0.1)
+
+    assert sizer.target == 126
+
+
+def test_partial_batches_do_not_grow_the_target():
+    sizer = make_sizer()
+
+    sizer.observe(40, 200, 0.1)
+
+    assert sizer.target == 100
+
+
+def test_slow_answers_and_server_errors_shrink_the_target():
+    sizer = make_sizer()
+
+    sizer.observe(100, 200, 2.0)
+    assert sizer.target == 80
+    sizer.observe(80, 503, 0.1)
+    assert sizer.target == 40
+    sizer.observe(40, None, 0.1)
+
+    assert sizer.target == 20
+
+
+def test_payload_too_large_caps_the_target_below_the_refused_batch():
+    sizer = make_sizer()
+
+    sizer.observe(100, 413, 0.1)
+    for _ in range(20):
+        sizer.observe(sizer.target, 200, 0.1)
+
+    assert sizer.target == 99
+
+
+def test_bad_rows_say_nothing_about_the_size():
+    sizer = make_sizer()
+
+    sizer.observe(100, 422, 0.1)
+
+    assert sizer.target == 100
+
+
+def test_fixed_batch_size_closes_on_byte_budget():
+    config = sync_client.load_config()
+    config.update(post_batch_adaptive=False, post_batch_size=1000, post_batch_max_bytes=1000)
+    sizer = sync_client.BatchSizer.from_config(config, "a.sql")
+
+    sizer.measure({"payload": {"text": "x" * 200}})
+
+    assert not sizer.is_full(3)
+    assert sizer.is_full(5)
+
+
+def test_learned_target_is_used_by_the_next_run(tmp_path):
+    config = sync_client.load_config()
+    config.update(post_batch_adaptive=True, post_batch_size=100, batch_sizes_path=str(tmp_path / "sizes.json"))
+    sizer = sync_client.BatchSizer.from_config(config, "a.sql")
+    sizer.observe(100, 200, 0.1)
+    sizer.save(config, "a.sql")
+
+    assert sync_client.BatchSizer.from_config(config, "a.sql").target == 126
+    assert sync_client.BatchSizer.from_config(config, "b.sql").target == 100
@@ -0,0 +1,15 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sync_client  # noqa: E402
+
+
+def test_state_dir_does_not_depend_on_working_directory(tmp_path, monkeypatch):
+    monkeypatch.delenv("SYNC_STATE_DIR", raising=False)
+    monkeypatch.chdir(tmp_path)
+
+    config = sync_client.load_config()
+
+    assert config["state_dir"] == os.path.join(sync_client.APP_DIR, "state")
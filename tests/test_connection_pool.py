@@ -0,0 +1,84 @@
+import os
+import sys
+
+import pymysql
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sync_client  # noqa: E402
+
+
+class StubConnection:
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.open = True
+        self.healthy = True
+
+    def ping(self, reconnect=False):
+        if not self.healthy:
+            raise pymysql.err.OperationalError(2006, "MySQL server has gone away")
+
+    def close(self):
+        self.open = False
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    made = []
+
+    def connect(**kwargs):
+        made.append(StubConnection(**kwargs))
+        return made[-1]
+
+    monkeypatch.setattr(pymysql, "connect", connect)
+    return made
+
+
+def make_pool(size=1, wait_timeout=0.1):
+    return sync_client.ConnectionPool(sync_client.load_config(), size, 300, wait_timeout)
+
+
+def test_connections_autocommit_so_reused_ones_see_new_rows(connections):
+    sync_client.connect_db(sync_client.load_config())
+
+    assert connections[0].kwargs["autocommit"] is True
+
+
+def test_released_connection_is_reused(connections):
+    pool = make_pool()
+
+    first = pool.acquire()
+    pool.release(first, reusable=True)
+
+    assert pool.acquire() is first
+    assert len(connections) == 1
+
+
+def test_broken_connection_is_replaced_on_checkout(connections):
+    pool = make_pool()
+    first = pool.acquire()
+    pool.release(first, reusable=True)
+    first.healthy = False
+
+    second = pool.acquire()
+
+    assert second is not first
+    assert not first.open
+
+
+def test_unreusable_connection_is_closed_and_frees_its_slot(connections):
+    pool = make_pool()
+    first = pool.acquire()
+    pool.release(first, reusable=False)
+
+    assert not first.open
+    assert pool.acquire() is not first
+
+
+def test_acquire_times_out_when_pool_is_full(connections):
+    pool = make_pool()
+    pool.acquire()
+
+    with pytest.raises(TimeoutError):
+        pool.acquire()
@@ -0,0 +1,62 @@
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sync_client  # noqa: E402
+
+
+def test_cron_fields_expand_lists_ranges_and_steps():
+    assert sync_client.parse_cron_field("*/15", 0, 59) == {0, 15, 30, 45}
+    assert sync_client.parse_cron_field("1-23/3", 0, 23) == {1, 4, 7, 10, 13, 16, 19, 22}
+    assert sync_client.parse_cron_field("5,10", 0, 59) == {5, 10}
+    assert sync_client.parse_cron_field("50/5", 0, 59) == {50, 55}
+
+
+@pytest.mark.parametrize("field", ["60", "0-60", "*/0"])
+def test_cron_fields_out_of_range_are_rejected(field):
+    with pytest.raises(ValueError):
+        sync_client.parse_cron_field(field, 0, 59)
+
+
+def test_job_matches_minute_and_hour():
+    job = sync_client.CronJob("5 1-23/3 * * *".split(), "a.sql")
+
+    assert job.matches(datetime(2024, 5, 1, 4, 5))
+    assert not job.matches(datetime(2024, 5, 1, 3, 5))
+    assert not job.matches(datetime(2024, 5, 1, 4, 6))
+
+
+def test_restricted_day_and_weekday_match_either():
+    # the 1st of the month or any Sunday (7 and 0 both mean Sunday)
+    job = sync_client.CronJob("0 0 1 * 7".split(), "a.sql")
+
+    assert job.matches(datetime(2024, 5, 1, 0, 0))  # Wednesday the 1st
+    assert job.matches(datetime(2024, 5, 5, 0, 0))  # Sunday the 5th
+    assert not job.matches(datetime(2024, 5, 6, 0, 0))
+
+
+def test_schedule_keeps_only_sync_jobs(tmp_path):
+    path = tmp_path / "sync-client"
+    path.write_text(
+        "SHELL=/bin/sh\n"
+        "# comment\n"
+        "*/10 * * * * root /usr/local/bin/python /app/sync_client.py 000_sync_test.sql >> /app/logs/cron.log 2>&1\n"
+        "*/5 * * * * root /usr/local/bin/python /app/sync_client.py --replay-outbox >> /app/logs/cron.log 2>&1\n"
+        "0 0 * * * root /usr/sbin/logrotate /etc/logrotate.conf\n",
+        encoding="utf-8",
+    )
+
+    jobs = sync_client.load_schedule(str(path))
+
+    assert [job.sync_file for job in jobs] == ["000_sync_test.sql"]
+
+
+def test_shipped_schedule_parses():
+    jobs = sync_client.load_schedule(sync_client.DEFAULT_SCHEDULE_PATH)
+
+    assert jobs
+    assert all(job.sync_file.endswith(".sql") for job in jobs)
@@ -0,0 +1,26 @@
+import errno
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sync_client  # noqa: E402
+
+
+def raise_disk_full(session, rows):
+    raise OSError(errno.ENOSPC, "No space left on device")
+
+
+@pytest.mark.parametrize("concurrency", [1, 4])
+def test_rows_of_a_raising_task_count_as_failed(concurrency):
+    config = sync_client.load_config()
+    limiter = sync_client.RateLimiter.from_config(config)
+    pool = sync_client.DeliveryPool(config, concurrency, "", limiter)
+
+    for _ in range(3):
+        pool.submit(5, raise_disk_full, 5)
+    pool.submit(2, lambda session: (2, 0))
+
+    assert pool.close() == (2, 15)
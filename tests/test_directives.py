@@ -0,0 +1,55 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sync_client  # noqa: E402
+
+
+def test_watermark_without_initial_does_not_take_next_line(tmp_path):
+    config = {"watermark_path": str(tmp_path / "watermarks.json")}
+    sql_text = "-- @watermark d_update\nSELECT * FROM t WHERE d_update > {{watermark}}\n"
+
+    bound, watermark = sync_client.bind_watermark(config, "a.sql", sql_text)
+
+    assert watermark.column == "d_update"
+    assert "d_update > '1970-01-01 00:00:00'" in bound
+
+
+def test_watermark_initial_value_stays_on_its_line(tmp_path):
+    config = {"watermark_path": str(tmp_path / "watermarks.json")}
+    sql_text = "-- @watermark vn 0\r\nSELECT * FROM ovst WHERE vn > {{watermark}}\r\n"
+
+    bound, _ = sync_client.bind_watermark(config, "a.sql", sql_text)
+
+    assert "vn > '0'" in bound
+
+
+def test_shard_directive_does_not_span_lines():
+    sql_text = "-- @shard vn 1 100\n4\nSELECT * FROM ovst WHERE {{shard}}\n"
+
+    assert sync_client.ShardPlan.from_sql(sql_text) is None
+
+
+def test_shard_directive_without_placeholder_is_ignored():
+    sql_text = "-- @shard hn 1 100 4\nSELECT hn, COUNT(*) FROM ovst GROUP BY hn\n"
+
+    assert sync_client.ShardPlan.from_sql(sql_text) is None
+
+
+def test_shard_pages_do_not_drop_rows_of_a_repeated_key(monkeypatch):
+    table = [{"vn": vn} for vn in (1, 2, 3, 3, 3, 4, 5, 6)]
+    plan = sync_client.ShardPlan("vn", [(1, None)], keyset=True)
+    monkeypatch.setattr(plan, "bind", lambda sql_text, low, high, after=None, limit=0: (after, limit))
+
+    def fetch_shard(config, query, source, label):
+        after, limit = query
+        rows = [row for row in table if after is None or row["vn"] > after]
+        return rows[:limit] if limit else rows
+
+    monkeypatch.setattr(sync_client, "fetch_shard", fetch_shard)
+    config = {"shard_page_rows": 2}
+
+    rows = list(sync_client.shard_pages(config, plan, "", "a.sql", 1, None))
+
+    assert rows == table
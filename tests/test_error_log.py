@@ -0,0 +1,39 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sync_client  # noqa: E402
+
+
+def read_lines(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_repeated_errors_keep_every_idx(tmp_path):
+    path = str(tmp_path / "err_message.log")
+    error_log = sync_client.ErrorLog(path, 60, 500, 200)
+
+    for index in (1, 4, 6):
+        error_log.append("post", "HTTP 422", {"source": "a.sql", "idx": f"{index}-{index}", "status": 422})
+    error_log.flush()
+
+    first, summary = read_lines(path)
+    assert first["idx"] == "1-1"
+    assert summary["repeated"] == 2
+    assert summary["repeated_idx"] == ["4-4", "6-6"]
+    assert summary["last_idx"] == "6-6"
+
+
+def test_distinct_errors_are_not_merged(tmp_path):
+    path = str(tmp_path / "err_message.log")
+    error_log = sync_client.ErrorLog(path, 60, 500, 200)
+
+    assert error_log.append("post", "HTTP 422", {"source": "a.sql", "idx": 1})
+    assert error_log.append("post", "HTTP 500", {"source": "a.sql", "idx": 2})
+    assert not error_log.append("post", "HTTP 500", {"source": "a.sql", "idx": 3})
+    error_log.flush()
+
+    assert [line.get("repeated", 0) for line in read_lines(path)] == [0, 0, 1]
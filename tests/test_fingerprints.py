@@ -0,0 +1,64 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sync_client  # noqa: E402
+
+
+def fingerprint_config(tmp_path):
+    return {
+        "row_fingerprint": True,
+        "fingerprint_path": str(tmp_path / "fingerprints.sqlite3"),
+        "row_fingerprint_ttl_hours": 24,
+    }
+
+
+def open_store(tmp_path, sql_text="-- @key hn, vn\nSELECT 1\n", full=False):
+    return sync_client.FingerprintStore.for_script(fingerprint_config(tmp_path), "a.sql", sql_text, full)
+
+
+def test_key_directive_reads_its_columns(tmp_path):
+    store = open_store(tmp_path, "-- @key: hn, vn\r\nSELECT hn, vn FROM ovst\r\n")
+
+    assert store.key_columns == ["hn", "vn"]
+
+
+def test_bare_key_directive_does_not_take_next_line(tmp_path):
+    store = open_store(tmp_path, "-- @key\nSELECT hn FROM ovst\n")
+
+    assert store.key_columns == []
+
+
+def test_delivered_rows_are_skipped_on_the_next_run(tmp_path):
+    rows = [{"hn": "1", "vn": "10", "x": 1}, {"hn": "2", "vn": "20", "x": 2}]
+    store = open_store(tmp_path)
+    assert [store.changed(index, row) for index, row in enumerate(rows)] == [True, True]
+    store.mark_delivered([0])
+    store.close()
+
+    store = open_store(tmp_path)
+    changed = [store.changed(index, row) for index, row in enumerate(rows)]
+    store.close()
+
+    assert changed == [False, True]
+
+
+def test_changed_content_and_full_runs_are_sent_again(tmp_path):
+    store = open_store(tmp_path)
+    store.changed(0, {"hn": "1", "vn": "10", "x": 1})
+    store.mark_delivered([0])
+    store.close()
+
+    store = open_store(tmp_path)
+    assert store.changed(0, {"hn": "1", "vn": "10", "x": 2})
+    store.close()
+    store = open_store(tmp_path, full=True)
+    assert store.changed(0, {"hn": "1", "vn": "10", "x": 1})
+    store.close()
+
+
+def test_store_is_off_unless_enabled(tmp_path):
+    config = dict(fingerprint_config(tmp_path), row_fingerprint=False)
+
+    assert sync_client.FingerprintStore.for_script(config, "a.sql", "SELECT 1") is None
@@ -0,0 +1,80 @@
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sync_client  # noqa: E402
+
+
+def make_governor(tmp_path, **overrides):
+    config = sync_client.load_config()
+    config.update(
+        state_dir=str(tmp_path),
+        his_stats_path=str(tmp_path / "his_load.json"),
+        his_heavy_seconds=60,
+        his_track_examined=False,
+        db_pool_wait_timeout=0.2,
+        **overrides,
+    )
+    with open(config["his_stats_path"], "w", encoding="utf-8") as f:
+        json.dump({"heavy.sql": {"runs": 1, "timeouts": 0, "avg_seconds": 120}}, f)
+    return config, sync_client.HisGovernor(config)
+
+
+def hold_query(governor, source, seconds, errors):
+    try:
+        with governor.query(source):
+            time.sleep(seconds)
+    except Exception as error:
+        errors.append(error)
+
+
+def test_heavy_query_waits_for_its_turn_past_the_pool_timeout(tmp_path):
+    _, governor = make_governor(tmp_path)
+    errors = []
+    threads = [threading.Thread(target=hold_query, args=(governor, "heavy.sql", 0.5, errors)) for _ in range(2)]
+
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert time.monotonic() - started >= 1.0
+
+
+def test_heavy_query_runs_anyway_after_its_wait_timeout(tmp_path):
+    _, governor = make_governor(tmp_path, his_heavy_wait_seconds=0.2)
+    errors = []
+    holder = threading.Thread(target=hold_query, args=(governor, "heavy.sql", 1.0, errors))
+    holder.start()
+    time.sleep(0.1)
+
+    started = time.monotonic()
+    with governor.query("heavy.sql"):
+        waited = time.monotonic() - started
+    holder.join()
+
+    assert errors == []
+    assert 0.2 <= waited < 0.9
+
+
+def test_shards_of_a_heavy_script_share_one_heavy_slot(tmp_path, monkeypatch):
+    config, governor = make_governor(tmp_path, shard_concurrency=3)
+
+    def fetch_rows(config, sql_text, source="", heavy=True):
+        with governor.query(source, heavy):
+            time.sleep(0.3)
+        return [{"sql": sql_text}]
+
+    monkeypatch.setattr(sync_client, "fetch_rows", fetch_rows)
+    monkeypatch.setattr(sync_client, "get_his_governor", lambda config: governor)
+    plan = sync_client.ShardPlan.from_sql("-- @shard vn 1 30 3\nSELECT * FROM ovst WHERE {{shard}}\n")
+
+    rows = list(sync_client.sharded_rows(config, plan, "SELECT * FROM ovst WHERE {{shard}}", "heavy.sql"))
+
+    assert len(rows) == 3
@@ -0,0 +1,64 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sync_client  # noqa: E402
+
+
+def targets_config(tmp_path, entries):
+    path = tmp_path / "targets.json"
+    path.write_text(json.dumps(entries), encoding="utf-8")
+    config = sync_client.load_config()
+    config.update(his_targets_file=str(path), state_dir=str(tmp_path / "state"))
+    return config
+
+
+def test_each_target_gets_its_own_connection_and_state(tmp_path):
+    config = targets_config(tmp_path, [
+        {"name": "rh1", "host": "10.0.0.1", "port": "3307", "hoscode": "11111"},
+        {"name": "rh2", "host": "10.0.0.2", "hoscode": "22222"},
+    ])
+
+    first, second = sync_client.get_his_targets(config).configs
+
+    assert (first["db_host"], first["db_port"], first["hoscode"]) == ("10.0.0.1", 3307, "11111")
+    assert (second["db_host"], second["db_port"]) == ("10.0.0.2", config["db_port"])
+    assert first["watermark_path"] == os.path.join(config["state_dir"], "targets", "rh1", "watermarks.json")
+    assert first["outbox_dir"] == second["outbox_dir"] == config["outbox_dir"]
+    assert sync_client.get_his_targets(first) is None
+
+
+@pytest.mark.parametrize("entries", [
+    [{"name": "rh1"}, {"name": "rh1"}],
+    [{"name": "../rh1"}],
+    [],
+])
+def test_invalid_target_files_are_rejected(tmp_path, entries):
+    with pytest.raises(ValueError):
+        sync_client.HisTargets.load(targets_config(tmp_path, entries))
+
+
+def test_a_failing_target_does_not_stop_the_others(tmp_path):
+    targets = sync_client.HisTargets.load(targets_config(tmp_path, [{"name": "rh1"}, {"name": "rh2"}]))
+    ran = []
+
+    def job(target):
+        ran.append(target["target"])
+        if target["target"] == "rh1":
+            raise OSError("HIS unreachable")
+        return {"exit_code": 0, "counters": {"rows_success": 3}}
+
+    assert targets.run("a.sql", job) == 1
+    assert sorted(ran) == ["rh1", "rh2"]
+    assert targets.run("a.sql", lambda target: {"exit_code": 0, "counters": {}}) == 0
+
+
+def test_single_target_without_targets_file():
+    config = sync_client.load_config()
+    config["his_targets_file"] = ""
+
+    assert sync_client.get_his_targets(config) is None
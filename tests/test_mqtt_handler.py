@@ -0,0 +1,28 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mqtt_handler_sync_custom as handler  # noqa: E402
+
+
+def test_normalize_sql_collapses_whitespace_outside_literals():
+    assert handler.normalize_sql("SELECT  *\n  FROM ovst ;\n") == "SELECT * FROM ovst"
+    assert handler.normalize_sql("SELECT 'a  b', \"c  d\" FROM t") == "SELECT 'a  b', \"c  d\" FROM t"
+
+
+def test_queries_differing_inside_a_string_do_not_share_cache_entries():
+    cache = handler.ResultCache(60, 1024 * 1024)
+    cache.put("SELECT * FROM patient WHERE name = 'A  B'", [{"hn": "1"}])
+
+    assert cache.get("SELECT * FROM patient WHERE name = 'A B'") is None
+    assert cache.get("SELECT *  FROM patient\nWHERE name = 'A  B'") == [{"hn": "1"}]
+
+
+def test_no_cache_request_is_not_coalesced_into_a_cached_one():
+    queue = handler.WorkQueue({}, 1, 10, "drop_new")
+
+    assert queue.submit("a", "SELECT 1")
+    assert not queue.submit("a", "SELECT  1")
+    assert queue.submit("a", "SELECT 1", refresh=True)
+    assert [job[3] for job in queue._pending] == [False, True]
@@ -0,0 +1,115 @@
+import json
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sync_client  # noqa: E402
+
+
+def make_outbox(tmp_path, max_attempts=20):
+    return sync_client.Outbox(str(tmp_path / "outbox"), 1024, 1024 * 1024, 1, max_attempts)
+
+
+def fake_api(monkeypatch, status_for):
+    sent = []
+
+    def send_limited(session, limiter, url, **kwargs):
+        sent.append(kwargs["json"]["id"])
+        return types.SimpleNamespace(status_code=status_for(kwargs["json"]["id"]), text="")
+
+    monkeypatch.setattr(sync_client, "send_limited", send_limited)
+    return sent
+
+
+def replay_config(tmp_path):
+    config = sync_client.load_config()
+    config["outbox_replay_concurrency"] = 1
+    config["post_rate"] = 1000
+    return config
+
+
+def test_rejected_segment_does_not_block_later_segments(tmp_path, monkeypatch):
+    outbox = make_outbox(tmp_path)
+    outbox.append({"url": "http://api", "source": "a.sql", "indexes": [1], "body": {"id": "bad"}})
+    outbox.close()
+    outbox.append({"url": "http://api", "source": "a.sql", "indexes": [2], "body": {"id": "good"}})
+    outbox.close()
+    sent = fake_api(monkeypatch, lambda body_id: 400 if body_id == "bad" else 200)
+
+    assert outbox.replay(replay_config(tmp_path)) == (1, 0)
+    assert sent == ["bad", "good"]
+    assert outbox.pending_segments() == []
+    with open(tmp_path / "outbox" / "dead-letter.jsonl", encoding="utf-8") as f:
+        assert [json.loads(line)["body"]["id"] for line in f] == ["bad"]
+
+
+def test_failing_segment_moves_behind_the_next_one(tmp_path, monkeypatch):
+    outbox = make_outbox(tmp_path, max_attempts=2)
+    outbox.append({"url": "http://api", "source": "a.sql", "indexes": [1], "body": {"id": "flaky"}})
+    outbox.close()
+    outbox.append({"url": "http://api", "source": "a.sql", "indexes": [2], "body": {"id": "good"}})
+    outbox.close()
+    sent = fake_api(monkeypatch, lambda body_id: 503 if body_id == "flaky" else 200)
+    config = replay_config(tmp_path)
+
+    outbox.replay(config)
+    outbox.replay(config)
+
+    outbox.close()
+    assert sent == ["flaky", "good", "flaky"]
+    assert len(outbox.pending_segments()) == 1
+
+
+def test_outage_stops_the_pass_and_does_not_count_attempts(tmp_path, monkeypatch):
+    outbox = make_outbox(tmp_path, max_attempts=1)
+    for index in range(3):
+        outbox.append({"url": "http://api", "source": "a.sql", "indexes": [index], "body": {"id": index}})
+    outbox.close()
+    sent = fake_api(monkeypatch, lambda body_id: 503)
+    config = replay_config(tmp_path)
+
+    for _ in range(5):
+        assert outbox.replay(config) == (0, 3)
+
+    assert sent == [0] * 5
+    assert not os.path.exists(tmp_path / "outbox" / "dead-letter.jsonl")
+
+
+def test_throttled_record_is_dead_lettered_after_max_attempts(tmp_path, monkeypatch):
+    outbox = make_outbox(tmp_path, max_attempts=2)
+    outbox.append({"url": "http://api", "source": "a.sql", "indexes": [1], "body": {"id": "slow"}})
+    outbox.close()
+    fake_api(monkeypatch, lambda body_id: 429)
+    config = replay_config(tmp_path)
+
+    outbox.replay(config)
+    outbox.replay(config)
+
+    assert outbox.pending_segments() == []
+    with open(tmp_path / "outbox" / "dead-letter.jsonl", encoding="utf-8") as f:
+        assert json.loads(f.readline())["attempts"] == 2
+
+
+def test_rows_rejected_on_first_delivery_are_dead_lettered(tmp_path, monkeypatch):
+    outbox = make_outbox(tmp_path)
+    statuses = {"bad": 422, "down": 503}
+
+    def send_limited(session, limiter, url, **kwargs):
+        body_id = kwargs["json"]["id"]
+        return types.SimpleNamespace(status_code=statuses[body_id], text=f"{body_id} row")
+
+    monkeypatch.setattr(sync_client, "send_limited", send_limited)
+    record = outbox.recorder("a.sql")
+    for index, body_id in enumerate(["bad", "down"]):
+        body = {"id": body_id, "hoscode": "1", "source": "a.sql"}
+        sync_client.post_single(None, None, "http://api", index, body, 5, None, record)
+    outbox.close()
+
+    with open(tmp_path / "outbox" / "dead-letter.jsonl", encoding="utf-8") as f:
+        dead = [json.loads(line) for line in f]
+    assert [(entry["indexes"], entry["body"]["id"], entry["response"]) for entry in dead] == [
+        ([0], "bad", "bad row"),
+    ]
+    assert len(outbox.pending_segments()) == 1
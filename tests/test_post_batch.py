@@ -0,0 +1,88 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sync_client  # noqa: E402
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = ""
+
+
+def post_columnar(monkeypatch, batch_url, status_code):
+    sent = []
+
+    def send_limited(session, limiter, url, **kwargs):
+        sent.append(kwargs["json"])
+        return FakeResponse(status_code)
+
+    monkeypatch.setattr(sync_client, "send_limited", send_limited)
+    batch = [
+        (index, {"hoscode": "1", "source": "a.sql", "sync_datetime": "", "payload": {"id": index}})
+        for index in range(2)
+    ]
+    result = sync_client.post_batch(None, None, batch_url, batch, 5, None, None, None, 0, 1, "columnar")
+    return result, sent
+
+
+def test_bad_row_status_keeps_columnar_format(monkeypatch):
+    result, sent = post_columnar(monkeypatch, "http://api.test/bad-row", 422)
+
+    assert result == (0, 2)
+    assert len(sent) == 1
+    assert "http://api.test/bad-row" not in sync_client._BATCH_FORMATS
+
+
+def test_unsupported_media_type_falls_back_to_rows(monkeypatch):
+    _, sent = post_columnar(monkeypatch, "http://api.test/no-columnar", 415)
+
+    assert isinstance(sent[0], dict)
+    assert isinstance(sent[1], list)
+    assert sync_client._BATCH_FORMATS["http://api.test/no-columnar"] == "rows"
+
+
+def bisect_batch(monkeypatch, rows, bad_rows):
+    requests_sent = []
+
+    def send_limited(session, limiter, url, **kwargs):
+        ids = [body["payload"]["id"] for body in kwargs["json"]]
+        requests_sent.append(ids)
+        return FakeResponse(422 if set(ids) & bad_rows else 200)
+
+    monkeypatch.setattr(sync_client, "send_limited", send_limited)
+    batch = [
+        (index, {"hoscode": "1", "source": "a.sql", "sync_datetime": "", "payload": {"id": index}})
+        for index in range(rows)
+    ]
+    failed = []
+    result = sync_client.post_batch(
+        None,
+        None,
+        "http://api.test/bisect",
+        batch,
+        5,
+        None,
+        lambda url, indexes, body, status, detail: failed.extend(indexes),
+        None,
+        10,
+        1,
+    )
+    return result, failed, requests_sent
+
+
+def test_bisect_isolates_the_bad_rows(monkeypatch):
+    result, failed, _ = bisect_batch(monkeypatch, 8, {1, 4, 6})
+
+    assert result == (5, 3)
+    assert sorted(failed) == [1, 4, 6]
+
+
+def test_bisect_stops_splitting_when_every_row_is_rejected(monkeypatch):
+    result, failed, requests_sent = bisect_batch(monkeypatch, 500, set(range(500)))
+
+    assert result == (0, 500)
+    assert sorted(failed) == list(range(500))
+    assert len(requests_sent) <= 25
@@ -0,0 +1,79 @@
+import os
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sync_client  # noqa: E402
+
+
+def response(status_code, headers=None, retried=()):
+    history = [types.SimpleNamespace(status=status) for status in retried]
+    raw = types.SimpleNamespace(retries=types.SimpleNamespace(history=history))
+    return types.SimpleNamespace(status_code=status_code, headers=headers or {}, raw=raw)
+
+
+def make_limiter(rate=10.0, adaptive=True):
+    return sync_client.RateLimiter(rate, 1.0, 20.0, 1.0, 0.5, 2.0, adaptive)
+
+
+def test_fast_success_raises_the_rate_up_to_the_maximum():
+    limiter = make_limiter(rate=19.5)
+
+    limiter.feedback(response(200), 0.1)
+    limiter.feedback(response(200), 0.1)
+
+    assert limiter.rate == 20.0
+
+
+def test_slow_success_holds_the_rate():
+    limiter = make_limiter()
+
+    limiter.feedback(response(200), 5.0)
+
+    assert limiter.rate == 10.0
+
+
+def test_throttling_and_connection_errors_cut_the_rate_down_to_the_minimum():
+    limiter = make_limiter(rate=3.0)
+
+    limiter.feedback(response(429), 0.1)
+    assert limiter.rate == 1.5
+    limiter.feedback(None, 0.1)
+
+    assert limiter.rate == 1.0
+
+
+def test_statuses_retried_away_by_urllib3_still_back_off():
+    limiter = make_limiter()
+
+    limiter.feedback(response(200, retried=[503]), 0.1)
+
+    assert limiter.rate == 5.0
+
+
+def test_retry_after_pauses_the_bucket():
+    limiter = make_limiter()
+
+    limiter.feedback(response(429, {"Retry-After": "1"}), 0.1)
+    started = time.monotonic()
+    limiter.acquire()
+
+    assert time.monotonic() - started >= 0.9
+
+
+def test_fixed_rate_ignores_feedback():
+    limiter = make_limiter(adaptive=False)
+
+    limiter.feedback(response(429), 0.1)
+    limiter.feedback(response(200), 0.1)
+
+    assert limiter.rate == 10.0
+
+
+def test_rate_defaults_to_post_sleep_ms():
+    config = sync_client.load_config()
+    config.update(post_rate=0, post_sleep_ms=250, post_rate_min=0.2, post_rate_max=50)
+
+    assert sync_client.RateLimiter.from_config(config).rate == 4.0